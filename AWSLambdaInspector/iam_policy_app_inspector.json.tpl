@@ -14,9 +14,29 @@
 				"lambda:ListFunctionEventInvokeConfigs",
 				"lambda:ListFunctionsByCodeSigningConfig",
 				"lambda:ListTags",
+				"lambda:GetFunction",
+				"lambda:InvokeFunction",
+				"tag:GetResources",
+				"ec2:DescribeRegions",
 				"cloudwatch:PutMetricData"
             ],
             "Resource": "*"
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+				"s3:GetObject",
+				"s3:PutObject",
+				"s3:DeleteObject"
+            ],
+            "Resource": "${state_bucket_arn}/*"
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+				"s3:ListBucket"
+            ],
+            "Resource": "${state_bucket_arn}"
         }
     ]
 }
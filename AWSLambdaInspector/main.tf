@@ -82,7 +82,9 @@ module "lambda_app_inspector" {
     }
   }
   environment_variables = {
-    CLOUDWATCH_NAMESPACE = var.cloudwatch_namespace
+    CLOUDWATCH_NAMESPACE   = var.cloudwatch_namespace
+    INSPECTOR_STATE_DIR    = "/tmp/lambda-inspector"
+    INSPECTOR_STATE_BUCKET = aws_s3_bucket.inspector_state.id
   }
 }
 
@@ -98,6 +100,101 @@ resource "aws_cloudwatch_event_target" "lambda_target" {
   arn       = module.lambda_app_inspector.lambda_function_arn
 }
 
+module "lambda_app_inspector_events" {
+  source        = "git::https://github.com/terraform-aws-modules/terraform-aws-lambda.git?ref=v6.4.0"
+  function_name = "app-inspector-events"
+  description   = "app inspector, update lambda and terraform tag metrics of changed functions"
+  handler       = "lambda_inspector_function.handle_function_events"
+  runtime       = "python3.13"
+  memory_size   = 160
+  timeout       = 30
+  source_path = [
+    {
+      path = "${path.module}/source-inspector"
+    }
+  ]
+  publish                           = true
+  attach_policies                   = true
+  attach_policy_jsons               = true
+  number_of_policies                = 1
+  number_of_policy_jsons            = 1
+  policy_jsons                      = [data.template_file.lambda_policy_app_inspector.rendered]
+  policies                          = ["arn:aws:iam::aws:policy/service-role/AWSLambdaVPCAccessExecutionRole"]
+  cloudwatch_logs_retention_in_days = 1
+  create_lambda_function_url        = false
+  allowed_triggers = {
+    FunctionChangeRule = {
+      principal    = "events.amazonaws.com"
+      source_arn   = aws_cloudwatch_event_rule.function_change_rule.arn
+      statement_id = "AllowExecutionFromEventBridge"
+    }
+  }
+  environment_variables = {
+    CLOUDWATCH_NAMESPACE = var.cloudwatch_namespace
+    INSPECTOR_STATE_DIR  = "/tmp/lambda-inspector"
+    # Same state as the scan function, so previous versions are known
+    INSPECTOR_STATE_BUCKET = aws_s3_bucket.inspector_state.id
+  }
+}
+
+# Needs a CloudTrail trail recording management events
+resource "aws_cloudwatch_event_rule" "function_change_rule" {
+  name        = "function_change_rule_${var.cloudwatch_namespace}"
+  description = "lambda function tag and code changes"
+  event_pattern = jsonencode({
+    source      = ["aws.lambda"]
+    detail-type = ["AWS API Call via CloudTrail"]
+    detail = {
+      eventName = [
+        { prefix = "TagResource" },
+        { prefix = "UntagResource" },
+        { prefix = "UpdateFunctionCode" },
+        { prefix = "CreateFunction" },
+        { prefix = "DeleteFunction" },
+      ]
+    }
+  })
+}
+
+resource "aws_cloudwatch_event_target" "function_change_target" {
+  rule      = aws_cloudwatch_event_rule.function_change_rule.name
+  target_id = "SendToLambda"
+  arn       = module.lambda_app_inspector_events.lambda_function_arn
+}
+
+# State shared by the scan and event functions (snapshot, watermarks, keepalive)
+resource "aws_s3_bucket" "inspector_state" {
+  bucket_prefix = "app-inspector-state-"
+  force_destroy = true
+}
+
+resource "aws_s3_bucket_public_access_block" "inspector_state" {
+  bucket                  = aws_s3_bucket.inspector_state.id
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+# Coordinators delete their shard documents, this only expires those of late shards
+resource "aws_s3_bucket_lifecycle_configuration" "inspector_state" {
+  bucket = aws_s3_bucket.inspector_state.id
+
+  rule {
+    id     = "expire-shard-runs"
+    status = "Enabled"
+    filter {
+      prefix = "lambda-inspector/shard-runs/"
+    }
+    expiration {
+      days = 1
+    }
+  }
+}
+
 data "template_file" "lambda_policy_app_inspector" {
   template = file("${path.module}/iam_policy_app_inspector.json.tpl")
+  vars = {
+    state_bucket_arn = aws_s3_bucket.inspector_state.arn
+  }
 }
@@ -0,0 +1,234 @@
+"""In-process stand-in for the Lambda, AWS Config and CloudWatch APIs.
+
+The fake serves a synthetic fleet and models what drives the inspector's run
+time at scale: per-call latency, page sizes and throttling. Each API has a
+token bucket, calls beyond its rate fail with ThrottlingException like the
+real services do. Calls and throttles are counted per operation.
+"""
+
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from botocore.exceptions import ClientError
+
+SERVICES = 200
+
+
+@dataclass
+class FakeAwsModel:
+    """Fleet size and API behaviour of the fake."""
+
+    function_count: int
+    page_size: int = 50  # list_functions page size
+    history_versions: int = 3  # Configuration items per function
+    # Seconds per call
+    latency: Dict[str, float] = field(
+        default_factory=lambda: {"lambda": 0.005, "config": 0.01, "cloudwatch": 0.01}
+    )
+    # Calls per second before the API throttles, None for no limit
+    rate_limits: Dict[str, Optional[float]] = field(
+        default_factory=lambda: {"lambda": 1000, "config": 300, "cloudwatch": 500}
+    )
+
+
+def function_name(index: int) -> str:
+    return f"function-{index:06d}"
+
+
+def function_payload(index: int) -> Dict:
+    """A list_functions entry as large as a typical production function."""
+    name = function_name(index)
+    return {
+        "FunctionName": name,
+        "FunctionArn": f"arn:aws:lambda:eu-west-1:123456789012:function:{name}",
+        "Runtime": "python3.13",
+        "Role": f"arn:aws:iam::123456789012:role/{name}-role",
+        "Handler": "lambda_function.handler",
+        "CodeSize": 1024 * index,
+        "Description": f"Synthetic function {index} used by the benchmarks",
+        "Timeout": 30,
+        "MemorySize": 256,
+        "LastModified": "2024-01-01T00:00:00.000+0000",
+        "CodeSha256": f"{index:064d}",
+        "Version": "$LATEST",
+        "Environment": {
+            "Variables": {f"VARIABLE_{i}": f"value-{index}-{i}" for i in range(10)}
+        },
+        "TracingConfig": {"Mode": "PassThrough"},
+        "RevisionId": f"{index:08d}-0000-0000-0000-000000000000",
+        "Layers": [
+            {
+                "Arn": f"arn:aws:lambda:eu-west-1:123456789012:layer:layer-{i}:1",
+                "CodeSize": 4096,
+            }
+            for i in range(3)
+        ],
+        "PackageType": "Zip",
+        "Architectures": ["arm64"],
+        "EphemeralStorage": {"Size": 512},
+    }
+
+
+def function_tags(index: int, revision: int = 0) -> Dict[str, str]:
+    service = index % SERVICES
+    return {
+        "AppVersion": f"1.{index % 7}.{revision}",
+        "TerraformVersion": f"1.{9 - revision}.0",
+        "Environment": "prod",
+        "Service": f"service-{service}",
+        "Stack": f"stack-{service % 20}",
+        "Owner": f"team-{service % 10}",
+        "CostCenter": f"cc-{service % 5}",
+    }
+
+
+def _index(name_or_arn: str) -> int:
+    return int(name_or_arn.rsplit("-", 1)[-1])
+
+
+class _Api:
+    """Latency, token bucket throttling and call counting of one service."""
+
+    def __init__(self, name: str, model: FakeAwsModel, stats: "FakeAwsStats"):
+        self.name = name
+        self.latency = model.latency.get(name, 0)
+        self.rate = model.rate_limits.get(name)
+        self.stats = stats
+        self.tokens = self.rate or 0
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+
+    def call(self, operation: str) -> None:
+        self.stats.count(operation)
+        if self.rate is not None:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.refilled) * self.rate
+                )
+                self.refilled = now
+                throttled = self.tokens < 1
+                if not throttled:
+                    self.tokens -= 1
+            if throttled:
+                self.stats.count(operation, throttled=True)
+                time.sleep(self.latency / 2)
+                raise ClientError(
+                    {
+                        "Error": {
+                            "Code": "ThrottlingException",
+                            "Message": "Rate exceeded",
+                        }
+                    },
+                    operation,
+                )
+        time.sleep(self.latency)
+
+
+class FakeAwsStats:
+    """Calls and throttles per operation."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.throttles = Counter()
+        self.metrics_received = 0
+        self.lock = threading.Lock()
+
+    def count(self, operation: str, throttled: bool = False) -> None:
+        with self.lock:
+            (self.throttles if throttled else self.calls)[operation] += 1
+
+
+class _Paginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+class FakeLambdaClient:
+    def __init__(self, model: FakeAwsModel, api: _Api):
+        self.model = model
+        self.api = api
+
+    def get_paginator(self, operation: str) -> _Paginator:
+        def pages(**kwargs):
+            count = self.model.function_count
+            for start in range(0, count, self.model.page_size):
+                self.api.call("ListFunctions")
+                end = min(start + self.model.page_size, count)
+                yield {"Functions": [function_payload(i) for i in range(start, end)]}
+
+        return _Paginator(pages)
+
+    def list_tags(self, Resource: str) -> Dict:
+        self.api.call("ListTags")
+        return {"Tags": function_tags(_index(Resource))}
+
+
+class FakeConfigClient:
+    def __init__(self, model: FakeAwsModel, api: _Api):
+        self.model = model
+        self.api = api
+
+    def get_paginator(self, operation: str) -> _Paginator:
+        def pages(resourceId: str, limit: int = 100, **kwargs):
+            index = _index(resourceId)
+            now = datetime.now(timezone.utc)
+            items = [
+                {
+                    "tags": function_tags(index, revision),
+                    "configurationItemCaptureTime": now - timedelta(days=revision * 30),
+                }
+                for revision in range(self.model.history_versions)
+            ]
+            for start in range(0, max(len(items), 1), limit):
+                self.api.call("GetResourceConfigHistory")
+                yield {"configurationItems": items[start : start + limit]}
+
+        return _Paginator(pages)
+
+
+class FakeCloudWatchClient:
+    def __init__(self, api: _Api, stats: FakeAwsStats):
+        self.api = api
+        self.stats = stats
+
+    def put_metric_data(self, Namespace: str, MetricData) -> Dict:
+        if len(MetricData) > 1000:
+            raise ClientError(
+                {"Error": {"Code": "InvalidParameterValue", "Message": "Too many"}},
+                "PutMetricData",
+            )
+        self.api.call("PutMetricData")
+        with self.stats.lock:
+            self.stats.metrics_received += len(MetricData)
+        return {}
+
+
+class FakeSession:
+    """boto3.Session stand-in handing out the fake clients."""
+
+    region_name = "eu-west-1"
+
+    def __init__(self, model: FakeAwsModel):
+        self.model = model
+        self.stats = FakeAwsStats()
+        self.apis = {
+            name: _Api(name, model, self.stats)
+            for name in ("lambda", "config", "cloudwatch")
+        }
+
+    def client(self, service_name: str, config=None):
+        if service_name == "lambda":
+            return FakeLambdaClient(self.model, self.apis["lambda"])
+        if service_name == "config":
+            return FakeConfigClient(self.model, self.apis["config"])
+        if service_name == "cloudwatch":
+            return FakeCloudWatchClient(self.apis["cloudwatch"], self.stats)
+        raise ValueError(f"Service {service_name} is not faked")
@@ -0,0 +1,137 @@
+"""Memory benchmark of function discovery and metric building.
+
+Runs get_all_functions and build_metrics against the fake Lambda API of
+fake_aws.py (list_functions pages with environment variables, layers and
+extra tags) and compares the peak and retained memory with the previous
+representation of the baseline inspector: plain dataclasses with the
+function's full tags, every raw list_functions payload held until all tags
+are read, and fresh dimension dicts for every metric.
+
+Usage:
+    python benchmarks/memory_benchmark.py [FUNCTION_COUNT ...]
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import lambda_inspector_function as inspector_module  # noqa: E402
+from fake_aws import FakeAwsModel, FakeSession  # noqa: E402
+from lambda_inspector_function import (  # noqa: E402
+    DimensionNames,
+    LambdaInspector,
+    MetricNames,
+    TagNames,
+    build_metrics,
+)
+
+DEFAULT_COUNTS = (10_000, 50_000)
+
+
+def fake_session(count: int) -> FakeSession:
+    # No latency or throttling, only memory is measured
+    return FakeSession(FakeAwsModel(count, latency={}, rate_limits={}))
+
+
+@dataclass
+class LegacyFunction:
+    name: str
+    arn: str
+    tags: Dict[str, str]
+
+
+@dataclass
+class LegacyMetric:
+    metric_name: str
+    dimensions: List[Dict[str, str]]
+    value: float
+    unit: str
+    timestamp: Optional[object] = None
+
+
+def legacy_functions(client) -> List[LegacyFunction]:
+    """Baseline get_all_functions: all payloads first, then the tags of each."""
+    payloads = []
+    for page in client.get_paginator("list_functions").paginate():
+        payloads.extend(page["Functions"])
+    functions = []
+    for payload in payloads:
+        tags = client.list_tags(Resource=payload["FunctionArn"])["Tags"]
+        functions.append(
+            LegacyFunction(payload["FunctionName"], payload["FunctionArn"], tags)
+        )
+    return functions
+
+
+def run_legacy(count: int) -> List:
+    """Previous representation: full tags and fresh dimension dicts."""
+    functions = legacy_functions(fake_session(count).client("lambda"))
+    metrics = []
+    for function in functions:
+        tags = function.tags
+        metrics.append(
+            LegacyMetric(
+                MetricNames.LAMBDA_TAG,
+                [
+                    {"Name": DimensionNames.ENV, "Value": tags[TagNames.ENVIRONMENT]},
+                    {"Name": DimensionNames.STACK, "Value": tags[TagNames.STACK]},
+                    {"Name": DimensionNames.SERVICE, "Value": tags[TagNames.SERVICE]},
+                    {"Name": DimensionNames.FUNCTION_NAME, "Value": function.name},
+                    {
+                        "Name": DimensionNames.APP_VERSION,
+                        "Value": tags[TagNames.APP_VERSION],
+                    },
+                ],
+                1,
+                "Count",
+            )
+        )
+    return [functions, metrics]
+
+
+def run_current(count: int) -> List:
+    inspector = LambdaInspector(state_store=None, session=fake_session(count))
+    functions = inspector.get_all_functions()
+    metrics = build_metrics(inspector, functions, {})
+    return [functions, metrics]
+
+
+def measure(run, count: int) -> Dict[str, float]:
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = run(count)
+    elapsed = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {
+        "seconds": elapsed,
+        "retained_mb": retained / 2**20,
+        "peak_mb": peak / 2**20,
+    }
+
+
+def main(counts) -> None:
+    # Keep the inspector's progress output out of the report
+    inspector_module.print = lambda *args, **kwargs: None
+    print(
+        f"{'functions':>10} {'variant':>8} {'peak MB':>9} {'retained MB':>12} {'seconds':>8}"
+    )
+    for count in counts:
+        for variant, run in (("legacy", run_legacy), ("current", run_current)):
+            stats = measure(run, count)
+            print(
+                f"{count:>10} {variant:>8} {stats['peak_mb']:>9.1f} "
+                f"{stats['retained_mb']:>12.1f} {stats['seconds']:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS)
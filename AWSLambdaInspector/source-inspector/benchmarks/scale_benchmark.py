@@ -0,0 +1,183 @@
+"""Scale benchmark of the inspector against the in-process AWS stand-in.
+
+Drives get_all_functions, get_tags_history_batch and publish_metrics_batch
+at several fleet sizes against fake_aws.py, which models per-call latency,
+page sizes and throttling. Every size runs in its own process so peak RSS
+is measured per size. Reports wall time per phase, API calls and throttles,
+peak RSS and publish throughput.
+
+Results are stored in benchmarks/results/scale.json together with the
+commit they were measured on, and each run prints the change against the
+stored results, so committing the file makes regressions visible between
+commits.
+
+Usage:
+    python benchmarks/scale_benchmark.py [--sizes 1000 10000 50000]
+        [--no-history] [--max-regression 0.2]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_PATH = os.path.join(BENCHMARKS_DIR, "results", "scale.json")
+DEFAULT_SIZES = (1_000, 10_000, 50_000)
+# Compared against the stored results, lower is better for all of them
+TRACKED = ("list_seconds", "history_seconds", "publish_seconds", "peak_rss_mb")
+
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+
+def run_size(size: int, history: bool) -> Dict:
+    """Measure one fleet size, meant to run in a fresh process."""
+    import lambda_inspector_function as inspector_module
+    from fake_aws import FakeAwsModel, FakeSession
+    from lambda_inspector_function import LambdaInspector, build_metrics
+
+    # Keep the inspector's progress output out of the report
+    inspector_module.print = lambda *args, **kwargs: None
+    session = FakeSession(FakeAwsModel(size))
+    inspector = LambdaInspector(state_store=None, session=session)
+
+    started = time.perf_counter()
+    functions = inspector.get_all_functions()
+    listed = time.perf_counter()
+    history_results = {}
+    if history:
+        history_results = inspector.get_tags_history_batch(functions, 365, 0)
+    fetched = time.perf_counter()
+    metrics = build_metrics(inspector, functions, history_results)
+    built = time.perf_counter()
+    result = inspector.publish_metrics_batch(metrics)
+    published = time.perf_counter()
+
+    publish_seconds = published - built
+    return {
+        "functions": len(functions),
+        "metrics": len(metrics),
+        "wall_seconds": round(published - started, 3),
+        "list_seconds": round(listed - started, 3),
+        "history_seconds": round(fetched - listed, 3),
+        "build_seconds": round(built - fetched, 3),
+        "publish_seconds": round(publish_seconds, 3),
+        "publish_metrics_per_second": round(
+            len(result.published) / publish_seconds if publish_seconds else 0, 1
+        ),
+        "rejected": len(result.rejected),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "api_calls": dict(session.stats.calls),
+        "throttles": dict(session.stats.throttles),
+    }
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCHMARKS_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def change(current: float, previous: float) -> str:
+    if not previous:
+        return ""
+    return f"{(current - previous) / previous:+.0%}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--no-history", action="store_true")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        help="Fail when a tracked value grows by more than this fraction",
+    )
+    parser.add_argument("--results", default=RESULTS_PATH)
+    parser.add_argument("--run-size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size:
+        print(json.dumps(run_size(args.run_size, not args.no_history)))
+        return 0
+
+    previous = {}
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            previous = json.load(f)
+
+    results = {}
+    for size in args.sizes:
+        command = [sys.executable, __file__, "--run-size", str(size)]
+        if args.no_history:
+            command.append("--no-history")
+        output = subprocess.run(command, capture_output=True, text=True, check=True)
+        results[str(size)] = json.loads(output.stdout.strip().splitlines()[-1])
+
+    regressions = []
+    print(
+        f"{'functions':>10} {'wall s':>8} {'list s':>8} {'history s':>10} "
+        f"{'publish s':>10} {'metrics/s':>10} {'peak RSS MB':>12}  api calls (throttled)"
+    )
+    for size, result in results.items():
+        stored = previous.get("results", {}).get(size, {})
+        calls = ", ".join(
+            f"{operation} {count} ({result['throttles'].get(operation, 0)})"
+            for operation, count in sorted(result["api_calls"].items())
+        )
+        print(
+            f"{size:>10} {result['wall_seconds']:>8.2f} {result['list_seconds']:>8.2f} "
+            f"{result['history_seconds']:>10.2f} {result['publish_seconds']:>10.2f} "
+            f"{result['publish_metrics_per_second']:>10.0f} {result['peak_rss_mb']:>12.1f}  "
+            f"{calls}"
+        )
+        for key in TRACKED:
+            if key not in stored:
+                continue
+            print(
+                f"{'':>10} {key}: {stored[key]} -> {result[key]} {change(result[key], stored[key])}"
+            )
+            if (
+                args.max_regression is not None
+                and stored[key]
+                and (result[key] - stored[key]) / stored[key] > args.max_regression
+            ):
+                regressions.append(f"{size} {key}")
+
+    os.makedirs(os.path.dirname(args.results), exist_ok=True)
+    with open(args.results, "w") as f:
+        json.dump(
+            {
+                "commit": current_commit(),
+                "previous_commit": previous.get("commit"),
+                "history": not args.no_history,
+                "results": results,
+            },
+            f,
+            indent=2,
+            sort_keys=True,
+        )
+        f.write("\n")
+
+    if regressions:
+        print(f"Regressions beyond {args.max_regression:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,35 @@
+import json
+import math
 import os
+import queue
+import random
+import re
+import struct
+import sys
+import threading
 import time
-from dataclasses import dataclass
-from typing import Dict, List, Set, Tuple
-from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import uuid
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import boto3
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from botocore.exceptions import HTTPClientError
+
+try:
+    import snappy  # python-snappy, optional
+except ImportError:
+    snappy = None
 
 CLOUDWATCH_NAMESPACE = os.environ.get("CLOUDWATCH_NAMESPACE", "StackRef")
 
@@ -20,6 +45,30 @@ class TagNames:
     STACK = "Stack"
 
 
+# Tags the inspector reads, other tags are dropped as soon as they are fetched
+INSPECTED_TAGS = frozenset(
+    (
+        TagNames.APP_VERSION,
+        TagNames.TERRAFORM_VERSION,
+        TagNames.ENVIRONMENT,
+        TagNames.SERVICE,
+        TagNames.STACK,
+    )
+)
+# CloudTrail events of Lambda API calls that can change a function's tags
+FUNCTION_CHANGE_EVENTS = frozenset(
+    {
+        "TagResource",
+        "UntagResource",
+        "UpdateFunctionCode",
+        "CreateFunction",
+        "DeleteFunction",
+    }
+)
+# list_functions fields the inspector reads, the rest of each page is dropped
+LISTED_FUNCTION_FIELDS = ("FunctionName", "FunctionArn", "LastModified", "RevisionId")
+
+
 class DimensionNames:
     """CloudWatch metric dimension names"""
 
@@ -29,6 +78,11 @@ class DimensionNames:
     FUNCTION_NAME = "FunctionName"
     APP_VERSION = "AppVersion"
     TERRAFORM_VERSION = "TerraformVersion"
+    REGION = "Region"
+    ACCOUNT_ID = "AccountId"
+    PHASE = "Phase"
+    API = "Api"
+    PERCENTILE = "Percentile"
 
 
 class MetricNames:
@@ -36,6 +90,13 @@ class MetricNames:
 
     LAMBDA_TAG = "lambdaTag"
     TERRAFORM_TAG = "terraformTag"
+    # Self-metrics about the inspector's own runs
+    RUN_DURATION = "InspectorRunDuration"
+    PHASE_DURATION = "InspectorPhaseDuration"
+    API_CALLS = "InspectorApiCalls"
+    API_LATENCY = "InspectorApiLatency"
+    API_THROTTLES = "InspectorApiThrottles"
+    API_RETRIES = "InspectorApiRetries"
 
 
 class Config:
@@ -46,408 +107,4647 @@ class Config:
     FULL_HISTORY_EARLIER_DAYS = 365
     CLOUDWATCH_RETENTION_OLD_METRICS_DAYS = 14
     CONFIG_HISTORY_LIMIT = 100
+    CONFIG_SELECT_LIMIT = 100  # Maximum results per SelectResourceConfig page
     AWS_LAMBDA_FUNCTION_RESOURCE_TYPE = "AWS::Lambda::Function"
-    MAX_WORKERS_AWS = 3  # Maximum number of parallel workers for AWS Config
-    CW_BATCH_SIZE = 20  # Batch size for CloudWatch metric publishing
+    MAX_WORKERS_AWS = 3  # Initial parallel calls per AWS API, adapted at run time
+    MIN_WORKERS_AWS = 1  # Lowest concurrency AIMD can back off to
+    AIMD_DECREASE_FACTOR = 0.5  # Concurrency multiplier applied on throttling
+    THROTTLE_MAX_ATTEMPTS = 5  # Attempts per call before a throttle is returned
+    THROTTLE_BACKOFF_BASE_SECONDS = 0.2
+    THROTTLE_BACKOFF_MAX_SECONDS = 5.0
+    THROTTLING_ERROR_CODES = frozenset(
+        {
+            "ThrottlingException",
+            "TooManyRequestsException",
+            "Throttling",
+            "RequestLimitExceeded",
+        }
+    )
+    # Server side error codes worth retrying as is, on top of throttling
+    TRANSIENT_ERROR_CODES = frozenset(
+        {
+            "InternalFailure",
+            "InternalServiceError",
+            "InternalServiceFault",
+            "ServiceUnavailable",
+            "RequestTimeout",
+        }
+    )
+    # Credential and permission error codes, every request fails the same way
+    AUTH_ERROR_CODES = frozenset(
+        {
+            "AccessDenied",
+            "AccessDeniedException",
+            "InvalidClientTokenId",
+            "UnrecognizedClientException",
+            "ExpiredToken",
+            "ExpiredTokenException",
+            "SignatureDoesNotMatch",
+            "MissingAuthenticationToken",
+        }
+    )
+    # Error codes caused by the request data, worth splitting the batch on
+    DATA_ERROR_CODES = frozenset(
+        {
+            "InvalidParameterValue",
+            "InvalidParameterCombination",
+            "MissingParameter",
+            "MissingRequiredParameter",
+            "RequestEntityTooLarge",
+            "ValidationError",
+        }
+    )
+    CW_TRANSIENT_MAX_ATTEMPTS = 4  # Attempts per batch on transient errors
+    CW_BATCH_SIZE = 1000  # Maximum metrics per PutMetricData request
+    CW_MAX_PAYLOAD_BYTES = 1_000_000  # Maximum PutMetricData request size
+    CW_MAX_VALUES_PER_METRIC = 150  # Maximum distinct Values in one entry
+    # Serialized size budgeted per metric field on top of its value, sized for
+    # the verbose query protocol so batches stay under the limit for any protocol
+    CW_FIELD_OVERHEAD_BYTES = 64
+    # Request bodies from this size on are sent gzip compressed
+    CW_COMPRESSION_MIN_BYTES = int(os.environ.get("CW_COMPRESSION_MIN_BYTES", "10240"))
+    # Where metrics go, see MetricSinks
+    METRIC_SINK = os.environ.get("METRIC_SINK", "cloudwatch")
+    # File written by the openmetrics and jsonl sinks
+    METRIC_SINK_PATH = os.environ.get("METRIC_SINK_PATH")
+    JSONL_BUFFER_LINES = int(os.environ.get("JSONL_BUFFER_LINES", "1000"))
+    REMOTE_WRITE_URL = os.environ.get("REMOTE_WRITE_URL")
+    REMOTE_WRITE_BATCH_SIZE = int(os.environ.get("REMOTE_WRITE_BATCH_SIZE", "500"))
+    REMOTE_WRITE_TIMEOUT_SECONDS = float(
+        os.environ.get("REMOTE_WRITE_TIMEOUT_SECONDS", "10")
+    )
+    REMOTE_WRITE_MAX_ATTEMPTS = 4
+    # Columnar snapshot of every run's functions, a directory or s3://bucket/prefix
+    SNAPSHOT_EXPORT_PATH = os.environ.get("SNAPSHOT_EXPORT_PATH")
+    SNAPSHOT_EXPORT_FORMAT = os.environ.get("SNAPSHOT_EXPORT_FORMAT", "parquet")
+    # Rows buffered per record batch (Parquet row group)
+    SNAPSHOT_EXPORT_BATCH_ROWS = int(
+        os.environ.get("SNAPSHOT_EXPORT_BATCH_ROWS", "10000")
+    )
+    EMF_MAX_METRICS_PER_LINE = 100  # EMF limit of metric definitions
+    EMF_MAX_VALUES_PER_METRIC = 100  # EMF limit of values in a metric array
+    EMF_MAX_LINE_BYTES = 250_000  # Below the 256 KB CloudWatch Logs event limit
+    # botocore client settings, "adaptive" retries add a client-side rate limiter.
+    # Throttles left after BOTO_MAX_ATTEMPTS reach the AIMD limiters.
+    BOTO_RETRY_MODE = os.environ.get("BOTO_RETRY_MODE", "adaptive")
+    BOTO_MAX_ATTEMPTS = int(os.environ.get("BOTO_MAX_ATTEMPTS", "3"))
+    BOTO_CONNECT_TIMEOUT_SECONDS = float(
+        os.environ.get("BOTO_CONNECT_TIMEOUT_SECONDS", "5")
+    )
+    BOTO_READ_TIMEOUT_SECONDS = float(os.environ.get("BOTO_READ_TIMEOUT_SECONDS", "30"))
+    BOTO_TCP_KEEPALIVE = os.environ.get("BOTO_TCP_KEEPALIVE", "true").lower() == "true"
+    BOTO_DEFAULT_POOL_CONNECTIONS = 10
+    TAG_DISCOVERY_MODE = os.environ.get("TAG_DISCOVERY_MODE", "lambda")
+    TAGGING_RESOURCE_TYPE = "lambda:function"
+    TAGGING_PAGE_SIZE = 100  # Maximum ResourcesPerPage for GetResources
+    # Fewer functions to look up are cheaper with ListTags than paging GetResources
+    TAG_BULK_MIN_FUNCTIONS = int(os.environ.get("TAG_BULK_MIN_FUNCTIONS", "100"))
+    STATE_DIR = os.environ.get("INSPECTOR_STATE_DIR")  # e.g. /tmp/lambda-inspector
+    STATE_BUCKET = os.environ.get("INSPECTOR_STATE_BUCKET")  # Durable S3 state
+    STATE_PREFIX = os.environ.get("INSPECTOR_STATE_PREFIX", "lambda-inspector/")
+    DEFAULT_STATE_DIR = "/tmp/lambda-inspector"  # Warm cache of the S3 state
+    HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "config-history")
+    # Log the versions seen by every run, always on for the snapshot-log backend
+    OBSERVATION_LOG = os.environ.get("OBSERVATION_LOG", "false").lower() == "true"
+    # Segments of the observation log older than this are pruned
+    OBSERVATION_LOG_RETENTION_DAYS = float(
+        os.environ.get("OBSERVATION_LOG_RETENTION_DAYS", "400")
+    )
+    # Query an AWS Config aggregator instead of the local account and region
+    CONFIG_AGGREGATOR_NAME = os.environ.get("CONFIG_AGGREGATOR_NAME")
+    # Longest AWS Config window scanned per function and run while backfilling
+    HISTORY_BACKFILL_CHUNK_DAYS = float(
+        os.environ.get("HISTORY_BACKFILL_CHUNK_DAYS", "30")
+    )
+    # Unchanged value-0 series are re-published after this, CloudWatch drops
+    # series without datapoints for CLOUDWATCH_RETENTION_OLD_METRICS_DAYS
+    KEEPALIVE_INTERVAL_SECONDS = int(
+        os.environ.get("KEEPALIVE_INTERVAL_SECONDS", str(12 * 86400))
+    )
+    # Unchanged non-zero series are re-published after this, 0 publishes them
+    # every run so dashboards over short time ranges stay filled
+    ACTIVE_REFRESH_SECONDS = int(os.environ.get("ACTIVE_REFRESH_SECONDS", "0"))
+    # Comma separated regions to inspect in one run, "all" for every enabled
+    # region, unset for the current region only
+    INSPECTOR_REGIONS = os.environ.get("INSPECTOR_REGIONS", "")
+    MAX_PARALLEL_REGIONS = int(os.environ.get("MAX_PARALLEL_REGIONS", "8"))
+    # Seconds each region may take, "region=seconds" pairs override the default
+    REGION_TIME_BUDGET_SECONDS = os.environ.get("REGION_TIME_BUDGET_SECONDS")
+    REGION_TIME_BUDGETS = os.environ.get("REGION_TIME_BUDGETS", "")
+    # Comma separated accounts to inspect through AssumeRole, "organization"
+    # for every active account of the AWS Organization, unset for this account
+    INSPECTOR_ACCOUNT_IDS = os.environ.get("INSPECTOR_ACCOUNT_IDS", "")
+    INSPECTOR_ROLE_NAME = os.environ.get("INSPECTOR_ROLE_NAME", "lambda-inspector")
+    MAX_PARALLEL_ACCOUNTS = int(os.environ.get("MAX_PARALLEL_ACCOUNTS", "16"))
+    ACCOUNT_TIME_BUDGET_SECONDS = os.environ.get("ACCOUNT_TIME_BUDGET_SECONDS")
+    # Resolved regions and accounts are reused by warm invocations this long
+    TARGETS_REFRESH_SECONDS = int(os.environ.get("TARGETS_REFRESH_SECONDS", "3600"))
+    # Assumed role credentials are renewed this long before they expire
+    CREDENTIALS_REFRESH_MARGIN_SECONDS = 300
+    # Tag-only changes do not alter LastModified/RevisionId, so every function
+    # is re-fetched once the snapshot is older than this
+    SNAPSHOT_MAX_AGE_SECONDS = int(os.environ.get("SNAPSHOT_MAX_AGE_SECONDS", "3600"))
+    # Distinct dimension name/value pairs and services whose dimension dicts are shared
+    DIMENSION_CACHE_SIZE = 65536
+    SERVICE_DIMENSION_CACHE_SIZE = 8192
+    # "batch" lists every function before publishing, "streaming" publishes
+    # while later pages are still being listed
+    PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "batch")
+    # Items buffered between two streaming stages
+    PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "4"))
+    # Publish phase timings and per-API call statistics of every run
+    SELF_METRICS = os.environ.get("INSPECTOR_SELF_METRICS", "true").lower() == "true"
+    # Lambda runs stop this long before the invocation times out, checkpoint
+    # their progress and continue in a follow-up invocation
+    CHECKPOINT_RESERVE_SECONDS = float(
+        os.environ.get("CHECKPOINT_RESERVE_SECONDS", "5")
+    )
+    # Checkpoints older than this are discarded and the run starts over
+    CHECKPOINT_MAX_AGE_SECONDS = int(
+        os.environ.get("CHECKPOINT_MAX_AGE_SECONDS", str(6 * 3600))
+    )
+    HISTORY_CHUNK_SIZE = int(os.environ.get("HISTORY_CHUNK_SIZE", "200"))
+    PUBLISH_CHUNK_SIZE = 10_000  # Metrics published between two deadline checks
+    # Follow-up invocations of one run, a later scheduled run resumes after that
+    MAX_CONTINUATIONS = int(os.environ.get("MAX_CONTINUATIONS", "20"))
+    # Parallel workers fetching history of a large fleet, 1 disables sharding
+    SHARD_COUNT = int(os.environ.get("INSPECTOR_SHARDS", "1"))
+    # Function invoked for each shard, this function itself inside Lambda;
+    # unset outside Lambda, where shards run in local processes
+    SHARD_WORKER_FUNCTION = os.environ.get(
+        "SHARD_WORKER_FUNCTION", os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+    )
+    SHARD_TIMEOUT_SECONDS = float(os.environ.get("SHARD_TIMEOUT_SECONDS", "600"))
+    SHARD_POLL_SECONDS = 2
+    SHARD_RUNS_SCOPE = "shard-runs"  # State scope of shard inputs and results
+    # SQLite inventory of the versions each function ran, unset disables it
+    VERSION_INDEX_PATH = os.environ.get("VERSION_INDEX_PATH")
+    # Change events of a function within this window are handled together
+    EVENT_COALESCE_SECONDS = float(os.environ.get("EVENT_COALESCE_SECONDS", "2"))
+    # Nearest-rank percentiles of the API latencies reported per run
+    LATENCY_PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))
 
 
-@dataclass
+class ApiNames:
+    """AWS APIs the inspector fans out to, each with its own concurrency limit"""
+
+    LAMBDA_LIST_TAGS = "lambda:ListTags"
+    LAMBDA_GET_FUNCTION = "lambda:GetFunction"
+    CONFIG_RESOURCE_HISTORY = "config:GetResourceConfigHistory"
+    CONFIG_SELECT = "config:SelectResourceConfig"
+    CLOUDWATCH_PUT_METRIC_DATA = "cloudwatch:PutMetricData"
+
+
+# Maximum concurrency per API, AIMD adapts between MIN_WORKERS_AWS and this value
+API_MAX_CONCURRENCY = {
+    ApiNames.LAMBDA_LIST_TAGS: int(os.environ.get("MAX_CONCURRENCY_LAMBDA", "64")),
+    ApiNames.CONFIG_RESOURCE_HISTORY: int(
+        os.environ.get("MAX_CONCURRENCY_CONFIG", "16")
+    ),
+    ApiNames.CLOUDWATCH_PUT_METRIC_DATA: int(
+        os.environ.get("MAX_CONCURRENCY_CLOUDWATCH", "16")
+    ),
+}
+
+
+class DiscoveryModes:
+    """How function tags are discovered"""
+
+    LAMBDA = "lambda"  # One lambda:ListTags call per function
+    TAGGING = "tagging"  # Bulk Resource Groups Tagging API GetResources pages
+
+
+class PipelineModes:
+    BATCH = "batch"
+    STREAMING = "streaming"
+
+
+class Phases:
+    """Phases of an inspection run timed by RunTelemetry"""
+
+    LIST_FUNCTIONS = "list_functions"
+    TAG_FETCH = "tag_fetch"
+    HISTORY_FETCH = "history_fetch"
+    METRIC_BUILD = "metric_build"
+    PUBLISH = "publish"
+
+
+class MetricSinks:
+    """Where published metrics are sent"""
+
+    CLOUDWATCH = "cloudwatch"  # PutMetricData
+    EMF = "emf"  # Embedded Metric Format lines on stdout
+    OPENMETRICS = "openmetrics"  # OpenMetrics text exposition file
+    REMOTE_WRITE = "remote-write"  # Prometheus remote-write endpoint
+    JSONL = "jsonl"  # Line-delimited JSON file
+
+
+class ExportFormats:
+    """File formats of the snapshot export"""
+
+    PARQUET = "parquet"
+    ARROW = "arrow"  # Arrow IPC stream
+
+
+class HistoryBackends:
+    """Where tag history comes from in history mode"""
+
+    CONFIG_HISTORY = "config-history"  # GetResourceConfigHistory per function
+    CONFIG_SELECT = "config-select"  # SelectResourceConfig advanced queries
+    SNAPSHOT_LOG = "snapshot-log"  # The inspector's own observation log, no AWS Config
+
+
+class StateNames:
+    """Names of the documents kept in the inspector state store"""
+
+    FUNCTION_SNAPSHOT = "function_snapshot.json"
+    HISTORY_WATERMARKS = "history_watermarks.json"
+    # The select backend only sees latest items, its observations are kept apart
+    SELECT_WATERMARKS = "select_watermarks.json"
+    PUBLISHED_SERIES = "published_series.json"
+    # History runs publish other series, their keepalive state is kept apart
+    HISTORY_PUBLISHED_SERIES = "history_published_series.json"
+    # One checkpoint per handler and run parameters
+    RUN_CHECKPOINT = "run_checkpoint-{handler}-{params}.json"
+    OBSERVATIONS = "observations.json"
+    OBSERVATION_SEGMENT = "observations/{day}.json"
+    SHARD_INPUT = "shard_input.json"
+    SHARD_RESULT = "shard_result.json"
+
+
+@dataclass(slots=True)
 class LambdaFunction:
     name: str
     arn: str
     tags: Dict[str, str]
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ServiceInfo:
     env: str
     service: str
     stack: str
     terraform_version: str
+    region: Optional[str] = None  # Only set when several regions are inspected
+    account_id: Optional[str] = None  # Only set when several accounts are inspected
 
 
-@dataclass
+@dataclass(frozen=True)
+class InspectionTarget:
+    """Account and region inspected by one LambdaInspector, None for the defaults."""
+
+    account_id: Optional[str] = None
+    region: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return "/".join(filter(None, (self.account_id, self.region))) or "default"
+
+
+@dataclass(slots=True)
 class MetricsData:
     metric_name: str
     dimensions: List[Dict[str, str]]
     value: float
     unit: str
+    timestamp: Optional[datetime] = None
+    # Datapoints collapsed into this entry, see collapse_metrics
+    values: Optional[List[float]] = None
+    counts: Optional[List[float]] = None
 
     def to_cloudwatch_format(self) -> Dict:
         """Convert to CloudWatch metric data format."""
-        return {
+        metric_data = {
             "MetricName": self.metric_name,
             "Dimensions": self.dimensions,
-            "Value": self.value,
-            "Unit": self.unit,
         }
+        if self.values is not None:
+            metric_data["Values"] = self.values
+            metric_data["Counts"] = self.counts
+        else:
+            metric_data["Value"] = self.value
+        metric_data["Unit"] = self.unit
+        if self.timestamp is not None:
+            metric_data["Timestamp"] = self.timestamp
+        return metric_data
 
 
-class LambdaInspector:
+def compact_tags(tags: Dict[str, str]) -> Dict[str, str]:
+    """Keep the inspected tags only, with interned values shared across functions."""
+    return {
+        key: sys.intern(value) for key, value in tags.items() if key in INSPECTED_TAGS
+    }
+
+
+def compact_function(function_info: Dict) -> Dict:
+    """Keep the list_functions fields the inspector reads, dropping environment, layers etc."""
+    return {
+        key: function_info[key]
+        for key in LISTED_FUNCTION_FIELDS
+        if key in function_info
+    }
+
+
+def collapse_metrics(metrics: List[MetricsData]) -> List[MetricsData]:
+    """Merge datapoints of the same series into entries with Values/Counts arrays.
+
+    Datapoints share a series when metric name, dimensions, unit and timestamp
+    are equal. Each entry holds at most Config.CW_MAX_VALUES_PER_METRIC
+    distinct values. Series with a single datapoint are returned unchanged.
+    """
+    series: Dict[Tuple, List[MetricsData]] = {}
+    for metric in metrics:
+        key = (
+            metric.metric_name,
+            tuple((d["Name"], d["Value"]) for d in metric.dimensions),
+            metric.unit,
+            metric.timestamp,
+        )
+        series.setdefault(key, []).append(metric)
+
+    collapsed = []
+    for datapoints in series.values():
+        if len(datapoints) == 1:
+            collapsed.append(datapoints[0])
+            continue
+        counts: Dict[float, float] = {}
+        for datapoint in datapoints:
+            for value, count in zip(
+                datapoint.values or [datapoint.value], datapoint.counts or [1]
+            ):
+                counts[value] = counts.get(value, 0) + count
+        values = list(counts)
+        first = datapoints[0]
+        for i in range(0, len(values), Config.CW_MAX_VALUES_PER_METRIC):
+            chunk = values[i : i + Config.CW_MAX_VALUES_PER_METRIC]
+            collapsed.append(
+                MetricsData(
+                    metric_name=first.metric_name,
+                    dimensions=first.dimensions,
+                    value=chunk[0],
+                    unit=first.unit,
+                    timestamp=first.timestamp,
+                    values=chunk,
+                    counts=[counts[value] for value in chunk],
+                )
+            )
+    return collapsed
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Check whether an AWS API error is a throttling error."""
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") in Config.THROTTLING_ERROR_CODES
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Check whether an AWS API error may succeed when retried unchanged."""
+    if is_throttling_error(error):
+        return True
+    if isinstance(error, (BotoConnectionError, HTTPClientError)):
+        return True
+    response = getattr(error, "response", None) or {}
+    if response.get("Error", {}).get("Code") in Config.TRANSIENT_ERROR_CODES:
+        return True
+    return response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+
+
+def is_auth_error(error: Exception) -> bool:
+    """Check whether an AWS API error is caused by the credentials or permissions."""
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") in Config.AUTH_ERROR_CODES
+
+
+def is_data_error(error: Exception) -> bool:
+    """Check whether an AWS API error is caused by the size or content of the request.
+
+    Errors without a response were raised client side, while validating or
+    serializing the request.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return True
+    if response.get("Error", {}).get("Code") in Config.DATA_ERROR_CODES:
+        return True
+    return response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 413
+
+
+def _jittered_backoff(attempt: int) -> None:
+    backoff = min(
+        Config.THROTTLE_BACKOFF_MAX_SECONDS,
+        Config.THROTTLE_BACKOFF_BASE_SECONDS * 2**attempt,
+    )
+    time.sleep(random.uniform(0, backoff))
+
+
+class AimdLimiter:
+    """Concurrency limit for a single AWS API, adapted with AIMD.
+
+    The limit grows by one slot for every window of successful calls and is
+    multiplied by AIMD_DECREASE_FACTOR when the API throttles. Only calls
+    started after the last decrease can decrease it again, so a burst of
+    throttles from the same window halves the limit once.
+    """
+
+    def __init__(self, api_name: str, initial: int, minimum: int, maximum: int):
+        self.api_name = api_name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.peak = self.concurrency
+        self.in_flight = 0
+        self.calls = 0
+        self.throttles = 0
+        self._epoch = 0
+        self._condition = threading.Condition()
+
+    @property
+    def concurrency(self) -> int:
+        return max(self.minimum, int(self.limit))
+
+    def acquire(self) -> int:
+        """Wait for a free slot. Returns the window the call started in."""
+        with self._condition:
+            while self.in_flight >= self.concurrency:
+                self._condition.wait()
+            self.in_flight += 1
+            return self._epoch
+
+    def release(self, epoch: int, throttled: bool = False) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            self.calls += 1
+            if throttled:
+                self.throttles += 1
+                if epoch == self._epoch:
+                    self._epoch += 1
+                    self.limit = max(
+                        self.minimum, self.limit * Config.AIMD_DECREASE_FACTOR
+                    )
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.concurrency)
+                self.peak = max(self.peak, self.concurrency)
+            self._condition.notify_all()
+
+    def call(self, fn: Callable, *args) -> Any:
+        """Run fn within the limit, retrying throttled calls with jittered backoff."""
+        for attempt in range(1, Config.THROTTLE_MAX_ATTEMPTS + 1):
+            epoch = self.acquire()
+            throttled = False
+            try:
+                return fn(*args)
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                if not throttled or attempt == Config.THROTTLE_MAX_ATTEMPTS:
+                    raise
+            finally:
+                self.release(epoch, throttled)
+            _jittered_backoff(attempt)
+
+    def report(self) -> Dict[str, int]:
+        return {
+            "concurrency": self.concurrency,
+            "peak": self.peak,
+            "calls": self.calls,
+            "throttles": self.throttles,
+        }
+
+
+class AdaptiveExecutor:
+    """Thread pool shared by all AWS API fan-outs of the inspector.
+
+    Every API gets its own AimdLimiter, so Lambda ListTags can run wide
+    while AWS Config backs off as soon as it starts throttling.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Dict[str, int] = None,
+        pool: ThreadPoolExecutor = None,
+    ):
+        self.max_concurrency = dict(max_concurrency or API_MAX_CONCURRENCY)
+        self.limiters: Dict[str, AimdLimiter] = {}
+        # A pool shared by several executors is not shut down by them
+        self._pool = pool
+        self._shared_pool = pool is not None
+        self._lock = threading.Lock()
+
+    def limiter(self, api_name: str) -> AimdLimiter:
+        with self._lock:
+            if api_name not in self.limiters:
+                self.limiters[api_name] = AimdLimiter(
+                    api_name,
+                    initial=Config.MAX_WORKERS_AWS,
+                    minimum=Config.MIN_WORKERS_AWS,
+                    maximum=self.max_concurrency.get(api_name, Config.MAX_WORKERS_AWS),
+                )
+            return self.limiters[api_name]
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                workers = max([Config.MAX_WORKERS_AWS, *self.max_concurrency.values()])
+                self._pool = ThreadPoolExecutor(max_workers=workers)
+            return self._pool
+
+    def submit_all(
+        self, api_name: str, fn: Callable, items: Iterable, *args
+    ) -> Dict[Future, Any]:
+        """Submit fn(item, *args) for every item. Returns dict of future -> item."""
+        limiter = self.limiter(api_name)
+        return {self.pool.submit(limiter.call, fn, item, *args): item for item in items}
+
+    def report(self) -> Dict[str, Dict[str, int]]:
+        """Concurrency each API settled on, with call and throttle counts."""
+        return {name: limiter.report() for name, limiter in self.limiters.items()}
+
+    def print_report(self, api_name: str) -> None:
+        stats = self.limiter(api_name).report()
+        print(
+            f"{api_name} settled at concurrency {stats['concurrency']} "
+            f"(peak {stats['peak']}, {stats['calls']} calls, "
+            f"{stats['throttles']} throttled)"
+        )
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None and not self._shared_pool:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class RunTelemetry:
+    """Time spent per run phase, and calls, latency, throttles and retries per AWS API.
+
+    Phase time is summed across threads, so in streaming mode, where phases
+    overlap, the phases add up to more than the run's wall time. API calls
+    are recorded by botocore event hooks on the clients passed to attach,
+    one call per operation with botocore's own retries counted separately.
+    """
+
     def __init__(self):
-        # Use session for connection pooling and reuse
-        self.session = boto3.Session()
-        self.lambda_client = self.session.client("lambda")
-        self.cloudwatch_client = self.session.client("cloudwatch")
-        self.config_client = self.session.client("config")
+        self._lock = threading.Lock()
+        self.reset()
 
-    def _fetch_function_tags(self, function_info: Dict) -> Tuple[LambdaFunction, bool]:
-        """Fetch tags for a single function. Returns (function, has_app_version)."""
+    def reset(self) -> None:
+        """Start a new run, warm invocations reuse the inspector and its telemetry."""
+        with self._lock:
+            self.started = time.time()
+            self.phases_ms: Dict[str, float] = {}
+            self.api_latencies_ms: Dict[str, List[float]] = {}
+            self.api_throttles: Dict[str, int] = {}
+            self.api_retries: Dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
         try:
-            tags = self.lambda_client.list_tags(
-                Resource=function_info["FunctionArn"]
-            ).get("Tags", {})
+            yield
+        finally:
+            self.add_phase(name, (time.perf_counter() - started) * 1000)
 
-            if TagNames.APP_VERSION in tags:
-                return (
-                    LambdaFunction(
-                        name=function_info["FunctionName"],
-                        arn=function_info["FunctionArn"],
-                        tags=tags,
-                    ),
-                    True,
+    def add_phase(self, name: str, elapsed_ms: float) -> None:
+        with self._lock:
+            self.phases_ms[name] = self.phases_ms.get(name, 0.0) + elapsed_ms
+
+    def record_call(
+        self, api: str, latency_ms: float, throttled: bool = False, retries: int = 0
+    ) -> None:
+        with self._lock:
+            self.api_latencies_ms.setdefault(api, []).append(latency_ms)
+            if throttled:
+                self.api_throttles[api] = self.api_throttles.get(api, 0) + 1
+            if retries:
+                self.api_retries[api] = self.api_retries.get(api, 0) + retries
+
+    def attach(self, client, service: str) -> None:
+        """Record every call of a botocore client as "<service>:<Operation>"."""
+        events = getattr(getattr(client, "meta", None), "events", None)
+        if events is None:
+            return
+
+        def before_call(model, context, **kwargs):
+            context["inspector_api"] = f"{service}:{model.name}"
+            context["inspector_started"] = time.perf_counter()
+
+        def after_call(parsed, context, **kwargs):
+            started = context.pop("inspector_started", None)
+            if started is None:
+                return
+            self.record_call(
+                context["inspector_api"],
+                (time.perf_counter() - started) * 1000,
+                throttled=parsed.get("Error", {}).get("Code")
+                in Config.THROTTLING_ERROR_CODES,
+                retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+            )
+
+        def after_call_error(context, **kwargs):
+            # Connection errors, raised before a response was parsed
+            started = context.pop("inspector_started", None)
+            if started is not None:
+                self.record_call(
+                    context["inspector_api"], (time.perf_counter() - started) * 1000
                 )
-            return None, False
+
+        # First, so handlers answering before-call themselves are timed too
+        events.register_first("before-call.*.*", before_call)
+        events.register("after-call.*.*", after_call)
+        events.register("after-call-error.*.*", after_call_error)
+
+    def merge(self, other: "RunTelemetry") -> None:
+        """Add the phases and API calls of another inspector, e.g. of one target."""
+        with other._lock:
+            phases = dict(other.phases_ms)
+            latencies = {
+                api: list(values) for api, values in other.api_latencies_ms.items()
+            }
+            throttles = dict(other.api_throttles)
+            retries = dict(other.api_retries)
+        with self._lock:
+            for name, elapsed_ms in phases.items():
+                self.phases_ms[name] = self.phases_ms.get(name, 0.0) + elapsed_ms
+            for api, values in latencies.items():
+                self.api_latencies_ms.setdefault(api, []).extend(values)
+            for api, count in throttles.items():
+                self.api_throttles[api] = self.api_throttles.get(api, 0) + count
+            for api, count in retries.items():
+                self.api_retries[api] = self.api_retries.get(api, 0) + count
+
+    def summary(self) -> Dict[str, Any]:
+        """Milliseconds per phase and call statistics per API of the current run."""
+        with self._lock:
+            apis = {}
+            for api, latencies in sorted(self.api_latencies_ms.items()):
+                values = sorted(latencies)
+                apis[api] = {
+                    "calls": len(values),
+                    "throttles": self.api_throttles.get(api, 0),
+                    "retries": self.api_retries.get(api, 0),
+                    "latency_ms": {
+                        name: round(_percentile(values, fraction), 1)
+                        for name, fraction in Config.LATENCY_PERCENTILES
+                    },
+                }
+            return {
+                "phases_ms": {
+                    name: round(elapsed_ms, 1)
+                    for name, elapsed_ms in self.phases_ms.items()
+                },
+                "apis": apis,
+            }
+
+
+@dataclass
+class PublishResult:
+    """Outcome of publishing metrics."""
+
+    published: List[MetricsData] = field(default_factory=list)
+    rejected: List[Tuple[MetricsData, str]] = field(default_factory=list)
+    calls: int = 0
+
+    def merge(self, other: "PublishResult") -> None:
+        self.published.extend(other.published)
+        self.rejected.extend(other.rejected)
+        self.calls += other.calls
+
+
+class LocalStateStore:
+    """Inspector state kept as JSON documents in a local directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def load(self, name: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
         except Exception as e:
-            print(
-                f"Error getting tags for function {function_info['FunctionName']}: {e}"
+            print(f"Error loading state {name}: {e}")
+            return None
+
+    def save(self, name: str, data: Dict) -> None:
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so a timeout never leaves half a document
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(f"{path}.tmp", path)
+
+    def delete(self, name: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+class S3StateStore:
+    """Inspector state kept as JSON objects in S3, shared by cold containers."""
+
+    def __init__(self, s3_client, bucket: str, prefix: str = ""):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def load(self, name: str) -> Optional[Dict]:
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}{name}"
             )
-            return None, False
+            return json.loads(response["Body"].read())
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if code not in ("NoSuchKey", "404"):
+                print(f"Error loading state {name} from s3://{self.bucket}: {e}")
+            return None
 
-    def get_all_functions(self) -> List[LambdaFunction]:
-        all_functions_count = 0
-        functions_with_app_version = 0
-        paginator = self.lambda_client.get_paginator("list_functions")
+    def save(self, name: str, data: Dict) -> None:
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{name}",
+            Body=json.dumps(data, separators=(",", ":")).encode(),
+        )
 
-        # First, collect all function information
-        all_functions = []
-        for page in paginator.paginate():
-            all_functions.extend(page["Functions"])
-            all_functions_count += len(page["Functions"])
-
-        print(f"Total functions found: {all_functions_count}")
-
-        # Fetch tags in parallel
-        functions = []
-        with ThreadPoolExecutor(max_workers=Config.MAX_WORKERS_AWS) as executor:
-            # Submit all tag fetching tasks
-            future_to_function = {
-                executor.submit(self._fetch_function_tags, func): func
-                for func in all_functions
+    def delete(self, name: str) -> None:
+        self.s3_client.delete_object(Bucket=self.bucket, Key=f"{self.prefix}{name}")
+
+
+class TieredStateStore:
+    """Reads the warm local copy first and falls back to the durable store."""
+
+    def __init__(self, cache: LocalStateStore, durable):
+        self.cache = cache
+        self.durable = durable
+
+    def load(self, name: str) -> Optional[Dict]:
+        data = self.cache.load(name)
+        if data is None:
+            data = self.durable.load(name)
+            if data is not None:
+                self.cache.save(name, data)
+        return data
+
+    def save(self, name: str, data: Dict) -> None:
+        self.cache.save(name, data)
+        try:
+            self.durable.save(name, data)
+        except Exception as e:
+            print(f"Error saving state {name} to durable store: {e}")
+
+    def delete(self, name: str) -> None:
+        self.cache.delete(name)
+        try:
+            self.durable.delete(name)
+        except Exception as e:
+            print(f"Error deleting state {name} from durable store: {e}")
+
+
+class ScopedStateStore:
+    """Prefixes document names, so several inspectors can share one store."""
+
+    def __init__(self, store, scope: str):
+        self.store = store
+        self.scope = scope
+
+    def load(self, name: str) -> Optional[Dict]:
+        return self.store.load(f"{self.scope}/{name}")
+
+    def save(self, name: str, data: Dict) -> None:
+        self.store.save(f"{self.scope}/{name}", data)
+
+    def delete(self, name: str) -> None:
+        self.store.delete(f"{self.scope}/{name}")
+
+
+class CancellableStateStore:
+    """Drops saves once its run is cancelled.
+
+    Targets skipped at the deadline keep running in their threads, possibly
+    into the next invocation of a warm container, and must not write state.
+    """
+
+    def __init__(self, store, cancelled: threading.Event):
+        self.store = store
+        self.cancelled = cancelled
+
+    def load(self, name: str) -> Optional[Dict]:
+        return self.store.load(name)
+
+    def save(self, name: str, data: Dict) -> None:
+        if self.cancelled.is_set():
+            print(f"Not saving {name}, its run was cancelled")
+            return
+        self.store.save(name, data)
+
+    def delete(self, name: str) -> None:
+        if self.cancelled.is_set():
+            print(f"Not deleting {name}, its run was cancelled")
+            return
+        self.store.delete(name)
+
+
+class MemoryStateStore:
+    """State documents kept in memory, e.g. the watermarks handed to a shard worker."""
+
+    def __init__(self, documents: Dict[str, Dict] = None):
+        self.documents = dict(documents or {})
+
+    def load(self, name: str) -> Optional[Dict]:
+        return self.documents.get(name)
+
+    def save(self, name: str, data: Dict) -> None:
+        self.documents[name] = data
+
+    def delete(self, name: str) -> None:
+        self.documents.pop(name, None)
+
+
+class AssumedRoleSessions:
+    """Sessions in other accounts through STS AssumeRole.
+
+    Credentials are cached per account until shortly before they expire, and
+    every region gets its own session built from them.
+    """
+
+    def __init__(self, sts_client, role_name: str, session_name="lambda-inspector"):
+        self.sts_client = sts_client
+        self.role_name = role_name
+        self.session_name = session_name
+        self._credentials: Dict[str, Dict] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def credentials(self, account_id: str) -> Dict:
+        with self._lock:
+            account_lock = self._locks.setdefault(account_id, threading.Lock())
+        # One AssumeRole per account, without serializing the other accounts
+        with account_lock:
+            credentials = self._credentials.get(account_id)
+            if (
+                credentials is None
+                or _to_epoch(credentials["Expiration"]) - time.time()
+                < Config.CREDENTIALS_REFRESH_MARGIN_SECONDS
+            ):
+                credentials = self.sts_client.assume_role(
+                    RoleArn=f"arn:aws:iam::{account_id}:role/{self.role_name}",
+                    RoleSessionName=self.session_name,
+                )["Credentials"]
+                self._credentials[account_id] = credentials
+            return credentials
+
+    def session(self, account_id: str, region_name: str = None) -> boto3.Session:
+        credentials = self.credentials(account_id)
+        return boto3.Session(
+            aws_access_key_id=credentials["AccessKeyId"],
+            aws_secret_access_key=credentials["SecretAccessKey"],
+            aws_session_token=credentials["SessionToken"],
+            region_name=region_name,
+        )
+
+
+def create_client(
+    session, service_name: str, max_pool_connections: int = None, **options
+):
+    """Create a client with the inspector's pool, timeout and retry settings.
+
+    The connection pool should match the concurrency the client is used
+    with, extra options (e.g. request compression) are passed to BotoConfig.
+    """
+    config = BotoConfig(
+        max_pool_connections=max_pool_connections
+        or Config.BOTO_DEFAULT_POOL_CONNECTIONS,
+        retries={
+            "mode": Config.BOTO_RETRY_MODE,
+            "max_attempts": Config.BOTO_MAX_ATTEMPTS,
+        },
+        connect_timeout=Config.BOTO_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=Config.BOTO_READ_TIMEOUT_SECONDS,
+        tcp_keepalive=Config.BOTO_TCP_KEEPALIVE,
+        **options,
+    )
+    return session.client(service_name, config=config)
+
+
+def build_state_store(session):
+    """Build the state store configured through the environment, if any."""
+    if Config.STATE_BUCKET:
+        return TieredStateStore(
+            LocalStateStore(Config.STATE_DIR or Config.DEFAULT_STATE_DIR),
+            S3StateStore(
+                create_client(session, "s3"), Config.STATE_BUCKET, Config.STATE_PREFIX
+            ),
+        )
+    if Config.STATE_DIR:
+        return LocalStateStore(Config.STATE_DIR)
+    return None
+
+
+class HistoryWatermarks:
+    """Per-function history watermarks and the versions seen so far.
+
+    For each function the store keeps the time up to which its history was
+    scanned and when each AppVersion/TerraformVersion was last seen. Later runs
+    only scan the window after the watermark and merge it into the stored
+    versions. Scans are capped at HISTORY_BACKFILL_CHUNK_DAYS, so the first
+    backfill of a long window is spread over several runs.
+    """
+
+    def __init__(self, store, name: str = StateNames.HISTORY_WATERMARKS):
+        self.store = store
+        self.name = name
+        self._lock = threading.Lock()
+        data = store.load(name) or {}
+        self.functions: Dict[str, Dict] = data.get("functions", {})
+
+    def scan_range(
+        self, function_name: str, window_start: float, window_end: float
+    ) -> Optional[Tuple[float, float]]:
+        """Range (epoch seconds) still to scan for a function, None when up to date."""
+        entry = self.functions.get(function_name)
+        start = max(window_start, entry["watermark"]) if entry else window_start
+        end = min(window_end, start + Config.HISTORY_BACKFILL_CHUNK_DAYS * 86400)
+        return (start, end) if start < end else None
+
+    def record(
+        self,
+        function_name: str,
+        scanned_until: float,
+        observations: Iterable[Tuple[Dict[str, str], float]],
+    ) -> None:
+        """Merge (tags, seen_at) observations and move the watermark forward."""
+        with self._lock:
+            entry = self.functions.setdefault(
+                function_name, {"watermark": 0, "app": {}, "tf": {}}
+            )
+            for tags, seen_at in observations:
+                for tag, key in (
+                    (TagNames.APP_VERSION, "app"),
+                    (TagNames.TERRAFORM_VERSION, "tf"),
+                ):
+                    if tag in tags:
+                        versions = entry[key]
+                        versions[tags[tag]] = max(versions.get(tags[tag], 0), seen_at)
+            entry["watermark"] = max(entry["watermark"], scanned_until)
+
+    def versions(
+        self, function_name: str, window_start: float
+    ) -> Tuple[Set[str], Set[str]]:
+        """Versions seen since window_start, older ones are pruned."""
+        with self._lock:
+            entry = self.functions.get(function_name)
+            if entry is None:
+                return set(), set()
+            for key in ("app", "tf"):
+                entry[key] = {
+                    version: seen_at
+                    for version, seen_at in entry[key].items()
+                    if seen_at >= window_start
+                }
+            return set(entry["app"]), set(entry["tf"])
+
+    def save(self) -> None:
+        """Persist the watermarks of all functions, chunks of a run add to them."""
+        with self._lock:
+            data = {"functions": dict(self.functions)}
+        try:
+            self.store.save(self.name, data)
+        except Exception as e:
+            print(f"Error saving history watermarks: {e}")
+
+    def merge(self, entries: Dict[str, Dict]) -> None:
+        """Take over the entries of functions scanned elsewhere, e.g. by a shard worker."""
+        with self._lock:
+            self.functions.update(entries)
+
+    def prune(self, function_names: Iterable[str]) -> None:
+        """Drop the watermarks of functions missing from the run's full function list."""
+        names = set(function_names)
+        with self._lock:
+            gone = [name for name in self.functions if name not in names]
+            for name in gone:
+                del self.functions[name]
+        if gone:
+            self.save()
+
+
+class PublishScheduler:
+    """Decides which metric series need a datapoint in this run.
+
+    Remembers when each series (metric name + dimensions) was last published
+    and with which value. A series is published when it is new or its value
+    changed, otherwise only when its keepalive deadline approaches.
+    Each handler keeps its own document, a run only drops series of its own.
+    """
+
+    def __init__(self, store, name: str = StateNames.PUBLISHED_SERIES):
+        self.store = store
+        self.name = name
+        data = store.load(name) or {}
+        # series key -> [last published epoch, last published value]
+        self.series: Dict[str, List[float]] = data.get("series", {})
+
+    @staticmethod
+    def series_key(metric: "MetricsData") -> str:
+        dimensions = ",".join(f"{d['Name']}={d['Value']}" for d in metric.dimensions)
+        return f"{metric.metric_name}|{dimensions}"
+
+    def due(
+        self, metrics: List["MetricsData"], now: float = None
+    ) -> List["MetricsData"]:
+        """Metrics whose series must be published in this run."""
+        now = time.time() if now is None else now
+        due = []
+        for metric in metrics:
+            last = self.series.get(self.series_key(metric))
+            if last is None or last[1] != metric.value:
+                due.append(metric)
+                continue
+            interval = (
+                Config.KEEPALIVE_INTERVAL_SECONDS
+                if metric.value == 0
+                else Config.ACTIVE_REFRESH_SECONDS
+            )
+            if now - last[0] >= interval:
+                due.append(metric)
+        return due
+
+    def mark_published(
+        self, metrics: Iterable["MetricsData"], now: float = None
+    ) -> None:
+        now = time.time() if now is None else now
+        for metric in metrics:
+            self.series[self.series_key(metric)] = [now, metric.value]
+
+    def save(self, current_metrics: Iterable["MetricsData"]) -> None:
+        """Persist the state of the series still emitted, dropping the others."""
+        self.save_series({self.series_key(metric) for metric in current_metrics})
+
+    def save_series(self, current: Set[str]) -> None:
+        """Persist the state of the given series keys, dropping the others."""
+        self.series = {key: last for key, last in self.series.items() if key in current}
+        try:
+            self.store.save(self.name, {"series": self.series})
+        except Exception as e:
+            print(f"Error saving published series: {e}")
+
+
+class RunCheckpoint:
+    """Progress of a run that stopped before its invocation deadline.
+
+    Holds the functions whose history was already fetched (the cursor)
+    with their version sets, and the metrics built but not published yet.
+    A run with the same parameters resumes from it, a stale checkpoint or
+    one of a run with other parameters is ignored. Each handler and set of
+    parameters has its own document, so a run completing never clears the
+    checkpoint of another run sharing the store.
+    """
+
+    def __init__(self, store, params: Dict[str, Any]):
+        self.store = store
+        self.params = params
+        self.name = StateNames.RUN_CHECKPOINT.format(
+            handler="history" if params.get("use_aws_config") else "current",
+            params=f"{zlib.crc32(json.dumps(params, sort_keys=True).encode()):08x}",
+        )
+        # function name -> (app_versions, terraform_versions)
+        self.history: Dict[str, Tuple[Set[str], Set[str]]] = {}
+        self.unpublished: List[MetricsData] = []
+        data = store.load(self.name) or {}
+        if (
+            data.get("params") == params
+            and time.time() - data.get("saved_at", 0)
+            <= Config.CHECKPOINT_MAX_AGE_SECONDS
+        ):
+            self.history = {
+                name: (set(app_versions), set(terraform_versions))
+                for name, (app_versions, terraform_versions) in data["history"].items()
             }
+            self.unpublished = [
+                MetricsData(
+                    metric_name=name,
+                    dimensions=dimensions,
+                    value=value,
+                    unit=unit,
+                )
+                for name, dimensions, value, unit in data["unpublished"]
+            ]
 
-            # Process completed tasks
-            for future in as_completed(future_to_function):
-                function, has_app_version = future.result()
-                if has_app_version:
-                    functions_with_app_version += 1
-                    functions.append(function)
+    def save(self) -> None:
+        try:
+            self.store.save(
+                self.name,
+                {
+                    "params": self.params,
+                    "saved_at": time.time(),
+                    "history": {
+                        name: [sorted(app_versions), sorted(terraform_versions)]
+                        for name, (
+                            app_versions,
+                            terraform_versions,
+                        ) in self.history.items()
+                    },
+                    "unpublished": [
+                        [
+                            metric.metric_name,
+                            metric.dimensions,
+                            metric.value,
+                            metric.unit,
+                        ]
+                        for metric in self.unpublished
+                    ],
+                },
+            )
+        except Exception as e:
+            print(f"Error saving run checkpoint: {e}")
 
-        print(f"Functions with AppVersion tag: {functions_with_app_version}")
+    def clear(self) -> None:
+        """Drop the checkpoint once the run completed."""
+        self.history = {}
+        self.unpublished = []
+        try:
+            self.store.delete(self.name)
+        except Exception as e:
+            print(f"Error clearing run checkpoint: {e}")
 
-        # Sort functions by environment, stack, and service
-        def sort_key(func: LambdaFunction) -> Tuple[str, str, str]:
+
+class ObservationLog:
+    """Versions each function ran as observed by the inspector's own runs.
+
+    Consecutive observations of the same AppVersion and TerraformVersion
+    are one interval [app_version, terraform_version, first_seen, last_seen].
+    Running intervals are kept in one document. Once a function runs another
+    version or is gone, its interval is appended to the daily segment of
+    that day, so segments only grow with deploys and a time range only
+    reads the segments that can overlap it.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        data = store.load(StateNames.OBSERVATIONS) or {}
+        self.running: Dict[str, List] = data.get("functions", {})
+        self.segments: List[str] = data.get("segments", [])
+
+    @staticmethod
+    def _day(timestamp: float) -> str:
+        return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+    def record(
+        self,
+        versions: Dict[str, Tuple[str, str]],
+        gone: Iterable[str] = (),
+        complete: bool = False,
+        now: float = None,
+    ) -> None:
+        """Record the (app_version, terraform_version) of functions seen at now.
+
+        Intervals of the gone function names are closed. complete means
+        versions holds every function, the intervals of all others are closed.
+        """
+        now = int(time.time() if now is None else now)
+        closed = []
+        for name, (app_version, terraform_version) in versions.items():
+            interval = self.running.get(name)
+            if interval is not None and interval[:2] == [
+                app_version,
+                terraform_version,
+            ]:
+                interval[3] = now
+                continue
+            if interval is not None:
+                closed.append([name, *interval])
+            self.running[name] = [app_version, terraform_version, now, now]
+        stale = set(self.running) - set(versions) if complete else set(gone)
+        for name in stale & set(self.running):
+            closed.append([name, *self.running.pop(name)])
+
+        if closed:
+            day = self._day(now)
+            name = StateNames.OBSERVATION_SEGMENT.format(day=day)
+            segment = self.store.load(name) or {}
+            segment.setdefault("intervals", []).extend(closed)
+            self.store.save(name, segment)
+            if day not in self.segments:
+                self.segments.append(day)
+        self._prune(now)
+        self.store.save(
+            StateNames.OBSERVATIONS,
+            {"functions": self.running, "segments": self.segments},
+        )
+
+    def _prune(self, now: float) -> None:
+        oldest = self._day(now - Config.OBSERVATION_LOG_RETENTION_DAYS * 86400)
+        for day in [day for day in self.segments if day < oldest]:
+            self.store.delete(StateNames.OBSERVATION_SEGMENT.format(day=day))
+            self.segments.remove(day)
+
+    def versions(
+        self,
+        names: Iterable[str],
+        earlier_days: float,
+        later_days: float = 0,
+        now: float = None,
+    ) -> Dict[str, Tuple[Set[str], Set[str]]]:
+        """Versions of the named functions seen between earlier_days and later_days ago.
+
+        names=None returns the versions of every function in the log.
+        """
+        now = time.time() if now is None else now
+        start = now - earlier_days * 86400
+        end = now - later_days * 86400
+        everything = names is None
+        results = {} if everything else {name: (set(), set()) for name in names}
+
+        def add(name, app_version, terraform_version, first_seen, last_seen):
+            if (
+                (everything or name in results)
+                and first_seen <= end
+                and last_seen >= start
+            ):
+                app_versions, terraform_versions = results.setdefault(
+                    name, (set(), set())
+                )
+                app_versions.add(app_version)
+                terraform_versions.add(terraform_version)
+
+        # An interval is appended on or after the day it was last seen
+        first_day = self._day(start)
+        for day in self.segments:
+            if day < first_day:
+                continue
+            segment = self.store.load(StateNames.OBSERVATION_SEGMENT.format(day=day))
+            for interval in (segment or {}).get("intervals", []):
+                add(*interval)
+        for name, interval in self.running.items():
+            add(name, *interval)
+        return results
+
+
+class VersionIndex:
+    """SQLite inventory of the versions each function ran, updated on every run.
+
+    One row per function, AppVersion and TerraformVersion, with when the
+    inspector first and last saw it and whether it is the function's current
+    deployment. Runs upsert the rows they see instead of rebuilding the
+    index, and the indexes below answer version lookups, drift reports and
+    last-seen questions without scanning metric series.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS versions (
+            account_id TEXT NOT NULL,
+            region TEXT NOT NULL,
+            function TEXT NOT NULL,
+            app_version TEXT NOT NULL,
+            terraform_version TEXT NOT NULL,
+            env TEXT NOT NULL,
+            stack TEXT NOT NULL,
+            service TEXT NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            current INTEGER NOT NULL,
+            PRIMARY KEY (account_id, region, function, app_version, terraform_version)
+        );
+        CREATE INDEX IF NOT EXISTS versions_by_app_version
+            ON versions (app_version, env);
+        CREATE INDEX IF NOT EXISTS versions_by_service
+            ON versions (env, stack, service);
+        CREATE INDEX IF NOT EXISTS versions_by_function
+            ON versions (function, last_seen);
+    """
+    COLUMNS = (
+        "function",
+        "env",
+        "stack",
+        "service",
+        "app_version",
+        "terraform_version",
+        "region",
+        "account_id",
+        "first_seen",
+        "last_seen",
+        "current",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self) -> "sqlite3.Connection":
+        if self._connection is None:
+            import sqlite3
+
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Inspectors of several targets write to the same file from their threads
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            self._connection.row_factory = sqlite3.Row
+            self._connection.executescript(self.SCHEMA)
+        return self._connection
+
+    def update(
+        self,
+        inspector: "LambdaInspector",
+        functions: Iterable[LambdaFunction],
+        gone: Iterable[str] = (),
+        complete: bool = False,
+        now: float = None,
+    ) -> None:
+        """Record the current version of functions seen by an inspector.
+
+        Older rows of these functions and the rows of the gone function
+        names stop being current. complete means functions are all functions
+        of the inspector's account and region, so rows of every function
+        missing from it stop being current too.
+        """
+        now = time.time() if now is None else now
+        scope = (inspector.account_id or "", inspector.region_name or "")
+        rows = []
+        for function in functions:
+            service_info = inspector.extract_service_info(function)
+            rows.append(
+                (
+                    *scope,
+                    function.name,
+                    function.tags[TagNames.APP_VERSION],
+                    service_info.terraform_version,
+                    service_info.env,
+                    service_info.stack,
+                    service_info.service,
+                    now,
+                    now,
+                )
+            )
+        names = [row[2] for row in rows] + list(gone)
+        with self._lock, self.connection as connection:
+            connection.executemany(
+                """
+                INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT (account_id, region, function, app_version, terraform_version)
+                DO UPDATE SET env = excluded.env, stack = excluded.stack,
+                    service = excluded.service, last_seen = excluded.last_seen,
+                    current = 1
+                """,
+                rows,
+            )
+            if complete:
+                connection.execute(
+                    "UPDATE versions SET current = 0 WHERE current = 1 "
+                    "AND account_id = ? AND region = ? AND last_seen < ?",
+                    (*scope, now),
+                )
+            else:
+                connection.executemany(
+                    "UPDATE versions SET current = 0 WHERE current = 1 "
+                    "AND account_id = ? AND region = ? AND function = ? AND last_seen < ?",
+                    [(*scope, name, now) for name in names],
+                )
+
+    def _query(self, sql: str, parameters: Tuple = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+    def running(
+        self, app_version: str, env: str = None, current: bool = True
+    ) -> List[Dict[str, Any]]:
+        """Functions running app_version, or that ever ran it with current False."""
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM versions WHERE app_version = ?"
+        parameters = [app_version]
+        if env is not None:
+            sql += " AND env = ?"
+            parameters.append(env)
+        if current:
+            sql += " AND current = 1"
+        return self._query(
+            sql + " ORDER BY env, stack, service, function", tuple(parameters)
+        )
+
+    def last_seen(
+        self, function: str = None, app_version: str = None
+    ) -> List[Dict[str, Any]]:
+        """When each version of a function, or each function of a version, was last seen."""
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM versions"
+        conditions, parameters = [], []
+        if function is not None:
+            conditions.append("function = ?")
+            parameters.append(function)
+        if app_version is not None:
+            conditions.append("app_version = ?")
+            parameters.append(app_version)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return self._query(sql + " ORDER BY last_seen DESC", tuple(parameters))
+
+    def drift(self, envs: List[str] = None) -> List[Dict[str, Any]]:
+        """Services whose current AppVersions or TerraformVersions differ between environments.
+
+        Compares the given environments, all of them by default. Returns one
+        entry per drifting stack and service with its versions per environment.
+        """
+        sql = (
+            "SELECT stack, service, env, "
+            "group_concat(DISTINCT app_version) AS app_versions, "
+            "group_concat(DISTINCT terraform_version) AS terraform_versions "
+            "FROM versions WHERE current = 1"
+        )
+        parameters: Tuple = ()
+        if envs:
+            sql += f" AND env IN ({', '.join('?' * len(envs))})"
+            parameters = tuple(envs)
+        rows = self._query(sql + " GROUP BY stack, service, env", parameters)
+
+        services: Dict[Tuple[str, str], Dict[str, Dict[str, List[str]]]] = {}
+        for row in rows:
+            services.setdefault((row["stack"], row["service"]), {})[row["env"]] = {
+                "app_versions": sorted(row["app_versions"].split(",")),
+                "terraform_versions": sorted(row["terraform_versions"].split(",")),
+            }
+        drift = []
+        for (stack, service), by_env in sorted(services.items()):
+            if len(by_env) < 2:
+                continue
+            distinct = {
+                (tuple(versions["app_versions"]), tuple(versions["terraform_versions"]))
+                for versions in by_env.values()
+            }
+            if len(distinct) > 1:
+                drift.append({"stack": stack, "service": service, "envs": by_env})
+        return drift
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def invocation_deadline(context) -> Optional[float]:
+    """Epoch seconds by which a handler must checkpoint, None outside Lambda.
+
+    Keeps CHECKPOINT_RESERVE_SECONDS of the remaining time for building,
+    publishing and saving the checkpoint.
+    """
+    remaining_ms = getattr(context, "get_remaining_time_in_millis", None)
+    if remaining_ms is None:
+        return None
+    return time.time() + remaining_ms() / 1000 - Config.CHECKPOINT_RESERVE_SECONDS
+
+
+def _to_epoch(value) -> float:
+    """Convert a boto3 timestamp (datetime or ISO string) to epoch seconds."""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.fromisoformat(str(value)).timestamp()
+
+
+class LambdaInspector:
+    def __init__(
+        self,
+        state_store=None,
+        region_name: str = None,
+        session: boto3.Session = None,
+        account_id: str = None,
+        executor: AdaptiveExecutor = None,
+    ):
+        # Use session for connection pooling and reuse
+        self.session = session or boto3.Session(region_name=region_name)
+        # Set when inspecting several regions or accounts, adds a
+        # Region/AccountId dimension
+        self.region_name = region_name
+        self.account_id = account_id
+        # Phase timings and API call statistics of the current run
+        self.telemetry = RunTelemetry()
+        self.lambda_client = create_client(
+            self.session, "lambda", API_MAX_CONCURRENCY[ApiNames.LAMBDA_LIST_TAGS]
+        )
+        self.cloudwatch_client = create_client(
+            self.session,
+            "cloudwatch",
+            API_MAX_CONCURRENCY[ApiNames.CLOUDWATCH_PUT_METRIC_DATA],
+            request_min_compression_size_bytes=Config.CW_COMPRESSION_MIN_BYTES,
+            disable_request_compression=False,
+        )
+        self.telemetry.attach(self.lambda_client, "lambda")
+        self.telemetry.attach(self.cloudwatch_client, "cloudwatch")
+        # Only history runs need AWS Config, its service model is loaded on first use
+        self._config_client = None
+        self._tagging_client = None
+        self.executor = executor or AdaptiveExecutor()
+        # State persisted between runs, None disables snapshots
+        self.state_store = (
+            state_store if state_store is not None else build_state_store(self.session)
+        )
+        self._snapshot = None
+        self._function_records: Dict[str, LambdaFunction] = {}
+        self._history_watermarks = None
+        self._select_watermarks = None
+        self._publish_scheduler = None
+        self._history_publish_scheduler = None
+        # When each function was last re-read after a change event
+        self._refreshed_at: Dict[str, float] = {}
+        self._version_index = None
+        self._observation_log = None
+        self._metric_sink = None
+        self._assumed_role_sessions = None
+        self._target_inspectors = None
+        self._targets = None
+        self._targets_resolved_at = 0.0
+
+    @property
+    def metric_sink(self) -> "MetricSink":
+        """Destination of published metrics, selected by Config.METRIC_SINK."""
+        if self._metric_sink is None:
+            self._metric_sink = build_metric_sink(self)
+        return self._metric_sink
+
+    @property
+    def assumed_role_sessions(self) -> AssumedRoleSessions:
+        """Sessions in other accounts, credentials are kept while the container is warm."""
+        if self._assumed_role_sessions is None:
+            self._assumed_role_sessions = AssumedRoleSessions(
+                create_client(self.session, "sts", Config.MAX_PARALLEL_ACCOUNTS),
+                Config.INSPECTOR_ROLE_NAME,
+            )
+        return self._assumed_role_sessions
+
+    @property
+    def target_inspectors(self) -> "TargetInspectors":
+        """Inspectors of other accounts and regions, sharing this inspector's thread pool."""
+        if self._target_inspectors is None:
+            self._target_inspectors = TargetInspectors(self.executor.pool)
+        return self._target_inspectors
+
+    @property
+    def targets(self) -> List["InspectionTarget"]:
+        """Account/region pairs to inspect, re-resolved every Config.TARGETS_REFRESH_SECONDS."""
+        if (
+            self._targets is None
+            or time.monotonic() - self._targets_resolved_at
+            > Config.TARGETS_REFRESH_SECONDS
+        ):
+            self._targets = resolve_targets(self.session)
+            self._targets_resolved_at = time.monotonic()
+        return self._targets
+
+    @property
+    def version_index(self) -> Optional[VersionIndex]:
+        """Version inventory, only available when Config.VERSION_INDEX_PATH is set."""
+        if not Config.VERSION_INDEX_PATH:
+            return None
+        if self._version_index is None:
+            self._version_index = VersionIndex(Config.VERSION_INDEX_PATH)
+        return self._version_index
+
+    @property
+    def observation_log(self) -> Optional[ObservationLog]:
+        """Observation log, kept with a state store when enabled or read by the history backend."""
+        enabled = (
+            Config.OBSERVATION_LOG
+            or Config.HISTORY_BACKEND == HistoryBackends.SNAPSHOT_LOG
+        )
+        if self.state_store is None or not enabled:
+            return None
+        if self._observation_log is None:
+            self._observation_log = ObservationLog(self.state_store)
+        return self._observation_log
+
+    def _record_observations(
+        self,
+        functions: Iterable[LambdaFunction],
+        gone: Iterable[str] = (),
+        complete: bool = False,
+    ) -> None:
+        if self.observation_log is None:
+            return
+        versions = {
+            function.name: (
+                function.tags[TagNames.APP_VERSION],
+                self.extract_service_info(function).terraform_version,
+            )
+            for function in functions
+        }
+        try:
+            self.observation_log.record(versions, gone, complete)
+        except Exception as e:
+            print(f"Error recording observations: {e}")
+
+    def _update_version_index(
+        self,
+        functions: Iterable[LambdaFunction],
+        gone: Iterable[str] = (),
+        complete: bool = False,
+    ) -> None:
+        if self.version_index is None:
+            return
+        try:
+            self.version_index.update(self, functions, gone, complete)
+        except Exception as e:
+            print(f"Error updating version index: {e}")
+
+    @property
+    def publish_scheduler(self) -> Optional[PublishScheduler]:
+        """Keepalive scheduler, only available when a state store is configured
+        and the metric sink does not need every series on every run."""
+        if self.state_store is None or self.metric_sink.full_series:
+            return None
+        if self._publish_scheduler is None:
+            self._publish_scheduler = PublishScheduler(self.state_store)
+        return self._publish_scheduler
+
+    @property
+    def history_publish_scheduler(self) -> Optional[PublishScheduler]:
+        """Keepalive scheduler of history runs, apart from the current-metrics one."""
+        if self.state_store is None or self.metric_sink.full_series:
+            return None
+        if self._history_publish_scheduler is None:
+            self._history_publish_scheduler = PublishScheduler(
+                self.state_store, StateNames.HISTORY_PUBLISHED_SERIES
+            )
+        return self._history_publish_scheduler
+
+    @property
+    def history_watermarks(self) -> Optional[HistoryWatermarks]:
+        """History watermarks, only available when a state store is configured."""
+        if self.state_store is None:
+            return None
+        if self._history_watermarks is None:
+            self._history_watermarks = HistoryWatermarks(self.state_store)
+        return self._history_watermarks
+
+    @property
+    def select_watermarks(self) -> Optional[HistoryWatermarks]:
+        """Versions accumulated by the config-select backend, apart from the history watermarks."""
+        if self.state_store is None:
+            return None
+        if self._select_watermarks is None:
+            self._select_watermarks = HistoryWatermarks(
+                self.state_store, StateNames.SELECT_WATERMARKS
+            )
+        return self._select_watermarks
+
+    def backend_watermarks(self, backend: str = None) -> Optional[HistoryWatermarks]:
+        """Watermarks kept by a history backend, None for backends without any."""
+        backend = backend or Config.HISTORY_BACKEND
+        if backend == HistoryBackends.CONFIG_HISTORY:
+            return self.history_watermarks
+        if backend == HistoryBackends.CONFIG_SELECT:
+            return self.select_watermarks
+        return None
+
+    @property
+    def config_client(self):
+        """AWS Config client, only created when history is fetched."""
+        if self._config_client is None:
+            self._config_client = create_client(
+                self.session,
+                "config",
+                API_MAX_CONCURRENCY[ApiNames.CONFIG_RESOURCE_HISTORY],
+            )
+            self.telemetry.attach(self._config_client, "config")
+        return self._config_client
+
+    @property
+    def tagging_client(self):
+        """Resource Groups Tagging API client, only created when bulk discovery is used."""
+        if self._tagging_client is None:
+            # GetResources pages are read one after the other
+            self._tagging_client = create_client(
+                self.session, "resourcegroupstaggingapi"
+            )
+            self.telemetry.attach(self._tagging_client, "tagging")
+        return self._tagging_client
+
+    def _fetch_function_tags(self, function_info: Dict) -> Tuple[LambdaFunction, bool]:
+        """Fetch tags for a single function. Returns (function, has_app_version).
+
+        Errors are raised so callers can tell failed lookups from untagged functions.
+        """
+        tags = compact_tags(
+            self.lambda_client.list_tags(Resource=function_info["FunctionArn"]).get(
+                "Tags", {}
+            )
+        )
+
+        if TagNames.APP_VERSION in tags:
+            return (
+                LambdaFunction(
+                    name=function_info["FunctionName"],
+                    arn=function_info["FunctionArn"],
+                    tags=tags,
+                ),
+                True,
+            )
+        return None, False
+
+    def _fetch_tags_per_function(
+        self, all_functions: List[Dict]
+    ) -> Dict[str, Optional[LambdaFunction]]:
+        """Fetch tags with one ListTags call per function, in parallel.
+
+        Returns dict of function_arn -> function, None for functions without
+        AppVersion tag. Functions whose lookup failed are left out.
+        """
+        functions = {}
+        # Submit all tag fetching tasks
+        future_to_function = self.executor.submit_all(
+            ApiNames.LAMBDA_LIST_TAGS, self._fetch_function_tags, all_functions
+        )
+
+        # Process completed tasks
+        for future in as_completed(future_to_function):
+            try:
+                function, has_app_version = future.result()
+            except Exception as e:
+                func = future_to_function[future]
+                print(f"Error getting tags for function {func['FunctionName']}: {e}")
+                continue
+            functions[future_to_function[future]["FunctionArn"]] = (
+                function if has_app_version else None
+            )
+
+        self.executor.print_report(ApiNames.LAMBDA_LIST_TAGS)
+        return functions
+
+    def get_tagged_function_tags(self) -> Dict[str, Dict[str, str]]:
+        """Get tags of all functions carrying an AppVersion tag in bulk.
+
+        Uses Resource Groups Tagging API GetResources pages instead of one
+        ListTags call per function. Returns dict of function_arn -> tags.
+        """
+        paginator = self.tagging_client.get_paginator("get_resources")
+        tags_by_arn = {}
+        for page in paginator.paginate(
+            ResourceTypeFilters=[Config.TAGGING_RESOURCE_TYPE],
+            TagFilters=[{"Key": TagNames.APP_VERSION}],
+            ResourcesPerPage=Config.TAGGING_PAGE_SIZE,
+        ):
+            for resource in page.get("ResourceTagMappingList", []):
+                tags_by_arn[resource["ResourceARN"]] = {
+                    tag["Key"]: tag["Value"] for tag in resource.get("Tags", [])
+                }
+        return tags_by_arn
+
+    @staticmethod
+    def _bulk_threshold(function_count: int) -> int:
+        """Functions to look up from which GetResources pages beat ListTags calls.
+
+        GetResources pages through every tagged function of the account, so
+        the lookups must at least outnumber its pages.
+        """
+        return max(
+            Config.TAG_BULK_MIN_FUNCTIONS,
+            math.ceil(function_count / Config.TAGGING_PAGE_SIZE),
+        )
+
+    def _fetch_tags_bulk(
+        self, all_functions: List[Dict]
+    ) -> Dict[str, Optional[LambdaFunction]]:
+        """Merge the function list with tags discovered in bulk.
+
+        Returns dict of function_arn -> function, None for functions without
+        AppVersion tag.
+        """
+        tags_by_arn = self.get_tagged_function_tags()
+        functions = {}
+        for func in all_functions:
+            tags = tags_by_arn.get(func["FunctionArn"])
+            if tags:
+                tags = compact_tags(tags)
+            functions[func["FunctionArn"]] = (
+                LambdaFunction(
+                    name=func["FunctionName"], arn=func["FunctionArn"], tags=tags
+                )
+                if tags and TagNames.APP_VERSION in tags
+                else None
+            )
+        return functions
+
+    @staticmethod
+    def _fingerprint(function_info: Dict) -> str:
+        """Fingerprint of a function configuration, changes on every update."""
+        return f"{function_info.get('LastModified')}|{function_info.get('RevisionId')}"
+
+    def _load_snapshot(self) -> Dict[str, List]:
+        """Load the previous run's snapshot. Returns dict of arn -> [fingerprint, tags]."""
+        if self.state_store is None:
+            return {}
+        if self._snapshot is None:
+            self._snapshot = self.state_store.load(StateNames.FUNCTION_SNAPSHOT) or {}
+        refreshed_at = self._snapshot.get("refreshed_at", 0)
+        if time.time() - refreshed_at > Config.SNAPSHOT_MAX_AGE_SECONDS:
+            return {}
+        return self._snapshot.get("functions", {})
+
+    def _save_snapshot(self, entries: Dict[str, List], full_refresh: bool) -> None:
+        if self.state_store is None:
+            return
+        refreshed_at = (
+            time.time() if full_refresh else self._snapshot.get("refreshed_at", 0)
+        )
+        self._snapshot = {"refreshed_at": refreshed_at, "functions": entries}
+        try:
+            self.state_store.save(StateNames.FUNCTION_SNAPSHOT, self._snapshot)
+        except Exception as e:
+            print(f"Error saving function snapshot: {e}")
+
+    def list_function_pages(self) -> Iterator[List[Dict]]:
+        """Yield the functions of each list_functions page as it arrives."""
+        paginator = self.lambda_client.get_paginator("list_functions")
+        pages = iter(paginator.paginate())
+        while True:
+            # Only the page requests are timed, not the consumers of each page
+            with self.telemetry.phase(Phases.LIST_FUNCTIONS):
+                page = next(pages, None)
+                if page is None:
+                    return
+                functions = [compact_function(func) for func in page["Functions"]]
+            yield functions
+
+    def resolve_functions(
+        self,
+        functions: List[Dict],
+        snapshot: Dict[str, List],
+        entries: Dict[str, List],
+        records: Dict[str, LambdaFunction],
+        bulk: bool = True,
+    ) -> Tuple[List[LambdaFunction], int]:
+        """Resolve the tags of listed functions, reusing the snapshot where possible.
+
+        Fills the snapshot entries and records of the resolved functions, and
+        returns the functions with an AppVersion tag and the number of tag
+        lookups made.
+        """
+        with self.telemetry.phase(Phases.TAG_FETCH):
+            return self._resolve_functions(functions, snapshot, entries, records, bulk)
+
+    def _resolve_functions(
+        self,
+        functions: List[Dict],
+        snapshot: Dict[str, List],
+        entries: Dict[str, List],
+        records: Dict[str, LambdaFunction],
+        bulk: bool,
+    ) -> Tuple[List[LambdaFunction], int]:
+        # Only fetch tags of functions that are new or changed since the snapshot
+        to_fetch = [
+            func
+            for func in functions
+            if snapshot.get(func["FunctionArn"], [None])[0] != self._fingerprint(func)
+        ]
+        to_fetch_arns = {func["FunctionArn"] for func in to_fetch}
+
+        fetched = None
+        if not to_fetch:
+            fetched = {}
+        elif (
+            bulk
+            and Config.TAG_DISCOVERY_MODE == DiscoveryModes.TAGGING
+            and len(to_fetch) >= self._bulk_threshold(len(functions))
+        ):
+            try:
+                fetched = self._fetch_tags_bulk(to_fetch)
+            except Exception as e:
+                print(f"Error discovering tags in bulk, falling back to ListTags: {e}")
+
+        if fetched is None:
+            fetched = self._fetch_tags_per_function(to_fetch)
+
+        resolved = []
+        for func in functions:
+            arn = func["FunctionArn"]
+            if arn in fetched:
+                function = fetched[arn]
+            elif arn not in to_fetch_arns:
+                # Unchanged, reuse the record of the previous run
+                tags = snapshot[arn][1]
+                function = self._function_records.get(arn) if tags else None
+                if tags and (function is None or function.tags != tags):
+                    function = LambdaFunction(
+                        name=func["FunctionName"], arn=arn, tags=tags
+                    )
+            else:
+                # Lookup failed, retry on the next run
+                continue
+            entries[arn] = [
+                self._fingerprint(func),
+                function.tags if function else None,
+            ]
+            if function:
+                records[arn] = function
+                resolved.append(function)
+        return resolved, len(to_fetch)
+
+    def commit_functions(
+        self,
+        snapshot: Dict[str, List],
+        entries: Dict[str, List],
+        records: Dict[str, LambdaFunction],
+        total: int,
+        fetched: int,
+    ) -> None:
+        """Keep the resolved functions for the next run once all pages are resolved."""
+        self._function_records = records
+        self._save_snapshot(entries, full_refresh=not snapshot)
+        self._update_version_index(records.values(), complete=True)
+        self._record_observations(records.values(), complete=True)
+        if self.state_store is not None:
+            print(
+                f"Tags fetched for {fetched} functions, "
+                f"{total - fetched} reused from snapshot"
+            )
+        print(f"Functions with AppVersion tag: {len(records)}")
+
+    def get_all_functions(self) -> List[LambdaFunction]:
+        # First, collect all function information
+        all_functions = []
+        for page in self.list_function_pages():
+            all_functions.extend(page)
+
+        print(f"Total functions found: {len(all_functions)}")
+
+        snapshot = self._load_snapshot()
+        entries = {}
+        records = {}
+        functions, fetched = self.resolve_functions(
+            all_functions, snapshot, entries, records
+        )
+        self.commit_functions(snapshot, entries, records, len(all_functions), fetched)
+
+        # Sort functions by environment, stack, and service
+        def sort_key(func: LambdaFunction) -> Tuple[str, str, str]:
             service_info = self.extract_service_info(func)
             return (service_info.env, service_info.stack, service_info.service)
 
-        functions.sort(key=sort_key)
-        return functions
+        functions.sort(key=sort_key)
+        return functions
+
+    def terraform_versions_in_use(self) -> Set[Tuple[ServiceInfo, str]]:
+        """(service, TerraformVersion) pairs of all functions known to this inspector.
+
+        Known functions are those of the snapshot, with the records of this
+        container taking precedence.
+        """
+        tags_by_arn = {
+            arn: entry[1]
+            for arn, entry in ((self._snapshot or {}).get("functions") or {}).items()
+            if entry[1]
+        }
+        tags_by_arn.update(
+            (arn, function.tags) for arn, function in self._function_records.items()
+        )
+        in_use = set()
+        for arn, tags in tags_by_arn.items():
+            if TagNames.APP_VERSION not in tags:
+                continue
+            service_info = self.extract_service_info(
+                LambdaFunction(name=arn.split(":")[-1], arn=arn, tags=tags)
+            )
+            in_use.add((service_info, service_info.terraform_version))
+        return in_use
+
+    def _get_function(self, arn: str) -> Optional[Dict]:
+        """GetFunction of one function, None when it no longer exists."""
+        try:
+            return self.lambda_client.get_function(FunctionName=arn)
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if code == "ResourceNotFoundException":
+                return None
+            raise
+
+    def refresh_functions(
+        self, arns: List[str]
+    ) -> List[Tuple[Optional[LambdaFunction], Optional[LambdaFunction]]]:
+        """Re-read changed functions with GetFunction and update their snapshot entries.
+
+        Returns (previous, current) records per function whose lookup
+        succeeded, None where the function was unknown, is deleted or has no
+        AppVersion tag. The previous record comes from this container or the
+        snapshot, even an expired one.
+        """
+        self._load_snapshot()
+        entries = (self._snapshot or {}).setdefault("functions", {})
+        future_to_arn = self.executor.submit_all(
+            ApiNames.LAMBDA_GET_FUNCTION, self._get_function, arns
+        )
+        changes = []
+        for future in as_completed(future_to_arn):
+            arn = future_to_arn[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"Error getting function {arn}: {e}")
+                continue
+            previous = self._function_records.get(arn)
+            if previous is None and entries.get(arn, [None, None])[1]:
+                previous = LambdaFunction(
+                    name=arn.split(":")[6], arn=arn, tags=entries[arn][1]
+                )
+            current = None
+            if response is None:
+                entries.pop(arn, None)
+            else:
+                function_info = compact_function(response["Configuration"])
+                tags = compact_tags(response.get("Tags", {}))
+                if TagNames.APP_VERSION in tags:
+                    current = LambdaFunction(
+                        name=function_info["FunctionName"], arn=arn, tags=tags
+                    )
+                entries[arn] = [
+                    self._fingerprint(function_info),
+                    tags if current else None,
+                ]
+            if current is not None:
+                self._function_records[arn] = current
+            else:
+                self._function_records.pop(arn, None)
+            changes.append((previous, current))
+        self._save_snapshot(entries, full_refresh=False)
+        changed = [current for _, current in changes if current is not None]
+        gone = [
+            previous.name
+            for previous, current in changes
+            if previous is not None and current is None
+        ]
+        self._update_version_index(changed, gone)
+        self._record_observations(changed, gone)
+        return changes
+
+    def extract_service_info(self, function: LambdaFunction) -> ServiceInfo:
+        tags = function.tags
+        stack = tags.get(TagNames.STACK, Config.UNKNOWN_VALUE)
+        service = tags.get(TagNames.SERVICE, stack)
+        env = tags.get(TagNames.ENVIRONMENT, Config.UNKNOWN_VALUE)
+        terraform = tags.get(TagNames.TERRAFORM_VERSION, Config.UNKNOWN_VALUE)
+
+        return ServiceInfo(
+            env=env,
+            service=service,
+            stack=stack,
+            terraform_version=terraform,
+            region=self.region_name,
+            account_id=self.account_id,
+        )
+
+    def _get_resource_history_items(
+        self,
+        resource_id: str,
+        resource_type: str,
+        earlier_time: datetime,
+        later_time: datetime,
+    ) -> List[Tuple[Dict[str, str], float]]:
+        """Get the tagged configuration items of a resource between two times.
+
+        Returns (tags, capture_time) pairs, capture_time in epoch seconds.
+        """
+        paginator = self.config_client.get_paginator("get_resource_config_history")
+        history_items = []
+        for page in paginator.paginate(
+            resourceType=resource_type,
+            resourceId=resource_id,
+            # Convert to UTC and format as required by AWS Config
+            earlierTime=earlier_time.astimezone().isoformat(),
+            laterTime=later_time.astimezone().isoformat(),
+            limit=Config.CONFIG_HISTORY_LIMIT,
+        ):
+            configuration_items = page.get("configurationItems", [])
+            for item in configuration_items:
+                if item.get("tags") and item["tags"] != {}:
+                    capture_time = item.get("configurationItemCaptureTime")
+                    history_items.append(
+                        (
+                            item["tags"],
+                            (
+                                _to_epoch(capture_time)
+                                if capture_time
+                                else later_time.timestamp()
+                            ),
+                        )
+                    )
+        return history_items
+
+    def get_resource_history_tags(
+        self,
+        resource_id: str,
+        resource_type: str,
+        earlier_days: float,
+        later_days: float,
+    ) -> List[Dict]:
+        """Get the configuration history for a specific resource from AWS Config."""
+        try:
+            earlier_days_ago = datetime.now() - timedelta(days=earlier_days)
+            later_days_ago = datetime.now() - timedelta(days=later_days)
+            return [
+                tags
+                for tags, _ in self._get_resource_history_items(
+                    resource_id, resource_type, earlier_days_ago, later_days_ago
+                )
+            ]
+        except Exception as e:
+            if is_throttling_error(e):
+                raise
+            print(f"Error getting resource history for {resource_id}: {e}")
+            return []
+
+    def _get_single_function_history(
+        self, function: LambdaFunction, earlier_days: float, later_days: float
+    ) -> Tuple[str, Set[str], Set[str]]:
+        """Get history for a single function. Returns (function_name, app_versions, terraform_versions)."""
+        if self.history_watermarks is not None:
+            return self._get_single_function_history_incremental(
+                function, earlier_days, later_days
+            )
+
+        app_versions = set()
+        terraform_versions = set()
+        history_tags = self.get_resource_history_tags(
+            function.name,
+            Config.AWS_LAMBDA_FUNCTION_RESOURCE_TYPE,
+            earlier_days,
+            later_days,
+        )
+
+        # Only process configuration items that have tags AppVersion and TerraformVersion
+        for tags in history_tags:
+            if TagNames.APP_VERSION in tags:
+                app_versions.add(tags[TagNames.APP_VERSION])
+            if TagNames.TERRAFORM_VERSION in tags:
+                terraform_versions.add(tags[TagNames.TERRAFORM_VERSION])
+
+        return function.name, app_versions, terraform_versions
+
+    def _get_single_function_history_incremental(
+        self, function: LambdaFunction, earlier_days: float, later_days: float
+    ) -> Tuple[str, Set[str], Set[str]]:
+        """Get history for a single function, scanning only past its watermark."""
+        now = time.time()
+        window_start = now - earlier_days * 86400
+        scan_range = self.history_watermarks.scan_range(
+            function.name, window_start, now - later_days * 86400
+        )
+        if scan_range is not None:
+            start, end = scan_range
+            try:
+                items = self._get_resource_history_items(
+                    function.name,
+                    Config.AWS_LAMBDA_FUNCTION_RESOURCE_TYPE,
+                    datetime.fromtimestamp(start, tz=timezone.utc),
+                    datetime.fromtimestamp(end, tz=timezone.utc),
+                )
+                self.history_watermarks.record(function.name, end, items)
+            except Exception as e:
+                if is_throttling_error(e):
+                    raise
+                # Keep the watermark so the window is scanned again next run
+                print(f"Error getting resource history for {function.name}: {e}")
+
+        app_versions, terraform_versions = self.history_watermarks.versions(
+            function.name, window_start
+        )
+        return function.name, app_versions, terraform_versions
+
+    def get_tags_history_batch(
+        self,
+        functions: List[LambdaFunction],
+        earlier_days: float,
+        later_days: float,
+        backend: str = None,
+        run_cache: Dict[str, Any] = None,
+        save_watermarks: bool = True,
+    ) -> Dict[str, Tuple[Set[str], Set[str]]]:
+        """Get history for multiple functions. Returns dict of function_name -> (app_versions, terraform_versions).
+
+        backend selects the history source (see HistoryBackends), defaults to
+        Config.HISTORY_BACKEND. Runs calling this once per page pass a
+        run_cache, so the backends reading the whole account or log do it
+        once per run, and save_watermarks=False to save them once at the end.
+        """
+        backend = backend or Config.HISTORY_BACKEND
+        print(f"Using history backend: {backend}")
+        if backend == HistoryBackends.CONFIG_SELECT:
+            return self._get_tags_history_select(
+                functions, earlier_days, run_cache, save_watermarks
+            )
+        if backend == HistoryBackends.SNAPSHOT_LOG:
+            return self._get_tags_history_log(
+                functions, earlier_days, later_days, run_cache
+            )
+        if backend != HistoryBackends.CONFIG_HISTORY:
+            raise ValueError(f"Unknown history backend: {backend}")
+        return self._get_tags_history_per_function(
+            functions, earlier_days, later_days, save_watermarks
+        )
+
+    def _get_tags_history_log(
+        self,
+        functions: List[LambdaFunction],
+        earlier_days: float,
+        later_days: float,
+        run_cache: Dict[str, Any] = None,
+    ) -> Dict[str, Tuple[Set[str], Set[str]]]:
+        """Get history from the observation log, without any AWS Config call."""
+        if self.state_store is None:
+            print("The snapshot-log history backend needs a state store, no history")
+            return {function.name: (set(), set()) for function in functions}
+        log = self.observation_log or ObservationLog(self.state_store)
+        if run_cache is None:
+            return log.versions(
+                (function.name for function in functions), earlier_days, later_days
+            )
+        if HistoryBackends.SNAPSHOT_LOG not in run_cache:
+            # Segments are read once, for every function of the log
+            run_cache[HistoryBackends.SNAPSHOT_LOG] = log.versions(
+                None, earlier_days, later_days
+            )
+        history = run_cache[HistoryBackends.SNAPSHOT_LOG]
+        return {
+            function.name: history.get(function.name, (set(), set()))
+            for function in functions
+        }
+
+    def _get_tags_history_per_function(
+        self,
+        functions: List[LambdaFunction],
+        earlier_days: float,
+        later_days: float,
+        save_watermarks: bool = True,
+    ) -> Dict[str, Tuple[Set[str], Set[str]]]:
+        """Get history with one GetResourceConfigHistory pagination per function, in parallel."""
+        results = {}
+
+        # Submit all history fetching tasks
+        future_to_function = self.executor.submit_all(
+            ApiNames.CONFIG_RESOURCE_HISTORY,
+            self._get_single_function_history,
+            functions,
+            earlier_days,
+            later_days,
+        )
+
+        # Process completed tasks
+        for future in as_completed(future_to_function):
+            try:
+                function_name, app_versions, terraform_versions = future.result()
+                results[function_name] = (app_versions, terraform_versions)
+            except Exception as e:
+                function = future_to_function[future]
+                print(f"Error getting history for function {function.name}: {e}")
+                results[function.name] = (set(), set())
+
+        if self.history_watermarks is not None and save_watermarks:
+            self.history_watermarks.save()
+        self.executor.print_report(ApiNames.CONFIG_RESOURCE_HISTORY)
+        return results
+
+    def select_function_tags(
+        self, account_id: str = None, region: str = None
+    ) -> List[Tuple[str, str, str, Dict[str, str]]]:
+        """Get the recorded tags of all Lambda functions with AWS Config advanced queries.
+
+        Queries the aggregator named by Config.CONFIG_AGGREGATOR_NAME when set,
+        restricted to account_id and region when given, the local account and
+        region otherwise. Returns (account_id, region, function_name, tags).
+        """
+        expression = (
+            "SELECT accountId, awsRegion, resourceName, tags "
+            f"WHERE resourceType = '{Config.AWS_LAMBDA_FUNCTION_RESOURCE_TYPE}' "
+            f"AND tags.key = '{TagNames.APP_VERSION}'"
+        )
+        if account_id:
+            expression += f" AND accountId = '{account_id}'"
+        if region:
+            expression += f" AND awsRegion = '{region}'"
+        if Config.CONFIG_AGGREGATOR_NAME:
+            select = self.config_client.select_aggregate_resource_config
+            kwargs = {"ConfigurationAggregatorName": Config.CONFIG_AGGREGATOR_NAME}
+        else:
+            select = self.config_client.select_resource_config
+            kwargs = {}
+
+        limiter = self.executor.limiter(ApiNames.CONFIG_SELECT)
+        results = []
+        next_token = None
+        while True:
+            page_kwargs = dict(
+                kwargs, Expression=expression, Limit=Config.CONFIG_SELECT_LIMIT
+            )
+            if next_token:
+                page_kwargs["NextToken"] = next_token
+            page = limiter.call(lambda: select(**page_kwargs))
+            for result in page.get("Results", []):
+                item = json.loads(result)
+                tags = item.get("tags") or {}
+                # Advanced queries return tags as a list of key/value objects
+                if isinstance(tags, list):
+                    tags = {tag["key"]: tag.get("value", "") for tag in tags}
+                results.append(
+                    (
+                        item.get("accountId"),
+                        item.get("awsRegion"),
+                        item.get("resourceName"),
+                        tags,
+                    )
+                )
+            next_token = page.get("NextToken")
+            if not next_token:
+                return results
+
+    def _get_tags_history_select(
+        self,
+        functions: List[LambdaFunction],
+        earlier_days: float,
+        run_cache: Dict[str, Any] = None,
+        save_watermarks: bool = True,
+    ) -> Dict[str, Tuple[Set[str], Set[str]]]:
+        """Get versions for all functions with a few paged advanced queries.
+
+        Advanced queries only see the latest configuration item recorded for
+        each function, not its full history, so this backend returns the
+        versions AWS Config currently has on record. With a state store the
+        observations accumulate in the history watermarks across runs. An
+        aggregator sees every account and region, so its results are matched
+        on the account and region of each function's ARN, not on name alone.
+        With a run_cache the query runs once per run, scoped by the first
+        functions asked for.
+        """
+        results = {function.name: (set(), set()) for function in functions}
+        # (account_id, region) of each function from its ARN
+        locations = {}
+        for function in functions:
+            parts = function.arn.split(":")
+            locations[function.name] = (
+                (parts[4], parts[3]) if len(parts) >= 7 else (None, None)
+            )
+        account_id = region = None
+        if Config.CONFIG_AGGREGATOR_NAME:
+            scopes = set(locations.values())
+            if len(scopes) == 1:
+                account_id, region = next(iter(scopes))
+        try:
+            if run_cache is None:
+                rows = self.select_function_tags(account_id, region)
+            else:
+                if HistoryBackends.CONFIG_SELECT not in run_cache:
+                    run_cache[HistoryBackends.CONFIG_SELECT] = (
+                        self.select_function_tags(account_id, region)
+                    )
+                rows = run_cache[HistoryBackends.CONFIG_SELECT]
+            for (
+                item_account,
+                item_region,
+                function_name,
+                tags,
+            ) in rows:
+                if function_name not in results:
+                    continue
+                if Config.CONFIG_AGGREGATOR_NAME and locations[function_name] != (
+                    item_account,
+                    item_region,
+                ):
+                    # A same-named function of another account or region
+                    continue
+                app_versions, terraform_versions = results[function_name]
+                if TagNames.APP_VERSION in tags:
+                    app_versions.add(tags[TagNames.APP_VERSION])
+                if TagNames.TERRAFORM_VERSION in tags:
+                    terraform_versions.add(tags[TagNames.TERRAFORM_VERSION])
+        except Exception as e:
+            print(f"Error selecting resource config for Lambda functions: {e}")
+            return results
+
+        watermarks = self.select_watermarks
+        if watermarks is None:
+            return results
+        now = time.time()
+        for function_name, (app_versions, terraform_versions) in results.items():
+            watermarks.record(
+                function_name,
+                now,
+                [({TagNames.APP_VERSION: version}, now) for version in app_versions]
+                + [
+                    ({TagNames.TERRAFORM_VERSION: version}, now)
+                    for version in terraform_versions
+                ],
+            )
+        if save_watermarks:
+            watermarks.save()
+        window_start = now - earlier_days * 86400
+        return {
+            function_name: watermarks.versions(function_name, window_start)
+            for function_name in results
+        }
+
+    def publish_metrics(
+        self, metric_name: str, dimensions: List[Dict[str, str]], value: float
+    ) -> None:
+        metric_data = MetricsData(
+            metric_name=metric_name,
+            dimensions=dimensions,
+            value=value,
+            unit=Config.METRIC_UNIT,
+        )
+
+        try:
+            self.cloudwatch_client.put_metric_data(
+                Namespace=CLOUDWATCH_NAMESPACE,
+                MetricData=[metric_data.to_cloudwatch_format()],
+            )
+            print(f"Published metric for {metric_name} {dimensions} {value}")
+        except Exception as e:
+            print(
+                f"Error publishing metric for {metric_name} {dimensions} {value}: {e}"
+            )
+
+    def _put_metric_data(
+        self, batch: List[MetricsData], result: PublishResult
+    ) -> Optional[Exception]:
+        """Send one PutMetricData request, retrying transient errors with jittered backoff.
+
+        Returns the error of the last attempt, None on success.
+        """
+        metric_data = [metric.to_cloudwatch_format() for metric in batch]
+        for attempt in range(1, Config.CW_TRANSIENT_MAX_ATTEMPTS + 1):
+            result.calls += 1
+            try:
+                self.cloudwatch_client.put_metric_data(
+                    Namespace=CLOUDWATCH_NAMESPACE,
+                    MetricData=metric_data,
+                )
+                return None
+            except Exception as e:
+                if (
+                    not is_transient_error(e)
+                    or attempt == Config.CW_TRANSIENT_MAX_ATTEMPTS
+                ):
+                    return e
+            _jittered_backoff(attempt)
+
+    def _publish_bisect(self, batch: List[MetricsData], result: PublishResult) -> None:
+        """Publish a batch, splitting it in halves until rejected metrics are isolated.
+
+        Costs O(k log n) extra calls for k rejected metrics in a batch of n.
+        Only size and validation errors are split, credential and permission
+        errors are raised since every half would be refused as well.
+        """
+        error = self._put_metric_data(batch, result)
+        if error is None:
+            print(f"Published batch of {len(batch)} metrics")
+            result.published.extend(batch)
+            return
+
+        if is_auth_error(error):
+            raise error
+        if len(batch) == 1 or not is_data_error(error):
+            # Nothing left to split, or the failure is not caused by the data
+            print(f"Error publishing batch of {len(batch)} metrics: {error}")
+            result.rejected.extend((metric, str(error)) for metric in batch)
+            return
+
+        print(f"Error publishing batch of {len(batch)} metrics, splitting it: {error}")
+        middle = len(batch) // 2
+        self._publish_bisect(batch[:middle], result)
+        self._publish_bisect(batch[middle:], result)
+
+    def _publish_batch(self, batch: List[MetricsData]) -> PublishResult:
+        result = PublishResult()
+        self._publish_bisect(batch, result)
+        return result
+
+    def publish_metrics_batch(self, metrics: List[MetricsData]) -> PublishResult:
+        """Publish multiple metrics to CloudWatch in the fewest, largest batches, in parallel.
+
+        Failed batches are bisected so only the offending metrics are rejected.
+        """
+        result = PublishResult()
+        if not metrics:
+            return result
+
+        datapoints = len(metrics)
+        metrics = collapse_metrics(metrics)
+        if len(metrics) < datapoints:
+            print(f"Collapsed {datapoints} datapoints into {len(metrics)} entries")
+
+        batches = pack_metric_batches(metrics)
+        print(f"Packed {len(metrics)} metrics into {len(batches)} batches")
+        future_to_batch = self.executor.submit_all(
+            ApiNames.CLOUDWATCH_PUT_METRIC_DATA, self._publish_batch, batches
+        )
+        for future in as_completed(future_to_batch):
+            try:
+                result.merge(future.result())
+            except Exception as e:
+                batch = future_to_batch[future]
+                print(f"Error publishing batch of {len(batch)} metrics: {e}")
+                result.rejected.extend((metric, str(e)) for metric in batch)
+        self.executor.print_report(ApiNames.CLOUDWATCH_PUT_METRIC_DATA)
+
+        for metric, reason in result.rejected:
+            print(f"Rejected metric {metric.metric_name} {metric.dimensions}: {reason}")
+        return result
+
+
+def estimate_metric_bytes(metric_data: Dict) -> int:
+    """Upper estimate of the serialized size of one PutMetricData entry."""
+    size = 0
+    for key, value in metric_data.items():
+        if key == "Dimensions":
+            for dimension in value:
+                size += 2 * Config.CW_FIELD_OVERHEAD_BYTES
+                size += len(dimension["Name"].encode()) + len(
+                    dimension["Value"].encode()
+                )
+        elif isinstance(value, list):
+            size += len(value) * Config.CW_FIELD_OVERHEAD_BYTES
+            size += sum(len(str(item)) for item in value)
+        else:
+            size += Config.CW_FIELD_OVERHEAD_BYTES + len(str(value).encode())
+    return size
+
+
+def pack_metric_batches(metrics: List[MetricsData]) -> List[List[MetricsData]]:
+    """Pack metrics into the largest batches PutMetricData accepts.
+
+    Batches are limited by Config.CW_BATCH_SIZE metrics and
+    Config.CW_MAX_PAYLOAD_BYTES of estimated payload.
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for metric in metrics:
+        metric_bytes = estimate_metric_bytes(metric.to_cloudwatch_format())
+        if batch and (
+            len(batch) >= Config.CW_BATCH_SIZE
+            or batch_bytes + metric_bytes > Config.CW_MAX_PAYLOAD_BYTES
+        ):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(metric)
+        batch_bytes += metric_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class MetricSink:
+    """Destination of published metrics.
+
+    publish may buffer metrics, flush sends what is still buffered at the end
+    of a run. Both return the metrics actually delivered by that call.
+    """
+
+    # Sinks that need every series on every run bypass the keepalive scheduler
+    full_series = False
+
+    def publish(self, metrics: List[MetricsData]) -> PublishResult:
+        raise NotImplementedError
+
+    def flush(self) -> PublishResult:
+        return PublishResult()
+
+
+class CloudWatchSink(MetricSink):
+    """Publishes metrics with PutMetricData through the inspector's CloudWatch client."""
+
+    def __init__(self, inspector: "LambdaInspector"):
+        self.inspector = inspector
+
+    def publish(self, metrics: List[MetricsData]) -> PublishResult:
+        return self.inspector.publish_metrics_batch(metrics)
+
+
+def _emf_values(metric: MetricsData) -> List[float]:
+    if metric.values is None:
+        return [metric.value]
+    values = []
+    for value, count in zip(metric.values, metric.counts):
+        values.extend([value] * int(count))
+    return values
+
+
+class _EmfLine:
+    """One Embedded Metric Format document being packed.
+
+    Dimension and metric values live at the root of the document, so metrics
+    only share a line when the dimensions they have in common agree. Each
+    distinct set of dimension names gets its own metric directive.
+    """
+
+    __slots__ = ("timestamp", "root", "metric_dimensions", "units", "size")
+
+    def __init__(self, timestamp: int):
+        self.timestamp = timestamp
+        self.root: Dict[str, Any] = {}
+        self.metric_dimensions: Dict[str, Tuple[str, ...]] = {}
+        self.units: Dict[str, str] = {}
+        self.size = 0
+
+    def add(self, metric: MetricsData, dimensions: Dict[str, str]) -> bool:
+        """Add a metric if the line can hold it, returns whether it was added."""
+        for name, value in dimensions.items():
+            if name in self.metric_dimensions or self.root.get(name, value) != value:
+                return False
+        if metric.metric_name in dimensions:
+            return False
+        names = tuple(dimensions)
+        values = _emf_values(metric)
+        existing = self.root.get(metric.metric_name)
+        if existing is not None:
+            # Another datapoint of the same series, extends its value array
+            if (
+                self.metric_dimensions.get(metric.metric_name) != names
+                or self.units[metric.metric_name] != metric.unit
+                or len(existing) + len(values) > Config.EMF_MAX_VALUES_PER_METRIC
+            ):
+                return False
+        elif (
+            len(self.metric_dimensions) >= Config.EMF_MAX_METRICS_PER_LINE
+            or len(values) > Config.EMF_MAX_VALUES_PER_METRIC
+        ):
+            return False
+
+        added_bytes = sum(
+            len(name) + len(value) + 8
+            for name, value in dimensions.items()
+            if name not in self.root
+        )
+        added_bytes += len(metric.metric_name) * 2 + len(names) * 32 + 64
+        added_bytes += sum(len(str(value)) + 2 for value in values)
+        if self.size and self.size + added_bytes > Config.EMF_MAX_LINE_BYTES:
+            return False
+
+        self.size += added_bytes
+        self.root.update(dimensions)
+        if existing is not None:
+            existing.extend(values)
+        else:
+            self.root[metric.metric_name] = values
+            self.metric_dimensions[metric.metric_name] = names
+            self.units[metric.metric_name] = metric.unit
+        return True
+
+    def document(self, namespace: str) -> Dict:
+        directives: Dict[Tuple[str, ...], List[Dict[str, str]]] = {}
+        for metric_name, names in self.metric_dimensions.items():
+            directives.setdefault(names, []).append(
+                {"Name": metric_name, "Unit": self.units[metric_name]}
+            )
+        document = {
+            "_aws": {
+                "Timestamp": self.timestamp,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": namespace,
+                        "Dimensions": [list(names)],
+                        "Metrics": definitions,
+                    }
+                    for names, definitions in directives.items()
+                ],
+            }
+        }
+        for key, value in self.root.items():
+            if key in self.metric_dimensions and len(value) == 1:
+                value = value[0]
+            document[key] = value
+        return document
+
+
+def pack_emf_documents(
+    metrics: List[MetricsData], namespace: str = CLOUDWATCH_NAMESPACE
+) -> List[Dict]:
+    """Pack metrics into as few Embedded Metric Format documents as EMF allows.
+
+    Only metrics agreeing on the dimensions every metric has (and on their
+    timestamp) can share a document, so candidates are looked up among the
+    documents of the same group.
+    """
+    if not metrics:
+        return []
+    shared_names = sorted(
+        set.intersection(
+            *({d["Name"] for d in metric.dimensions} for metric in metrics)
+        )
+    )
+    now = int(time.time() * 1000)
+    groups: Dict[Tuple, List[_EmfLine]] = {}
+    for metric in metrics:
+        dimensions = {d["Name"]: d["Value"] for d in metric.dimensions}
+        timestamp = (
+            int(metric.timestamp.timestamp() * 1000)
+            if metric.timestamp is not None
+            else now
+        )
+        key = (timestamp, tuple(dimensions[name] for name in shared_names))
+        lines = groups.setdefault(key, [])
+        if not any(line.add(metric, dimensions) for line in lines):
+            line = _EmfLine(timestamp)
+            line.add(metric, dimensions)
+            lines.append(line)
+    return [line.document(namespace) for lines in groups.values() for line in lines]
+
+
+class EmfSink(MetricSink):
+    """Writes Embedded Metric Format lines to stdout, no PutMetricData calls.
+
+    CloudWatch Logs extracts the metrics from the function's log stream.
+    """
+
+    def __init__(self, namespace: str = CLOUDWATCH_NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream
+
+    def publish(self, metrics: List[MetricsData]) -> PublishResult:
+        documents = pack_emf_documents(metrics, self.namespace)
+        stream = self.stream or sys.stdout
+        for document in documents:
+            stream.write(json.dumps(document, separators=(",", ":")) + "\n")
+        stream.flush()
+        print(f"Wrote {len(metrics)} metrics as {len(documents)} EMF lines")
+        return PublishResult(published=list(metrics))
+
+
+def _metric_labels(metric: MetricsData) -> List[Tuple[str, str]]:
+    """Prometheus labels of a metric, sorted by name as remote-write requires."""
+    labels = [("__name__", re.sub(r"[^a-zA-Z0-9_:]", "_", metric.metric_name))]
+    labels.extend(
+        (re.sub(r"[^a-zA-Z0-9_]", "_", d["Name"]), d["Value"])
+        for d in metric.dimensions
+    )
+    return sorted(labels)
+
+
+def _latest_value(metric: MetricsData) -> float:
+    """Latest value of a metric, collapsed entries keep their last value."""
+    return metric.values[-1] if metric.values else metric.value
+
+
+def _merge_series(
+    series: Dict[Tuple, MetricsData], metrics: Iterable[MetricsData]
+) -> None:
+    """Add metrics to series by label set, the highest value wins.
+
+    A history run can emit a terraformTag series twice: with value 0 from one
+    function's history and 1 from a sibling still running that version.
+    """
+    for metric in metrics:
+        labels = tuple(_metric_labels(metric))
+        current = series.get(labels)
+        if current is None or _latest_value(metric) > _latest_value(current):
+            series[labels] = metric
+
+
+class OpenMetricsFileSink(MetricSink):
+    """Writes an OpenMetrics text exposition file at the end of each run.
+
+    Metrics are buffered for the whole run, the file is replaced atomically
+    on flush with the latest value of every series, grouped by family.
+    """
+
+    full_series = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._series: Dict[Tuple, MetricsData] = {}
+
+    def publish(self, metrics: List[MetricsData]) -> PublishResult:
+        _merge_series(self._series, metrics)
+        return PublishResult()
+
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def flush(self) -> PublishResult:
+        if not self._series:
+            return PublishResult()
+        families: Dict[str, List[str]] = {}
+        for labels, metric in sorted(self._series.items()):
+            name = dict(labels)["__name__"]
+            label_text = ",".join(
+                f'{label}="{self._escape(value)}"'
+                for label, value in labels
+                if label != "__name__"
+            )
+            sample = f"{name}{{{label_text}}} {_latest_value(metric)}"
+            if metric.timestamp is not None:
+                sample += f" {metric.timestamp.timestamp():.3f}"
+            families.setdefault(name, []).append(sample)
+        lines = []
+        for name, samples in families.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        lines.append("# EOF")
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+        published = list(self._series.values())
+        self._series = {}
+        print(f"Wrote {len(published)} series to {self.path}")
+        return PublishResult(published=published)
+
+
+class JsonLinesSink(MetricSink):
+    """Appends one JSON object per metric to a file.
+
+    Lines are buffered and written every Config.JSONL_BUFFER_LINES metrics
+    and at the end of the run.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._buffer: List[MetricsData] = []
+
+    def publish(self, metrics: List[MetricsData]) -> PublishResult:
+        self._buffer.extend(metrics)
+        if len(self._buffer) >= Config.JSONL_BUFFER_LINES:
+            return self.flush()
+        return PublishResult()
+
+    def flush(self) -> PublishResult:
+        if not self._buffer:
+            return PublishResult()
+        now = datetime.now(timezone.utc).isoformat()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            for metric in self._buffer:
+                record = metric.to_cloudwatch_format()
+                record["Timestamp"] = (
+                    metric.timestamp.isoformat() if metric.timestamp else now
+                )
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        published, self._buffer = self._buffer, []
+        return PublishResult(published=published)
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def _protobuf_field(number: int, payload: bytes) -> bytes:
+    """Length-delimited protobuf field."""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def encode_write_request(metrics: List[MetricsData], timestamp_ms: int) -> bytes:
+    """Encode a Prometheus remote-write WriteRequest protobuf.
+
+    WriteRequest.timeseries = 1, TimeSeries.labels = 1 / samples = 2,
+    Label.name = 1 / value = 2, Sample.value = 1 (double) / timestamp = 2.
+    A series given twice is encoded once, with its highest value.
+    """
+    series_by_labels: Dict[Tuple, MetricsData] = {}
+    _merge_series(series_by_labels, metrics)
+    request = bytearray()
+    for metric in series_by_labels.values():
+        series = bytearray()
+        for name, value in _metric_labels(metric):
+            series += _protobuf_field(
+                1,
+                _protobuf_field(1, name.encode()) + _protobuf_field(2, value.encode()),
+            )
+        sample_ms = (
+            int(metric.timestamp.timestamp() * 1000)
+            if metric.timestamp is not None
+            else timestamp_ms
+        )
+        sample = (
+            _varint(1 << 3 | 1)
+            + struct.pack("<d", float(_latest_value(metric)))
+            + _varint(2 << 3 | 0)
+            + _varint(sample_ms)
+        )
+        series += _protobuf_field(2, sample)
+        request += _protobuf_field(1, bytes(series))
+    return bytes(request)
+
+
+def snappy_compress(data: bytes) -> bytes:
+    """Snappy block format, through python-snappy when installed.
+
+    The fallback emits literal chunks only: valid snappy any decoder reads,
+    without the compression.
+    """
+    if snappy is not None:
+        return snappy.compress(data)
+    compressed = bytearray(_varint(len(data)))
+    for start in range(0, len(data), 65536):
+        chunk = data[start : start + 65536]
+        length = len(chunk) - 1
+        if length < 60:
+            compressed.append(length << 2)
+        elif length < 256:
+            compressed += bytes((60 << 2, length))
+        else:
+            compressed.append(61 << 2)
+            compressed += length.to_bytes(2, "little")
+        compressed += chunk
+    return bytes(compressed)
+
+
+class PrometheusRemoteWriteSink(MetricSink):
+    """Sends metrics to a Prometheus remote-write endpoint (Prometheus, Mimir...).
+
+    Metrics are buffered into requests of Config.REMOTE_WRITE_BATCH_SIZE
+    series, sent one after the other to keep samples of a series in order.
+    A series emitted twice in a run is sent once with its highest value, a
+    request never repeats a series. Transient failures (5xx, 429, connection
+    errors) are retried.
+    """
+
+    # A series without a sample for 5 minutes goes stale in Prometheus
+    full_series = True
+
+    def __init__(self, url: str):
+        self.url = url
+        self._buffer: Dict[Tuple, MetricsData] = {}
+        # Value sent for each series in this run
+        self._sent: Dict[Tuple, float] = {}
+
+    def publish(self, metrics: List[MetricsData]) -> PublishResult:
+        _merge_series(
+            self._buffer,
+            (
+                metric
+                for metric in metrics
+                if _latest_value(metric)
+                > self._sent.get(tuple(_metric_labels(metric)), -math.inf)
+            ),
+        )
+        result = PublishResult()
+        while len(self._buffer) >= Config.REMOTE_WRITE_BATCH_SIZE:
+            labels = list(self._buffer)[: Config.REMOTE_WRITE_BATCH_SIZE]
+            result.merge(self._send([self._buffer.pop(key) for key in labels]))
+        return result
+
+    def flush(self) -> PublishResult:
+        batch, self._buffer = list(self._buffer.values()), {}
+        result = self._send(batch) if batch else PublishResult()
+        self._sent = {}
+        return result
+
+    def _send(self, batch: List[MetricsData]) -> PublishResult:
+        import urllib.error
+        import urllib.request
+
+        body = snappy_compress(encode_write_request(batch, int(time.time() * 1000)))
+        request = urllib.request.Request(
+            self.url,
+            data=body,
+            method="POST",
+            headers={
+                "Content-Encoding": "snappy",
+                "Content-Type": "application/x-protobuf",
+                "X-Prometheus-Remote-Write-Version": "0.1.0",
+            },
+        )
+        for attempt in range(1, Config.REMOTE_WRITE_MAX_ATTEMPTS + 1):
+            try:
+                with urllib.request.urlopen(
+                    request, timeout=Config.REMOTE_WRITE_TIMEOUT_SECONDS
+                ):
+                    pass
+                for metric in batch:
+                    self._sent[tuple(_metric_labels(metric))] = _latest_value(metric)
+                return PublishResult(published=batch, calls=attempt)
+            except Exception as e:
+                transient = not isinstance(e, urllib.error.HTTPError) or (
+                    e.code == 429 or e.code >= 500
+                )
+                if not transient or attempt == Config.REMOTE_WRITE_MAX_ATTEMPTS:
+                    print(f"Error sending {len(batch)} series to remote-write: {e}")
+                    return PublishResult(
+                        rejected=[(metric, str(e)) for metric in batch],
+                        calls=attempt,
+                    )
+                _jittered_backoff(attempt)
+
+
+def build_metric_sink(inspector: "LambdaInspector") -> MetricSink:
+    """Build the sink selected by Config.METRIC_SINK."""
+    if Config.METRIC_SINK == MetricSinks.EMF:
+        return EmfSink()
+    if Config.METRIC_SINK == MetricSinks.OPENMETRICS:
+        return OpenMetricsFileSink(
+            Config.METRIC_SINK_PATH
+            or os.path.join(Config.DEFAULT_STATE_DIR, "metrics.prom")
+        )
+    if Config.METRIC_SINK == MetricSinks.JSONL:
+        return JsonLinesSink(
+            Config.METRIC_SINK_PATH
+            or os.path.join(Config.DEFAULT_STATE_DIR, "metrics.jsonl")
+        )
+    if Config.METRIC_SINK == MetricSinks.REMOTE_WRITE:
+        if not Config.REMOTE_WRITE_URL:
+            raise ValueError("REMOTE_WRITE_URL is required for the remote-write sink")
+        return PrometheusRemoteWriteSink(Config.REMOTE_WRITE_URL)
+    if Config.METRIC_SINK != MetricSinks.CLOUDWATCH:
+        raise ValueError(f"Unknown metric sink: {Config.METRIC_SINK}")
+    return CloudWatchSink(inspector)
+
+
+class SnapshotExporter:
+    """Columnar snapshot of the functions of a run, written while their metrics are built.
+
+    One row per function with its ServiceInfo, current versions and all
+    versions seen in its history. Rows are buffered as columns and written as
+    a record batch every batch_rows functions, so the file grows while the
+    run goes on. String columns are dictionary encoded against dictionaries
+    shared by the whole file, which an Arrow IPC stream sends as deltas.
+    """
+
+    DICTIONARY_COLUMNS = (
+        "account_id",
+        "region",
+        "env",
+        "stack",
+        "service",
+        "app_version",
+        "terraform_version",
+    )
+    LIST_COLUMNS = ("app_versions", "terraform_versions")
+    PLAIN_COLUMNS = ("function_name", "function_arn")
+    EXTENSIONS = {ExportFormats.PARQUET: "parquet", ExportFormats.ARROW: "arrows"}
+
+    def __init__(
+        self,
+        destination: str,
+        export_format: str = ExportFormats.PARQUET,
+        s3_client=None,
+        batch_rows: int = None,
+        now: float = None,
+    ):
+        if export_format not in self.EXTENSIONS:
+            raise ValueError(f"Unknown snapshot export format {export_format}")
+        # pyarrow is heavy, it is only imported when exports are enabled
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.format = export_format
+        self.batch_rows = batch_rows or Config.SNAPSHOT_EXPORT_BATCH_ROWS
+        self.observed_at = time.time() if now is None else now
+        stamp = datetime.fromtimestamp(self.observed_at, timezone.utc)
+        name = f"inspector-snapshot-{stamp:%Y%m%dT%H%M%SZ}.{self.EXTENSIONS[export_format]}"
+        self.s3_client = s3_client
+        if destination.startswith("s3://"):
+            self.bucket, _, prefix = destination[len("s3://") :].partition("/")
+            self.key = f"{prefix.rstrip('/')}/{name}".lstrip("/")
+            self.path = os.path.join(Config.DEFAULT_STATE_DIR, name)
+            self.location = f"s3://{self.bucket}/{self.key}"
+        else:
+            self.bucket = self.key = None
+            self.path = self.location = os.path.join(destination, name)
+
+        dictionary = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        self.schema = pyarrow.schema(
+            [("observed_at", pyarrow.timestamp("ms", tz="UTC"))]
+            + [(column, dictionary) for column in self.DICTIONARY_COLUMNS[:5]]
+            + [(column, pyarrow.string()) for column in self.PLAIN_COLUMNS]
+            + [(column, dictionary) for column in self.DICTIONARY_COLUMNS[5:]]
+            + [(column, pyarrow.list_(dictionary)) for column in self.LIST_COLUMNS]
+        )
+        # Codes of the dictionary values, per column for the whole file
+        self._codes: Dict[str, Dict[str, int]] = {
+            column: {} for column in self.DICTIONARY_COLUMNS + self.LIST_COLUMNS
+        }
+        self._columns: Dict[str, List] = {}
+        self._offsets: Dict[str, List[int]] = {}
+        self._reset_batch()
+        self._writer = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.rows = 0
+
+    def _reset_batch(self) -> None:
+        self._columns = {
+            column: []
+            for column in self.DICTIONARY_COLUMNS
+            + self.LIST_COLUMNS
+            + self.PLAIN_COLUMNS
+        }
+        self._offsets = {column: [0] for column in self.LIST_COLUMNS}
+
+    def _code(self, column: str, value: Optional[str]) -> Optional[int]:
+        if value is None:
+            return None
+        codes = self._codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def add(
+        self,
+        service_info: ServiceInfo,
+        function: LambdaFunction,
+        app_versions: Set[str],
+        terraform_versions: Set[str],
+    ) -> None:
+        """Add the row of one function, versions include the current ones."""
+        values = {
+            "account_id": service_info.account_id,
+            "region": service_info.region,
+            "env": service_info.env,
+            "stack": service_info.stack,
+            "service": service_info.service,
+            "app_version": function.tags[TagNames.APP_VERSION],
+            "terraform_version": service_info.terraform_version,
+        }
+        with self._lock:
+            # Targets that ran out of time may still finish after the run
+            if self._closed:
+                return
+            for column, value in values.items():
+                self._columns[column].append(self._code(column, value))
+            self._columns["function_name"].append(function.name)
+            self._columns["function_arn"].append(function.arn)
+            for column, versions in zip(
+                self.LIST_COLUMNS, (app_versions, terraform_versions)
+            ):
+                codes = self._columns[column]
+                codes.extend(
+                    self._code(column, version) for version in sorted(versions)
+                )
+                self._offsets[column].append(len(codes))
+            if len(self._columns["function_name"]) >= self.batch_rows:
+                self._write_batch()
+
+    def _dictionary_array(self, column: str, codes: List[Optional[int]]):
+        pa = self.pa
+        return pa.DictionaryArray.from_arrays(
+            pa.array(codes, pa.int32()),
+            pa.array(list(self._codes[column]), pa.string()),
+        )
+
+    def _write_batch(self) -> None:
+        pa = self.pa
+        rows = len(self._columns["function_name"])
+        if not rows:
+            return
+        arrays = [pa.array([int(self.observed_at * 1000)] * rows, self.schema[0].type)]
+        arrays += [
+            self._dictionary_array(column, self._columns[column])
+            for column in self.DICTIONARY_COLUMNS[:5]
+        ]
+        arrays += [
+            pa.array(self._columns[column], pa.string())
+            for column in self.PLAIN_COLUMNS
+        ]
+        arrays += [
+            self._dictionary_array(column, self._columns[column])
+            for column in self.DICTIONARY_COLUMNS[5:]
+        ]
+        arrays += [
+            pa.ListArray.from_arrays(
+                pa.array(self._offsets[column], pa.int32()),
+                self._dictionary_array(column, self._columns[column]),
+            )
+            for column in self.LIST_COLUMNS
+        ]
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if self._writer is None:
+            self._writer = self._open_writer()
+        self._writer.write_batch(batch)
+        self.rows += rows
+        self._reset_batch()
+
+    def _open_writer(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.format == ExportFormats.PARQUET:
+            return self.pa.parquet.ParquetWriter(
+                self.path, self.schema, compression="zstd"
+            )
+        return self.pa.ipc.new_stream(
+            self.path,
+            self.schema,
+            options=self.pa.ipc.IpcWriteOptions(
+                compression="zstd", emit_dictionary_deltas=True
+            ),
+        )
+
+    def close(self) -> Optional[str]:
+        """Write the last rows and ship the file, returns its location if any rows were added."""
+        with self._lock:
+            self._closed = True
+            self._write_batch()
+            if self._writer is None:
+                return None
+            self._writer.close()
+            self._writer = None
+        size = os.path.getsize(self.path)
+        if self.bucket is not None:
+            self.s3_client.upload_file(self.path, self.bucket, self.key)
+            os.remove(self.path)
+        print(f"Exported {self.rows} functions to {self.location} ({size} bytes)")
+        return self.location
+
+
+def build_snapshot_exporter(inspector: "LambdaInspector") -> Optional[SnapshotExporter]:
+    """Build the snapshot exporter configured through the environment, if any."""
+    if not Config.SNAPSHOT_EXPORT_PATH:
+        return None
+    s3_client = None
+    if Config.SNAPSHOT_EXPORT_PATH.startswith("s3://"):
+        s3_client = create_client(inspector.session, "s3")
+    try:
+        return SnapshotExporter(
+            Config.SNAPSHOT_EXPORT_PATH, Config.SNAPSHOT_EXPORT_FORMAT, s3_client
+        )
+    except ImportError:
+        print("Snapshot export needs pyarrow (pip install .[arrow]), skipped")
+    except ValueError as e:
+        print(f"Snapshot export skipped: {e}")
+    return None
+
+
+@lru_cache(maxsize=Config.DIMENSION_CACHE_SIZE)
+def _dimension(name: str, value: str) -> Dict[str, str]:
+    """Dimension dict shared by every metric with this name and value, never modified."""
+    return {"Name": name, "Value": sys.intern(value)}
+
+
+@lru_cache(maxsize=Config.SERVICE_DIMENSION_CACHE_SIZE)
+def _service_dimensions(
+    service_info: ServiceInfo,
+) -> Tuple[Tuple[Dict[str, str], ...], Tuple[Dict[str, str], ...]]:
+    """Leading and location dimensions shared by every metric of a service."""
+    leading = (
+        _dimension(DimensionNames.ENV, service_info.env),
+        _dimension(DimensionNames.STACK, service_info.stack),
+        _dimension(DimensionNames.SERVICE, service_info.service),
+    )
+    return leading, tuple(create_location_dimensions(service_info))
+
+
+def create_location_dimensions(service_info: ServiceInfo) -> List[Dict[str, str]]:
+    """Create the Region/AccountId dimensions of multi-region and multi-account runs."""
+    dimensions = []
+    if service_info.region:
+        dimensions.append(_dimension(DimensionNames.REGION, service_info.region))
+    if service_info.account_id:
+        dimensions.append(
+            _dimension(DimensionNames.ACCOUNT_ID, service_info.account_id)
+        )
+    return dimensions
+
+
+def create_lambda_dimensions(
+    service_info: ServiceInfo, function_name: str, app_version: str
+) -> List[Dict[str, str]]:
+    """Create dimensions for lambda metrics."""
+    leading, location = _service_dimensions(service_info)
+    return [
+        *leading,
+        _dimension(DimensionNames.FUNCTION_NAME, function_name),
+        _dimension(DimensionNames.APP_VERSION, app_version),
+        *location,
+    ]
+
+
+def create_terraform_dimensions(
+    service_info: ServiceInfo, terraform_version: str
+) -> List[Dict[str, str]]:
+    """Create dimensions for terraform metrics."""
+    leading, location = _service_dimensions(service_info)
+    return [
+        *leading,
+        _dimension(DimensionNames.TERRAFORM_VERSION, terraform_version),
+        *location,
+    ]
+
+
+def publish_lambda_metric(
+    inspector: LambdaInspector,
+    service_info: ServiceInfo,
+    function_name: str,
+    app_version: str,
+    value: float = 1,
+) -> None:
+    """Publish a lambda metric with proper dimensions."""
+    dimensions = create_lambda_dimensions(service_info, function_name, app_version)
+    inspector.publish_metrics(MetricNames.LAMBDA_TAG, dimensions, value)
+
+
+def publish_terraform_metric(
+    inspector: LambdaInspector,
+    service_info: ServiceInfo,
+    terraform_version: str,
+    value: float = 1,
+) -> None:
+    """Publish a terraform metric with proper dimensions."""
+    dimensions = create_terraform_dimensions(service_info, terraform_version)
+    inspector.publish_metrics(MetricNames.TERRAFORM_TAG, dimensions, value)
+
+
+def build_function_metrics(
+    inspector: LambdaInspector,
+    function: LambdaFunction,
+    history: Optional[Tuple[Set[str], Set[str]]],
+    seen_terraform: Set[Tuple[ServiceInfo, str]],
+    exporter: Optional[SnapshotExporter] = None,
+) -> Tuple[List[MetricsData], List[MetricsData]]:
+    """Build the lambdaTag metrics of one function and its new terraformTag metrics.
+
+    A terraformTag metric only depends on its service and version, so it is
+    built the first time the pair shows up and recorded in seen_terraform.
+    The function's row is added to the exporter, if any.
+    """
+    service_info = inspector.extract_service_info(function)
+
+    app_versions = {function.tags[TagNames.APP_VERSION]}
+    terraform_versions = {function.tags[TagNames.TERRAFORM_VERSION]}
+
+    if history is not None:
+        app_versions_history, terraform_versions_history = history
+        app_versions.update(app_versions_history)
+        terraform_versions.update(terraform_versions_history)
+    if exporter is not None:
+        exporter.add(service_info, function, app_versions, terraform_versions)
+
+    lambda_metrics = []
+    for version in app_versions:
+        if version != function.tags.get(TagNames.APP_VERSION):
+            dimensions = create_lambda_dimensions(service_info, function.name, version)
+            lambda_metrics.append(
+                MetricsData(
+                    metric_name=MetricNames.LAMBDA_TAG,
+                    dimensions=dimensions,
+                    value=0,
+                    unit=Config.METRIC_UNIT,
+                )
+            )
+        else:
+            dimensions = create_lambda_dimensions(
+                service_info, function.name, function.tags[TagNames.APP_VERSION]
+            )
+            lambda_metrics.append(
+                MetricsData(
+                    metric_name=MetricNames.LAMBDA_TAG,
+                    dimensions=dimensions,
+                    value=1,
+                    unit=Config.METRIC_UNIT,
+                )
+            )
+
+    terraform_metrics = []
+    for version in terraform_versions:
+        if (service_info, version) in seen_terraform:
+            continue
+        seen_terraform.add((service_info, version))
+        if version != service_info.terraform_version:
+            dimensions = create_terraform_dimensions(service_info, version)
+            terraform_metrics.append(
+                MetricsData(
+                    metric_name=MetricNames.TERRAFORM_TAG,
+                    dimensions=dimensions,
+                    value=0,
+                    unit=Config.METRIC_UNIT,
+                )
+            )
+        else:
+            dimensions = create_terraform_dimensions(
+                service_info, service_info.terraform_version
+            )
+            terraform_metrics.append(
+                MetricsData(
+                    metric_name=MetricNames.TERRAFORM_TAG,
+                    dimensions=dimensions,
+                    value=1,
+                    unit=Config.METRIC_UNIT,
+                )
+            )
+
+    return lambda_metrics, terraform_metrics
+
+
+def build_metrics(
+    inspector: LambdaInspector,
+    functions: List[LambdaFunction],
+    history_results: Dict[str, Tuple[Set[str], Set[str]]],
+    exporter: Optional[SnapshotExporter] = None,
+) -> List[MetricsData]:
+    """Build lambdaTag and terraformTag metrics from current tags and history."""
+    seen_terraform: Set[Tuple[ServiceInfo, str]] = set()
+    lambda_metrics = []
+    terraform_metrics = []
+
+    with inspector.telemetry.phase(Phases.METRIC_BUILD):
+        for function in functions:
+            function_metrics, service_metrics = build_function_metrics(
+                inspector,
+                function,
+                history_results.get(function.name),
+                seen_terraform,
+                exporter,
+            )
+            lambda_metrics.extend(function_metrics)
+            terraform_metrics.extend(service_metrics)
+
+    return lambda_metrics + terraform_metrics
+
+
+def collect_metrics(
+    inspector: LambdaInspector,
+    use_aws_config: bool = False,
+    earlier_days: float = Config.FULL_HISTORY_EARLIER_DAYS,
+    later_days: float = 0,
+    history_backend: str = None,
+    checkpoint: RunCheckpoint = None,
+    deadline: float = None,
+    shard_count: int = 1,
+    exporter: SnapshotExporter = None,
+) -> Optional[List[MetricsData]]:
+    """Inspect the functions visible to an inspector and build their metrics.
+
+    With a checkpoint, history is fetched in chunks until the deadline (epoch
+    seconds) and None is returned when the run stopped before it was complete.
+    With more than one shard, history is fetched by parallel shard workers.
+    Functions are added to the exporter, if any, as their metrics are built.
+    """
+    functions = inspector.get_all_functions()
+
+    history_results = {}
+    if use_aws_config:
+        print("Fetching history for all functions in parallel...")
+        with inspector.telemetry.phase(Phases.HISTORY_FETCH):
+            if checkpoint is None and shard_count <= 1:
+                history_results = inspector.get_tags_history_batch(
+                    functions, earlier_days, later_days, backend=history_backend
+                )
+            else:
+                history_results = fetch_history_until(
+                    inspector,
+                    functions,
+                    checkpoint.history if checkpoint is not None else {},
+                    # Only a checkpointed run can stop early without losing work
+                    deadline if checkpoint is not None else None,
+                    earlier_days,
+                    later_days,
+                    history_backend,
+                    shard_count,
+                )
+        if history_results is None:
+            return None
+        watermarks = inspector.backend_watermarks(history_backend)
+        if watermarks is not None:
+            watermarks.prune(function.name for function in functions)
+
+    return build_metrics(inspector, functions, history_results, exporter)
+
+
+def fetch_history_until(
+    inspector: LambdaInspector,
+    functions: List[LambdaFunction],
+    fetched: Dict[str, Tuple[Set[str], Set[str]]],
+    deadline: Optional[float],
+    earlier_days: float,
+    later_days: float,
+    history_backend: str = None,
+    shard_count: int = 1,
+) -> Optional[Dict[str, Tuple[Set[str], Set[str]]]]:
+    """Fetch history in chunks of HISTORY_CHUNK_SIZE functions until the deadline.
+
+    Functions already in fetched, e.g. the history of a checkpoint, are
+    skipped and every fetched chunk is added to it. With more than one shard
+    the shard workers go first and the functions of shards that did not
+    finish are fetched here. A chunk is only started when the longest chunk
+    so far still fits before the deadline, and at least one runs per
+    invocation so every continuation makes progress. Returns the history of
+    all functions, None when the deadline came first.
+    """
+    remaining = [function for function in functions if function.name not in fetched]
+    if len(remaining) < len(functions):
+        print(
+            f"Resuming from checkpoint, history of {len(functions) - len(remaining)} "
+            "functions already fetched"
+        )
+    backend = history_backend or Config.HISTORY_BACKEND
+    progressed = False
+    if shard_count > 1 and remaining:
+        if backend == HistoryBackends.CONFIG_HISTORY:
+            fetched.update(
+                collect_sharded_history(
+                    inspector,
+                    remaining,
+                    shard_count,
+                    earlier_days,
+                    later_days,
+                    history_backend,
+                    deadline,
+                )
+            )
+            left = [function for function in remaining if function.name not in fetched]
+            progressed = len(left) < len(remaining)
+            remaining = left
+            if remaining:
+                print(f"Fetching history of {len(remaining)} functions left by shards")
+        else:
+            print(f"History backend {backend} reads the whole account, not sharded")
+
+    chunk_size = Config.HISTORY_CHUNK_SIZE
+    if backend in (HistoryBackends.CONFIG_SELECT, HistoryBackends.SNAPSHOT_LOG):
+        # These read the whole account or log at once, chunks would repeat them
+        chunk_size = max(1, len(remaining))
+    longest = 0.0
+    for start in range(0, len(remaining), chunk_size):
+        if (
+            (start or progressed)
+            and deadline is not None
+            and time.time() + longest > deadline
+        ):
+            print(
+                f"Stopping before the invocation deadline, history of "
+                f"{len(remaining) - start} functions left"
+            )
+            return None
+        started = time.time()
+        fetched.update(
+            inspector.get_tags_history_batch(
+                remaining[start : start + chunk_size],
+                earlier_days,
+                later_days,
+                backend=history_backend,
+            )
+        )
+        longest = max(longest, time.time() - started)
+    return fetched
+
+
+def shard_of(function_name: str, shard_count: int) -> int:
+    """Shard of a function, stable across processes, runs and Python versions."""
+    return zlib.crc32(function_name.encode()) % shard_count
+
+
+def fetch_shard_history(
+    shard: int,
+    shard_count: int,
+    functions: List[List],
+    earlier_days: float,
+    later_days: float,
+    history_backend: str = None,
+    watermarks: Optional[Dict[str, Dict]] = None,
+) -> Dict[str, Dict]:
+    """Worker side of a sharded run: the history of one shard's functions.
+
+    functions are [name, arn, tags] entries, watermarks the coordinator's
+    history watermark entries of these functions, None when it keeps none.
+    The worker has its own inspector and scans from the given watermarks, so
+    a sharded run fetches exactly what a single-process run would. Returns
+    {"history": function name -> [app_versions, terraform_versions],
+    "watermarks": the updated entries, None without watermarks}.
+    """
+    session = boto3.Session()
+    store = None
+    if watermarks is not None:
+        store = MemoryStateStore(
+            {StateNames.HISTORY_WATERMARKS: {"functions": watermarks}}
+        )
+    inspector = LambdaInspector(state_store=store, session=session)
+    try:
+        history = inspector.get_tags_history_batch(
+            [
+                LambdaFunction(name=name, arn=arn, tags=tags)
+                for name, arn, tags in functions
+            ],
+            earlier_days,
+            later_days,
+            backend=history_backend,
+        )
+    finally:
+        inspector.executor.shutdown()
+    return {
+        "history": {
+            name: [sorted(app_versions), sorted(terraform_versions)]
+            for name, (app_versions, terraform_versions) in history.items()
+        },
+        "watermarks": (
+            inspector.history_watermarks.functions if store is not None else None
+        ),
+    }
+
+
+def _shard_pool(workers: int) -> "ProcessPoolExecutor":
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Spawned, not forked, the parent already runs AWS API threads
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _run_shards_locally(
+    shards: Dict[int, Dict], shard_count: int, params: Dict[str, Any]
+) -> Dict[int, Dict[str, Dict]]:
+    """Run the shard workers in a local process pool."""
+    results = {}
+    with _shard_pool(len(shards)) as pool:
+        futures = {
+            pool.submit(
+                fetch_shard_history, shard, shard_count, **shard_input, **params
+            ): shard
+            for shard, shard_input in shards.items()
+        }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print(f"Error in history shard {futures[future]}: {e}")
+    return results
+
+
+def _run_shards_on_lambda(
+    inspector: LambdaInspector,
+    shards: Dict[int, Dict],
+    shard_count: int,
+    params: Dict[str, Any],
+    deadline: Optional[float],
+) -> Dict[int, Dict[str, Dict]]:
+    """Run the shard workers as asynchronous invocations of SHARD_WORKER_FUNCTION.
+
+    Shard inputs and results go through the state store, results are polled
+    until SHARD_TIMEOUT_SECONDS or the deadline. The run's documents are
+    deleted once the results are read.
+    """
+    run_id = uuid.uuid4().hex
+    scopes = {}
+    for shard, shard_input in shards.items():
+        scopes[shard] = ScopedStateStore(
+            inspector.state_store, f"{Config.SHARD_RUNS_SCOPE}/{run_id}/{shard}"
+        )
+        try:
+            # Async invoke payloads are limited to 256 KB, the functions go through the store
+            scopes[shard].save(StateNames.SHARD_INPUT, shard_input)
+            inspector.lambda_client.invoke(
+                FunctionName=Config.SHARD_WORKER_FUNCTION,
+                InvocationType="Event",
+                Payload=json.dumps(
+                    {
+                        "shard_run": run_id,
+                        "shard": shard,
+                        "shards": shard_count,
+                        **params,
+                    }
+                ),
+            )
+        except Exception as e:
+            print(f"Error starting history shard {shard}: {e}")
+            del scopes[shard]
+
+    started = dict(scopes)
+    wait_until = time.time() + Config.SHARD_TIMEOUT_SECONDS
+    if deadline is not None:
+        wait_until = min(wait_until, deadline)
+    results = {}
+    while scopes:
+        for shard in list(scopes):
+            data = scopes[shard].load(StateNames.SHARD_RESULT)
+            if data is not None:
+                results[shard] = data
+                del scopes[shard]
+        if not scopes or time.time() >= wait_until:
+            break
+        time.sleep(Config.SHARD_POLL_SECONDS)
+    if scopes:
+        print(f"History shards {sorted(scopes)} did not finish in time")
+    for scope in started.values():
+        for name in (StateNames.SHARD_INPUT, StateNames.SHARD_RESULT):
+            try:
+                scope.delete(name)
+            except Exception as e:
+                print(f"Error deleting {scope.scope}/{name}: {e}")
+    return results
+
+
+def collect_sharded_history(
+    inspector: LambdaInspector,
+    functions: List[LambdaFunction],
+    shard_count: int,
+    earlier_days: float,
+    later_days: float,
+    history_backend: str = None,
+    deadline: float = None,
+) -> Dict[str, Tuple[Set[str], Set[str]]]:
+    """Fetch history in parallel shard workers and merge their version sets.
+
+    Functions are split by shard_of their name. Workers are asynchronous
+    invocations of SHARD_WORKER_FUNCTION when it is set (inside Lambda it
+    defaults to the running function) and a state store is available, local
+    processes otherwise. Workers get the coordinator's history watermarks of
+    their functions and hand back the updated ones, which are merged into
+    it, so the shard count never restarts the incremental history. Returns
+    the history of the shards that finished, the terraformTag rollups are
+    built from the merged result afterwards.
+    """
+    watermarks = inspector.history_watermarks
+    shards: Dict[int, Dict] = {}
+    for function in functions:
+        shard_input = shards.setdefault(
+            shard_of(function.name, shard_count),
+            {"functions": [], "watermarks": {} if watermarks is not None else None},
+        )
+        shard_input["functions"].append([function.name, function.arn, function.tags])
+        if watermarks is not None and function.name in watermarks.functions:
+            shard_input["watermarks"][function.name] = watermarks.functions[
+                function.name
+            ]
+    params = dict(
+        earlier_days=earlier_days,
+        later_days=later_days,
+        history_backend=history_backend,
+    )
+    print(f"Fetching history in {len(shards)} shards")
+    if Config.SHARD_WORKER_FUNCTION and inspector.state_store is not None:
+        results = _run_shards_on_lambda(
+            inspector, shards, shard_count, params, deadline
+        )
+    elif Config.SHARD_WORKER_FUNCTION:
+        print("Sharded runs on Lambda need a state store, fetching history here")
+        results = {}
+    else:
+        results = _run_shards_locally(shards, shard_count, params)
+
+    merged = {}
+    for result in results.values():
+        for name, (app_versions, terraform_versions) in result["history"].items():
+            merged[name] = (set(app_versions), set(terraform_versions))
+        if watermarks is not None and result.get("watermarks"):
+            watermarks.merge(result["watermarks"])
+    if watermarks is not None and results:
+        watermarks.save()
+    return merged
+
+
+def resolve_regions(session) -> List[str]:
+    """Regions listed in Config.INSPECTOR_REGIONS, empty for the current region only."""
+    setting = Config.INSPECTOR_REGIONS.strip()
+    if not setting:
+        return []
+    if setting == "all":
+        # Without AllRegions, DescribeRegions only returns the enabled regions
+        regions = create_client(session, "ec2").describe_regions()["Regions"]
+        return sorted(region["RegionName"] for region in regions)
+    return [region.strip() for region in setting.split(",") if region.strip()]
+
+
+def region_time_budget(region: str) -> Optional[float]:
+    """Seconds a region may take, None for no limit."""
+    for pair in Config.REGION_TIME_BUDGETS.split(","):
+        name, _, seconds = pair.partition("=")
+        if name.strip() == region and seconds.strip():
+            return float(seconds)
+    if Config.REGION_TIME_BUDGET_SECONDS:
+        return float(Config.REGION_TIME_BUDGET_SECONDS)
+    return None
+
+
+def resolve_accounts(session) -> List[str]:
+    """Accounts listed in Config.INSPECTOR_ACCOUNT_IDS, empty for this account only."""
+    setting = Config.INSPECTOR_ACCOUNT_IDS.strip()
+    if not setting:
+        return []
+    if setting == "organization":
+        paginator = create_client(session, "organizations").get_paginator(
+            "list_accounts"
+        )
+        return sorted(
+            account["Id"]
+            for page in paginator.paginate()
+            for account in page["Accounts"]
+            if account.get("Status") == "ACTIVE"
+        )
+    return [account.strip() for account in setting.split(",") if account.strip()]
+
+
+def resolve_targets(session) -> List[InspectionTarget]:
+    """Account/region pairs to inspect, empty for the current account and region only.
+
+    Targets are interleaved by account, so every account starts before any
+    account gets its second region.
+    """
+    regions = resolve_regions(session) or [None]
+    accounts = resolve_accounts(session) or [None]
+    if regions == [None] and accounts == [None]:
+        return []
+    return [
+        InspectionTarget(account_id=account, region=region)
+        for region in regions
+        for account in accounts
+    ]
+
+
+def target_time_budget(target: InspectionTarget) -> Optional[float]:
+    """Seconds a target may take, the tighter of its region and account budgets."""
+    budgets = []
+    if target.region:
+        budgets.append(region_time_budget(target.region))
+    if target.account_id and Config.ACCOUNT_TIME_BUDGET_SECONDS:
+        budgets.append(float(Config.ACCOUNT_TIME_BUDGET_SECONDS))
+    budgets = [budget for budget in budgets if budget is not None]
+    return min(budgets) if budgets else None
+
+
+class TargetInspectors:
+    """Inspectors of the account/region targets, kept while the container is warm.
+
+    A run checks an inspector out and only returns it once it finished in
+    time, so a target still running from a skipped run never shares its
+    inspector. Inspectors of an assumed role are rebuilt once its credentials
+    are renewed. All of them submit their API calls to one thread pool.
+    """
+
+    def __init__(self, pool: ThreadPoolExecutor = None):
+        self.pool = pool
+        # target -> (credentials the session was built from, inspector)
+        self._idle: Dict[InspectionTarget, Tuple[Optional[Dict], LambdaInspector]] = {}
+        self._lock = threading.Lock()
+
+    def checkout(
+        self,
+        target: InspectionTarget,
+        state_store,
+        sessions: AssumedRoleSessions,
+        cancelled: threading.Event = None,
+    ) -> Tuple[Optional[Dict], LambdaInspector]:
+        credentials = None
+        if target.account_id:
+            credentials = sessions.credentials(target.account_id)
+        with self._lock:
+            idle = self._idle.pop(target, None)
+        if idle is not None and idle[0] is credentials:
+            inspector = idle[1]
+            inspector.telemetry.reset()
+            if isinstance(inspector.state_store, CancellableStateStore):
+                inspector.state_store.cancelled = cancelled
+            return credentials, inspector
+
+        session = None
+        if target.account_id:
+            session = sessions.session(target.account_id, target.region)
+        if state_store:
+            state_store = ScopedStateStore(state_store, target.label)
+            if cancelled is not None:
+                state_store = CancellableStateStore(state_store, cancelled)
+        inspector = LambdaInspector(
+            state_store=state_store,
+            region_name=target.region,
+            session=session,
+            account_id=target.account_id,
+            executor=AdaptiveExecutor(pool=self.pool) if self.pool else None,
+        )
+        return credentials, inspector
+
+    def checkin(
+        self,
+        target: InspectionTarget,
+        credentials: Optional[Dict],
+        inspector: LambdaInspector,
+    ) -> None:
+        with self._lock:
+            self._idle[target] = (credentials, inspector)
+
+
+def _collect_target_metrics(
+    target: InspectionTarget,
+    state_store,
+    sessions: AssumedRoleSessions,
+    telemetry: RunTelemetry = None,
+    cancelled: threading.Event = None,
+    inspectors: TargetInspectors = None,
+    **kwargs,
+) -> List[MetricsData]:
+    inspectors = inspectors or TargetInspectors()
+    credentials, inspector = inspectors.checkout(
+        target, state_store, sessions, cancelled
+    )
+    try:
+        return collect_metrics(inspector, **kwargs)
+    finally:
+        # A cancelled target's telemetry would land in another run, and its
+        # inspector may still be running
+        if not (cancelled and cancelled.is_set()):
+            if telemetry is not None:
+                telemetry.merge(inspector.telemetry)
+            inspectors.checkin(target, credentials, inspector)
+
+
+def collect_metrics_by_target(
+    targets: List[InspectionTarget],
+    state_store=None,
+    sessions: AssumedRoleSessions = None,
+    deadline: float = None,
+    telemetry: RunTelemetry = None,
+    inspectors: TargetInspectors = None,
+    **kwargs,
+) -> List[MetricsData]:
+    """Inspect several accounts and regions concurrently, each within its own time budget.
+
+    Every target gets its own inspector from inspectors, so clients and
+    concurrency limits are per account and region, while their API calls
+    share one thread pool. Without inspectors, they are built for this sweep
+    only. Targets exceeding their
+    budget, or still running at the deadline (epoch seconds), are skipped for
+    this run so one slow account never holds up the others, and are cancelled
+    so they no longer save state or telemetry once they finish. The phases
+    and API calls of finished targets are added to telemetry.
+    """
+    started = time.time()
+    cancelled = threading.Event()
+    sweep_pool = None
+    if inspectors is None:
+        sweep_pool = ThreadPoolExecutor(
+            max_workers=max([Config.MAX_WORKERS_AWS, *API_MAX_CONCURRENCY.values()])
+        )
+        inspectors = TargetInspectors(sweep_pool)
+    workers = Config.MAX_PARALLEL_REGIONS
+    if any(target.account_id for target in targets):
+        workers = max(workers, Config.MAX_PARALLEL_ACCOUNTS)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(len(targets), workers)))
+    target_futures = {
+        target: executor.submit(
+            _collect_target_metrics,
+            target,
+            state_store,
+            sessions,
+            telemetry,
+            cancelled,
+            inspectors,
+            **kwargs,
+        )
+        for target in targets
+    }
+
+    all_metrics = []
+    for target, future in target_futures.items():
+        budget = target_time_budget(target)
+        limits = [] if budget is None else [started + budget]
+        if deadline is not None:
+            limits.append(deadline)
+        timeout = max(0, min(limits) - time.time()) if limits else None
+        try:
+            metrics = future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            print(f"Target {target.label} ran out of time, skipped")
+            continue
+        except Exception as e:
+            print(f"Error inspecting {target.label}: {e}")
+            continue
+        print(f"Target {target.label}: {len(metrics)} metrics")
+        all_metrics.extend(metrics)
+
+    # Do not wait for targets that ran out of time
+    cancelled.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+    if sweep_pool is not None:
+        sweep_pool.shutdown(wait=False)
+    return all_metrics
+
+
+def _publish_due(
+    inspector: LambdaInspector, scheduler: Optional[PublishScheduler], metrics
+) -> PublishResult:
+    """Publish the metrics whose series are due and record them in the scheduler."""
+    metrics_to_publish = metrics
+    if scheduler is not None:
+        # Skip unchanged series that are not due for a keepalive datapoint
+        metrics_to_publish = scheduler.due(metrics)
+        print(
+            f"Skipping {len(metrics) - len(metrics_to_publish)} unchanged series "
+            "not due for keepalive"
+        )
+
+    # Publish all metrics in batches
+    print(f"Publishing {len(metrics_to_publish)} metrics in batches...")
+    with inspector.telemetry.phase(Phases.PUBLISH):
+        result = inspector.metric_sink.publish(metrics_to_publish)
+    if scheduler is not None:
+        scheduler.mark_published(result.published)
+    return result
+
+
+def _flush_sink(
+    inspector: LambdaInspector, scheduler: Optional[PublishScheduler]
+) -> PublishResult:
+    """Deliver what the metric sink still buffers at the end of a run."""
+    with inspector.telemetry.phase(Phases.PUBLISH):
+        result = inspector.metric_sink.flush()
+    if scheduler is not None:
+        scheduler.mark_published(result.published)
+    return result
+
+
+def _publish_until(
+    inspector: LambdaInspector,
+    scheduler: Optional[PublishScheduler],
+    metrics: List[MetricsData],
+    deadline: Optional[float],
+) -> Tuple[PublishResult, List[MetricsData]]:
+    """Publish metrics in chunks of PUBLISH_CHUNK_SIZE until the deadline.
+
+    Returns the publish result and the metrics left for a follow-up run.
+    """
+    result = PublishResult()
+    longest = 0.0
+    for start in range(0, max(len(metrics), 1), Config.PUBLISH_CHUNK_SIZE):
+        if start and deadline is not None and time.time() + longest > deadline:
+            print(
+                f"Stopping before the invocation deadline, {len(metrics) - start} "
+                "metrics left to publish"
+            )
+            return result, metrics[start:]
+        started = time.time()
+        result.merge(
+            _publish_due(
+                inspector, scheduler, metrics[start : start + Config.PUBLISH_CHUNK_SIZE]
+            )
+        )
+        longest = max(longest, time.time() - started)
+    return result, []
+
+
+def build_self_metrics(
+    summary: Dict[str, Any], duration_ms: float
+) -> List[MetricsData]:
+    """Inspector self-metrics of one run, from its RunTelemetry summary."""
+    milliseconds = "Milliseconds"
+    metrics = [MetricsData(MetricNames.RUN_DURATION, [], duration_ms, milliseconds)]
+    for phase, elapsed_ms in summary["phases_ms"].items():
+        metrics.append(
+            MetricsData(
+                MetricNames.PHASE_DURATION,
+                [_dimension(DimensionNames.PHASE, phase)],
+                elapsed_ms,
+                milliseconds,
+            )
+        )
+    for api, stats in summary["apis"].items():
+        api_dimension = _dimension(DimensionNames.API, api)
+        for metric_name, key in (
+            (MetricNames.API_CALLS, "calls"),
+            (MetricNames.API_THROTTLES, "throttles"),
+            (MetricNames.API_RETRIES, "retries"),
+        ):
+            metrics.append(
+                MetricsData(
+                    metric_name, [api_dimension], stats[key], Config.METRIC_UNIT
+                )
+            )
+        for percentile, latency_ms in stats["latency_ms"].items():
+            metrics.append(
+                MetricsData(
+                    MetricNames.API_LATENCY,
+                    [api_dimension, _dimension(DimensionNames.PERCENTILE, percentile)],
+                    latency_ms,
+                    milliseconds,
+                )
+            )
+    return metrics
+
+
+def publish_self_metrics(
+    inspector: LambdaInspector, metrics: List[MetricsData]
+) -> None:
+    """Send self-metrics through the metric sink, bypassing the keepalive scheduler.
+
+    Buffering sinks deliver them with the run's final flush. A failure is
+    logged only, the run's own metrics are already delivered.
+    """
+    try:
+        inspector.metric_sink.publish(metrics)
+    except Exception as e:
+        print(f"Error publishing inspector self-metrics: {e}")
+        return
+    print(f"Sent {len(metrics)} inspector self-metrics to the metric sink")
 
-    def extract_service_info(self, function: LambdaFunction) -> ServiceInfo:
-        tags = function.tags
-        stack = tags.get(TagNames.STACK, Config.UNKNOWN_VALUE)
-        service = tags.get(TagNames.SERVICE, stack)
-        env = tags.get(TagNames.ENVIRONMENT, Config.UNKNOWN_VALUE)
-        terraform = tags.get(TagNames.TERRAFORM_VERSION, Config.UNKNOWN_VALUE)
 
-        return ServiceInfo(
-            env=env, service=service, stack=stack, terraform_version=terraform
-        )
+_STAGE_DONE = object()
 
-    def get_resource_history_tags(
-        self,
-        resource_id: str,
-        resource_type: str,
-        earlier_days: float,
-        later_days: float,
-    ) -> List[Dict]:
-        """Get the configuration history for a specific resource from AWS Config."""
-        try:
-            paginator = self.config_client.get_paginator("get_resource_config_history")
-            history_tags = []
-            earlier_days_ago = datetime.now() - timedelta(days=earlier_days)
-            later_days_ago = datetime.now() - timedelta(days=later_days)
 
-            # Convert to UTC and format as required by AWS Config
-            earlier_time_utc = earlier_days_ago.astimezone().isoformat()
-            later_time_utc = later_days_ago.astimezone().isoformat()
-
-            for page in paginator.paginate(
-                resourceType=resource_type,
-                resourceId=resource_id,
-                earlierTime=earlier_time_utc,
-                laterTime=later_time_utc,
-                limit=Config.CONFIG_HISTORY_LIMIT,
-            ):
-                configuration_items = page.get("configurationItems", [])
-                for item in configuration_items:
-                    if item.get("tags") and item["tags"] != {}:
-                        history_tags.append(item["tags"])
+def _pipeline_source(items: Iterable, outbox: queue.Queue, errors: List) -> None:
+    """First pipeline stage, feeds items until they run out or a stage failed."""
+    try:
+        for item in items:
+            if errors:
+                break
+            outbox.put(item)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        outbox.put(_STAGE_DONE)
 
-            return history_tags
+
+def _pipeline_stage(
+    work: Callable[[Any], Iterable],
+    inbox: queue.Queue,
+    outbox: queue.Queue,
+    errors: List,
+) -> None:
+    """Pipeline stage, forwards what work yields for each inbox item.
+
+    After a failure the inbox is still drained, so upstream stages never
+    block on a full queue.
+    """
+    while True:
+        item = inbox.get()
+        if item is _STAGE_DONE:
+            break
+        if errors:
+            continue
+        try:
+            for result in work(item):
+                outbox.put(result)
         except Exception as e:
-            print(f"Error getting resource history for {resource_id}: {e}")
-            return []
+            errors.append(e)
+    outbox.put(_STAGE_DONE)
 
-    def _get_single_function_history(
-        self, function: LambdaFunction, earlier_days: float, later_days: float
-    ) -> Tuple[str, Set[str], Set[str]]:
-        """Get history for a single function. Returns (function_name, app_versions, terraform_versions)."""
-        app_versions = set()
-        terraform_versions = set()
-        history_tags = self.get_resource_history_tags(
-            function.name,
-            Config.AWS_LAMBDA_FUNCTION_RESOURCE_TYPE,
-            earlier_days,
-            later_days,
-        )
 
-        # Only process configuration items that have tags AppVersion and TerraformVersion
-        for tags in history_tags:
-            if TagNames.APP_VERSION in tags:
-                app_versions.add(tags[TagNames.APP_VERSION])
-            if TagNames.TERRAFORM_VERSION in tags:
-                terraform_versions.add(tags[TagNames.TERRAFORM_VERSION])
+def stream_metrics(
+    inspector: LambdaInspector,
+    scheduler: Optional[PublishScheduler] = None,
+    use_aws_config: bool = False,
+    earlier_days: float = Config.FULL_HISTORY_EARLIER_DAYS,
+    later_days: float = 0,
+    history_backend: str = None,
+    exporter: SnapshotExporter = None,
+) -> Tuple[PublishResult, int, int, Set[str]]:
+    """Publish metrics while later list_functions pages are still being fetched.
 
-        return function.name, app_versions, terraform_versions
+    Pages flow through bounded queues from listing to tag lookup, metric
+    build (with history) and publishing, each stage on its own thread, so
+    API latency of one stage overlaps with the work of the next and only a
+    few pages are held in memory. A batch is published once it is full or
+    no more metrics are ready. Returns the publish result, without the
+    published metrics, the lambda and terraform metric counts and the keys
+    of the series emitted. The caller flushes the sink and saves the
+    scheduler at the end of the run.
+    """
+    snapshot = inspector._load_snapshot()
+    if Config.TAG_DISCOVERY_MODE == DiscoveryModes.TAGGING:
+        # Each page would page through the whole account's GetResources
+        print("TAG_DISCOVERY_MODE=tagging only applies to batch runs, using ListTags")
+    entries: Dict[str, List] = {}
+    records: Dict[str, LambdaFunction] = {}
+    seen_terraform: Set[Tuple[ServiceInfo, str]] = set()
+    totals = {"functions": 0, "fetched": 0}
+    errors: List[Exception] = []
 
-    def get_tags_history_batch(
-        self, functions: List[LambdaFunction], earlier_days: float, later_days: float
-    ) -> Dict[str, Tuple[Set[str], Set[str]]]:
-        """Get history for multiple functions in parallel. Returns dict of function_name -> (app_versions, terraform_versions)."""
-        results = {}
+    def resolve(page):
+        functions, fetched = inspector.resolve_functions(
+            page, snapshot, entries, records, bulk=False
+        )
+        totals["functions"] += len(page)
+        totals["fetched"] += fetched
+        if functions:
+            yield functions
 
-        with ThreadPoolExecutor(max_workers=Config.MAX_WORKERS_AWS) as executor:
-            # Submit all history fetching tasks
-            future_to_function = {
-                executor.submit(
-                    self._get_single_function_history, func, earlier_days, later_days
-                ): func
-                for func in functions
-            }
+    # Account-wide backend reads, shared by all pages of the run
+    run_cache: Dict[str, Any] = {}
 
-            # Process completed tasks
-            for future in as_completed(future_to_function):
-                try:
-                    function_name, app_versions, terraform_versions = future.result()
-                    results[function_name] = (app_versions, terraform_versions)
-                except Exception as e:
-                    function = future_to_function[future]
-                    print(f"Error getting history for function {function.name}: {e}")
-                    results[function.name] = (set(), set())
+    def build(functions):
+        history_results = {}
+        if use_aws_config:
+            with inspector.telemetry.phase(Phases.HISTORY_FETCH):
+                history_results = inspector.get_tags_history_batch(
+                    functions,
+                    earlier_days,
+                    later_days,
+                    backend=history_backend,
+                    run_cache=run_cache,
+                    save_watermarks=False,
+                )
+        metrics = []
+        with inspector.telemetry.phase(Phases.METRIC_BUILD):
+            for function in functions:
+                lambda_metrics, terraform_metrics = build_function_metrics(
+                    inspector,
+                    function,
+                    history_results.get(function.name),
+                    seen_terraform,
+                    exporter,
+                )
+                metrics.extend(lambda_metrics)
+                metrics.extend(terraform_metrics)
+        yield metrics
 
-        return results
+    pages = queue.Queue(Config.PIPELINE_QUEUE_SIZE)
+    functions = queue.Queue(Config.PIPELINE_QUEUE_SIZE)
+    metrics = queue.Queue(Config.PIPELINE_QUEUE_SIZE)
+    threads = [
+        threading.Thread(
+            target=_pipeline_source,
+            args=(inspector.list_function_pages(), pages, errors),
+        ),
+        threading.Thread(
+            target=_pipeline_stage, args=(resolve, pages, functions, errors)
+        ),
+        threading.Thread(
+            target=_pipeline_stage, args=(build, functions, metrics, errors)
+        ),
+    ]
+    for thread in threads:
+        thread.start()
 
-    def publish_metrics(
-        self, metric_name: str, dimensions: List[Dict[str, str]], value: float
-    ) -> None:
-        metric_data = MetricsData(
-            metric_name=metric_name,
-            dimensions=dimensions,
-            value=value,
-            unit=Config.METRIC_UNIT,
-        )
+    result = PublishResult()
+    published = 0
+    series: Set[str] = set()
+    counts = {MetricNames.LAMBDA_TAG: 0, MetricNames.TERRAFORM_TAG: 0}
+    pending: List[MetricsData] = []
+
+    def flush():
+        nonlocal published
+        for metric in pending:
+            counts[metric.metric_name] += 1
+            if scheduler is not None:
+                series.add(scheduler.series_key(metric))
+        chunk = _publish_due(inspector, scheduler, pending)
+        published += len(chunk.published)
+        result.rejected.extend(chunk.rejected)
+        result.calls += chunk.calls
+        pending.clear()
 
+    # Publishing runs on this thread as the last stage
+    while True:
+        item = metrics.get()
+        if item is _STAGE_DONE:
+            break
+        if errors:
+            continue
+        pending.extend(item)
         try:
-            self.cloudwatch_client.put_metric_data(
-                Namespace=CLOUDWATCH_NAMESPACE,
-                MetricData=[metric_data.to_cloudwatch_format()],
-            )
-            print(f"Published metric for {metric_name} {dimensions} {value}")
+            if len(pending) >= Config.CW_BATCH_SIZE or metrics.empty():
+                flush()
         except Exception as e:
-            print(
-                f"Error publishing metric for {metric_name} {dimensions} {value}: {e}"
-            )
+            errors.append(e)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    if pending:
+        flush()
 
-    def publish_metrics_batch(self, metrics: List[MetricsData]) -> None:
-        """Publish multiple metrics in batches to CloudWatch."""
-        if not metrics:
-            return
+    print(f"Total functions found: {totals['functions']}")
+    inspector.commit_functions(
+        snapshot, entries, records, totals["functions"], totals["fetched"]
+    )
+    watermarks = inspector.backend_watermarks(history_backend)
+    if use_aws_config and watermarks is not None:
+        # Pages only record their watermarks, they are saved once per run
+        watermarks.save()
+        watermarks.prune(function.name for function in records.values())
+    print(
+        f"Published {published} metrics in {result.calls} calls, "
+        f"{len(result.rejected)} rejected"
+    )
+    return (
+        result,
+        counts[MetricNames.LAMBDA_TAG],
+        counts[MetricNames.TERRAFORM_TAG],
+        series,
+    )
 
-        # Split metrics into batches of CW_BATCH_SIZE
-        for i in range(0, len(metrics), Config.CW_BATCH_SIZE):
-            batch = metrics[i : i + Config.CW_BATCH_SIZE]
-            metric_data = [metric.to_cloudwatch_format() for metric in batch]
 
-            try:
-                self.cloudwatch_client.put_metric_data(
-                    Namespace=CLOUDWATCH_NAMESPACE,
-                    MetricData=metric_data,
-                )
-                print(f"Published batch of {len(batch)} metrics")
-            except Exception as e:
-                print(f"Error publishing batch of {len(batch)} metrics: {e}")
-                # Fallback to individual publishing for this batch
-                for metric in batch:
-                    try:
-                        self.cloudwatch_client.put_metric_data(
-                            Namespace=CLOUDWATCH_NAMESPACE,
-                            MetricData=[metric.to_cloudwatch_format()],
-                        )
-                        print(f"Published individual metric for {metric.metric_name}")
-                    except Exception as individual_error:
-                        print(
-                            f"Error publishing individual metric {metric.metric_name}: {individual_error}"
-                        )
+# Inspector of this container, reused by warm invocations
+_inspector: Optional[LambdaInspector] = None
+_inspector_lock = threading.Lock()
 
 
-def create_lambda_dimensions(
-    service_info: ServiceInfo, function_name: str, app_version: str
-) -> List[Dict[str, str]]:
-    """Create dimensions for lambda metrics."""
-    return [
-        {"Name": DimensionNames.ENV, "Value": service_info.env},
-        {"Name": DimensionNames.STACK, "Value": service_info.stack},
-        {"Name": DimensionNames.SERVICE, "Value": service_info.service},
-        {"Name": DimensionNames.FUNCTION_NAME, "Value": function_name},
-        {"Name": DimensionNames.APP_VERSION, "Value": app_version},
-    ]
+@dataclass
+class StartInfo:
+    """Whether an invocation found a warm inspector, and what creating it cost.
 
+    checkpointed is set by publish_metrics when the run stopped before its
+    deadline and left a checkpoint for a follow-up invocation.
+    """
 
-def create_terraform_dimensions(
-    service_info: ServiceInfo, terraform_version: str
-) -> List[Dict[str, str]]:
-    """Create dimensions for terraform metrics."""
-    return [
-        {"Name": DimensionNames.ENV, "Value": service_info.env},
-        {"Name": DimensionNames.STACK, "Value": service_info.stack},
-        {"Name": DimensionNames.SERVICE, "Value": service_info.service},
-        {"Name": DimensionNames.TERRAFORM_VERSION, "Value": terraform_version},
-    ]
+    warm: bool
+    invocation: int
+    init_ms: float
+    checkpointed: bool = False
 
 
-def publish_lambda_metric(
-    inspector: LambdaInspector,
-    service_info: ServiceInfo,
-    function_name: str,
-    app_version: str,
-    value: float = 1,
-) -> None:
-    """Publish a lambda metric with proper dimensions."""
-    dimensions = create_lambda_dimensions(service_info, function_name, app_version)
-    inspector.publish_metrics(MetricNames.LAMBDA_TAG, dimensions, value)
+def get_inspector() -> Tuple[LambdaInspector, StartInfo]:
+    """The container's inspector, created on the first (cold) invocation.
 
+    Warm invocations reuse its session, clients, connection pools, discovery
+    caches and concurrency limits.
+    """
+    global _inspector
+    with _inspector_lock:
+        warm = _inspector is not None
+        if not warm:
+            started = time.perf_counter()
+            _inspector = LambdaInspector()
+            _inspector.init_ms = (time.perf_counter() - started) * 1000
+            _inspector.invocations = 0
+        _inspector.invocations += 1
+        start = StartInfo(
+            warm=warm,
+            invocation=_inspector.invocations,
+            init_ms=0.0 if warm else _inspector.init_ms,
+        )
+    if warm:
+        print(f"Warm start: reusing inspector (invocation {start.invocation})")
+    else:
+        print(f"Cold start: inspector initialised in {start.init_ms:.1f} ms")
+    return _inspector, start
 
-def publish_terraform_metric(
-    inspector: LambdaInspector,
-    service_info: ServiceInfo,
-    terraform_version: str,
-    value: float = 1,
-) -> None:
-    """Publish a terraform metric with proper dimensions."""
-    dimensions = create_terraform_dimensions(service_info, terraform_version)
-    inspector.publish_metrics(MetricNames.TERRAFORM_TAG, dimensions, value)
+
+def reset_inspector() -> None:
+    """Drop the cached inspector, the next invocation starts cold."""
+    global _inspector
+    with _inspector_lock:
+        _inspector = None
 
 
 def publish_metrics(
     use_aws_config: bool = False,
     earlier_days: float = Config.FULL_HISTORY_EARLIER_DAYS,
     later_days: float = 0,
-):
-    inspector = LambdaInspector()
-    functions = inspector.get_all_functions()
-    service_terraform_versions: Dict[ServiceInfo, Set[str]] = {}
+    history_backend: str = None,
+    deadline: float = None,
+) -> StartInfo:
+    """Inspect, build and publish the metrics of one run.
 
-    lambda_metrics_count = 0
-    terraform_metrics_count = 0
-
-    all_metrics = []
-    history_results = {}
-    if use_aws_config:
-        print("Fetching history for all functions in parallel...")
-        history_results = inspector.get_tags_history_batch(
-            functions, earlier_days, later_days
+    With a deadline (epoch seconds) and a state store, a single-account batch
+    run checkpoints its progress before the deadline instead of running into
+    the invocation timeout, and the next run with the same parameters resumes
+    from the checkpoint. Multi-target runs skip the targets still running at
+    the deadline, streaming runs ignore it.
+    """
+    started = time.perf_counter()
+    inspector, start = get_inspector()
+    inspector.telemetry.reset()
+    scheduler = (
+        inspector.history_publish_scheduler
+        if use_aws_config
+        else inspector.publish_scheduler
+    )
+    collect_kwargs = dict(
+        use_aws_config=use_aws_config,
+        earlier_days=earlier_days,
+        later_days=later_days,
+        history_backend=history_backend,
+    )
+    targets = inspector.targets
+    streaming = Config.PIPELINE_MODE == PipelineModes.STREAMING
+    exporter = build_snapshot_exporter(inspector)
+    checkpoint = None
+    if deadline is not None and inspector.state_store is not None:
+        if not targets and not streaming:
+            checkpoint = RunCheckpoint(inspector.state_store, collect_kwargs)
+    # Series whose scheduler state is kept once the sink is flushed
+    series = None
+    if not targets and streaming:
+        result, lambda_metrics_count, terraform_metrics_count, series = stream_metrics(
+            inspector, scheduler, exporter=exporter, **collect_kwargs
         )
+    else:
+        if targets:
+            print(f"Inspecting {', '.join(target.label for target in targets)}")
+            sessions = None
+            if any(target.account_id for target in targets):
+                sessions = inspector.assumed_role_sessions
+            all_metrics = collect_metrics_by_target(
+                targets,
+                inspector.state_store,
+                sessions,
+                deadline=deadline,
+                telemetry=inspector.telemetry,
+                inspectors=inspector.target_inspectors,
+                exporter=exporter,
+                **collect_kwargs,
+            )
+        elif checkpoint is not None and checkpoint.unpublished:
+            print(
+                f"Resuming from checkpoint, {len(checkpoint.unpublished)} metrics "
+                "left to publish"
+            )
+            all_metrics = checkpoint.unpublished
+        else:
+            all_metrics = collect_metrics(
+                inspector,
+                checkpoint=checkpoint,
+                deadline=deadline,
+                shard_count=Config.SHARD_COUNT,
+                exporter=exporter,
+                **collect_kwargs,
+            )
 
-    for function in functions:
-        service_info = inspector.extract_service_info(function)
-
-        app_versions = {function.tags[TagNames.APP_VERSION]}
-        terraform_versions = {function.tags[TagNames.TERRAFORM_VERSION]}
-
-        if use_aws_config and function.name in history_results:
-            app_versions_history, terraform_versions_history = history_results[
-                function.name
-            ]
-            app_versions.update(app_versions_history)
-            terraform_versions.update(terraform_versions_history)
+        resumed = checkpoint is not None and all_metrics is checkpoint.unpublished
+        if all_metrics is None:
+            # History is incomplete, metrics are built once it is
+            all_metrics, left = [], []
+            result = PublishResult()
+            start.checkpointed = True
+        else:
+            # Metrics left at the deadline are only carried by a checkpoint
+            result, left = _publish_until(
+                inspector,
+                scheduler,
+                all_metrics,
+                deadline if checkpoint is not None else None,
+            )
+            print(
+                f"Published {len(result.published)} metrics in {result.calls} calls, "
+                f"{len(result.rejected)} rejected"
+            )
+            if scheduler is not None:
+                # A resumed publish only carries part of the run's series
+                if resumed:
+                    series = set(scheduler.series)
+                else:
+                    series = {scheduler.series_key(metric) for metric in all_metrics}
 
-        if service_info not in service_terraform_versions:
-            service_terraform_versions[service_info] = set()
-        service_terraform_versions[service_info].update(terraform_versions)
+        lambda_metrics_count = sum(
+            1 for metric in all_metrics if metric.metric_name == MetricNames.LAMBDA_TAG
+        )
+        terraform_metrics_count = len(all_metrics) - lambda_metrics_count
 
-        for version in app_versions:
-            if version != function.tags.get(TagNames.APP_VERSION):
-                dimensions = create_lambda_dimensions(
-                    service_info, function.name, version
-                )
-                all_metrics.append(
-                    MetricsData(
-                        metric_name=MetricNames.LAMBDA_TAG,
-                        dimensions=dimensions,
-                        value=0,
-                        unit=Config.METRIC_UNIT,
-                    )
-                )
-                lambda_metrics_count += 1
-            else:
-                dimensions = create_lambda_dimensions(
-                    service_info, function.name, function.tags[TagNames.APP_VERSION]
-                )
-                all_metrics.append(
-                    MetricsData(
-                        metric_name=MetricNames.LAMBDA_TAG,
-                        dimensions=dimensions,
-                        value=1,
-                        unit=Config.METRIC_UNIT,
-                    )
-                )
-                lambda_metrics_count += 1
-
-    for service_info, terraform_versions in service_terraform_versions.items():
-        for version in terraform_versions:
-            if version != service_info.terraform_version:
-                dimensions = create_terraform_dimensions(service_info, version)
-                all_metrics.append(
-                    MetricsData(
-                        metric_name=MetricNames.TERRAFORM_TAG,
-                        dimensions=dimensions,
-                        value=0,
-                        unit=Config.METRIC_UNIT,
-                    )
-                )
-                terraform_metrics_count += 1
+        if checkpoint is not None:
+            if start.checkpointed or left:
+                checkpoint.unpublished = left
+                checkpoint.save()
+                start.checkpointed = True
             else:
-                dimensions = create_terraform_dimensions(
-                    service_info, service_info.terraform_version
-                )
-                all_metrics.append(
-                    MetricsData(
-                        metric_name=MetricNames.TERRAFORM_TAG,
-                        dimensions=dimensions,
-                        value=1,
-                        unit=Config.METRIC_UNIT,
-                    )
-                )
-                terraform_metrics_count += 1
-
-    # Publish all metrics in batches
-    print(f"Publishing {len(all_metrics)} metrics in batches...")
-    inspector.publish_metrics_batch(all_metrics)
+                checkpoint.clear()
+    if exporter is not None:
+        try:
+            exporter.close()
+        except Exception as e:
+            print(f"Error exporting snapshot: {e}")
     print(
         f"Total metrics published: {lambda_metrics_count} lambda metrics, {terraform_metrics_count} terraform metrics"
     )
     print("Published CW Metrics successfully")
+    duration_ms = (time.perf_counter() - started) * 1000
+    summary = inspector.telemetry.summary()
+    if Config.SELF_METRICS:
+        publish_self_metrics(inspector, build_self_metrics(summary, duration_ms))
+    # One flush at the end, file sinks replace their file with what they buffered
+    final = _flush_sink(inspector, scheduler)
+    result.merge(final)
+    if final.published or final.rejected:
+        print(
+            f"Flushed {len(final.published)} buffered metrics, "
+            f"{len(final.rejected)} rejected"
+        )
+    if scheduler is not None and series is not None:
+        scheduler.save_series(series)
+    print(f"{'Warm' if start.warm else 'Cold'} run finished in {duration_ms:.1f} ms")
+    # One JSON line per run, for CloudWatch Logs Insights queries
+    print(
+        json.dumps(
+            {
+                "event": "inspector_run_summary",
+                "start": "warm" if start.warm else "cold",
+                "invocation": start.invocation,
+                "duration_ms": round(duration_ms, 1),
+                "checkpointed": start.checkpointed,
+                "metrics": {
+                    "lambda": lambda_metrics_count,
+                    "terraform": terraform_metrics_count,
+                    "rejected": len(result.rejected),
+                    "publish_calls": result.calls,
+                },
+                **summary,
+            }
+        )
+    )
+    return start
+
+
+def function_arn(function: str, region: str, account_id: str) -> str:
+    """Unqualified ARN of a function given by name or (qualified) ARN."""
+    if function.startswith("arn:"):
+        return ":".join(function.split(":")[:7])
+    return f"arn:aws:lambda:{region}:{account_id}:function:{function}"
+
+
+def parse_function_events(event: Dict, region: str = None) -> Dict[str, float]:
+    """Functions changed according to CloudTrail events from EventBridge or SQS.
+
+    Accepts a single EventBridge event or an SQS batch of them. Failed calls,
+    other API calls and, when region is given, events of other regions are
+    ignored. Returns function ARN -> epoch of its latest change event.
+    """
+    if "Records" in event:
+        events = [json.loads(record["body"]) for record in event["Records"]]
+    else:
+        events = [event]
+    changes = {}
+    for change in events:
+        detail = change.get("detail") or {}
+        # Lambda event names carry an API version, e.g. UpdateFunctionCode20150331v2
+        name = re.sub(r"\d{8}(v\d+)?$", "", detail.get("eventName", ""))
+        if name not in FUNCTION_CHANGE_EVENTS or detail.get("errorCode"):
+            continue
+        event_region = detail.get("awsRegion") or change.get("region")
+        if region and event_region != region:
+            continue
+        parameters = detail.get("requestParameters") or {}
+        function = parameters.get("resource") or parameters.get("functionName")
+        if not function:
+            continue
+        arn = function_arn(
+            function,
+            event_region,
+            detail.get("recipientAccountId") or change.get("account"),
+        )
+        changed_at = _to_epoch(detail.get("eventTime") or change["time"])
+        changes[arn] = max(changes.get(arn, 0.0), changed_at)
+    return changes
+
+
+def build_change_metrics(
+    inspector: LambdaInspector,
+    previous: Optional[LambdaFunction],
+    current: Optional[LambdaFunction],
+    terraform_in_use: Set[Tuple[ServiceInfo, str]] = frozenset(),
+) -> List[MetricsData]:
+    """Metrics of one changed function.
+
+    The current record's lambdaTag and terraformTag series, and value 0 for
+    the series of the previous record it no longer has (older version,
+    other service, untagged or deleted function). A terraformTag series is
+    service level, it is only retired when no (service, version) pair of
+    terraform_in_use still runs it.
+    """
+    metrics: Dict[str, MetricsData] = {}
+    if current is not None:
+        lambda_metrics, terraform_metrics = build_function_metrics(
+            inspector, current, None, set()
+        )
+        for metric in lambda_metrics + terraform_metrics:
+            metrics[PublishScheduler.series_key(metric)] = metric
+    if previous is not None:
+        # Pairs still in use are marked seen, so no 0 is built for them
+        lambda_metrics, terraform_metrics = build_function_metrics(
+            inspector, previous, None, set(terraform_in_use)
+        )
+        for metric in lambda_metrics + terraform_metrics:
+            metrics.setdefault(
+                PublishScheduler.series_key(metric),
+                MetricsData(
+                    metric_name=metric.metric_name,
+                    dimensions=metric.dimensions,
+                    value=0,
+                    unit=metric.unit,
+                ),
+            )
+    return list(metrics.values())
+
+
+def continue_run(event: Dict, context) -> Dict:
+    """Invoke this function again asynchronously to resume a checkpointed run.
+
+    The follow-up gets the same event with its continuation number. After
+    MAX_CONTINUATIONS, or when the invoke fails, the checkpoint is left for
+    the next scheduled run.
+    """
+    continuation = event.get("continuation", 0) + 1
+    if continuation > Config.MAX_CONTINUATIONS:
+        print(
+            f"Reached {Config.MAX_CONTINUATIONS} continuations, the next scheduled "
+            "run resumes from the checkpoint"
+        )
+        return {"statusCode": 202, "body": "Checkpointed"}
+    try:
+        # The container's inspector, left by the run that checkpointed
+        _inspector.lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps({**event, "continuation": continuation}),
+        )
+    except Exception as e:
+        print(f"Error invoking continuation {continuation}: {e}")
+        return {"statusCode": 202, "body": "Checkpointed"}
+    print(f"Checkpointed, continuing in invocation {continuation}")
+    return {"statusCode": 202, "body": "Checkpointed, continuing"}
 
 
 def handle_current_metrics(event, context):
@@ -466,13 +4766,16 @@ def handle_current_metrics(event, context):
     - Fast execution without AWS Config API calls
 
     Args:
-        event: Lambda event (unused)
-        context: Lambda context (unused)
+        event: Lambda event, only read by continuations (see continue_run)
+        context: Lambda context, its remaining time bounds the run
 
     Returns:
-        dict: Status response with statusCode 200
+        dict: Status response with statusCode 200, 202 when the run was
+        checkpointed and continues in a follow-up invocation
     """
-    publish_metrics(use_aws_config=False)
+    start = publish_metrics(use_aws_config=False, deadline=invocation_deadline(context))
+    if start.checkpointed:
+        return continue_run(event, context)
     return {"statusCode": 200, "body": "Metrics updated successfully"}
 
 
@@ -500,22 +4803,204 @@ def handle_history_metrics(event, context):
         event: Lambda event containing optional parameters:
             - earlier_days (float): Days to look back for history (default: 365)
             - later_days (float): Days to look back for recent data (default: 14)
-        context: Lambda context (unused)
+            - history_backend (str): History source, "config-history",
+              "config-select" or "snapshot-log" (default: HISTORY_BACKEND
+              environment variable)
+        context: Lambda context, its remaining time bounds the run. Large
+            histories are checkpointed before the timeout and completed by
+            follow-up invocations (see continue_run)
 
     Returns:
-        dict: Status response with statusCode 200
+        dict: Status response with statusCode 200, 202 when the run was
+        checkpointed and continues in a follow-up invocation
     """
+    if "shard_run" in event:
+        return handle_history_shard(event, context)
     earlier_days = event.get("earlier_days", Config.FULL_HISTORY_EARLIER_DAYS)
     later_days = event.get("later_days", Config.CLOUDWATCH_RETENTION_OLD_METRICS_DAYS)
-    publish_metrics(
-        use_aws_config=True, earlier_days=earlier_days, later_days=later_days
+    start = publish_metrics(
+        use_aws_config=True,
+        earlier_days=earlier_days,
+        later_days=later_days,
+        history_backend=event.get("history_backend"),
+        deadline=invocation_deadline(context),
     )
+    if start.checkpointed:
+        return continue_run(event, context)
     return {"statusCode": 200, "body": "Metrics updated successfully"}
 
 
+def handle_function_events(event, context):
+    """
+    Lambda handler for function change events.
+
+    Consumes the CloudTrail events of TagResource, UntagResource,
+    UpdateFunctionCode, CreateFunction and DeleteFunction, delivered by an
+    EventBridge rule directly or through an SQS queue, and updates only the
+    series of the changed functions.
+
+    Purpose:
+    - Re-reads each changed function once with GetFunction
+    - Publishes its current lambdaTag and terraformTag series, and value 0
+      for the series it no longer has
+    - Coalesces bursts: events of a batch are merged per function, the
+      handler waits until EVENT_COALESCE_SECONDS after the latest event,
+      and events older than this container's last read are skipped
+    - Lets the full scans of handle_current_metrics run on a slow
+      reconciliation schedule
+
+    Args:
+        event: EventBridge event, or SQS event with EventBridge events as bodies
+        context: Lambda context (unused)
+
+    Returns:
+        dict: Status response with statusCode 200
+    """
+    inspector, _ = get_inspector()
+    inspector.telemetry.reset()
+    changes = {
+        arn: changed_at
+        for arn, changed_at in parse_function_events(
+            event, inspector.session.region_name
+        ).items()
+        if changed_at > inspector._refreshed_at.get(arn, 0.0)
+    }
+    if not changes:
+        print("No function changes to handle")
+        return {"statusCode": 200, "body": "No function changes"}
+
+    # Let the rest of a deploy's burst happen before reading the functions
+    delay = max(changes.values()) + Config.EVENT_COALESCE_SECONDS - time.time()
+    if delay > 0:
+        time.sleep(min(delay, Config.EVENT_COALESCE_SECONDS))
+    read_at = time.time()
+    refreshed = inspector.refresh_functions(list(changes))
+    terraform_in_use = inspector.terraform_versions_in_use()
+    metrics = []
+    for previous, current in refreshed:
+        metrics.extend(
+            build_change_metrics(inspector, previous, current, terraform_in_use)
+        )
+    for arn in changes:
+        inspector._refreshed_at[arn] = read_at
+
+    scheduler = inspector.publish_scheduler
+    result = _publish_due(inspector, scheduler, metrics)
+    result.merge(_flush_sink(inspector, scheduler))
+    if scheduler is not None:
+        # Only a few functions were seen, keep the state of all series
+        scheduler.save_series(set(scheduler.series))
+    print(
+        f"Updated {len(changes)} functions: published {len(result.published)} "
+        f"metrics in {result.calls} calls, {len(result.rejected)} rejected"
+    )
+    return {"statusCode": 200, "body": f"Updated {len(changes)} functions"}
+
+
+def handle_history_shard(event, context):
+    """
+    Lambda handler of a history shard worker, invoked by a sharded run.
+
+    handle_history_metrics forwards events with a "shard_run" here, so the
+    inspector function itself can serve as SHARD_WORKER_FUNCTION.
+
+    Args:
+        event: Lambda event from collect_sharded_history:
+            - shard_run (str): Id of the coordinating run
+            - shard (int), shards (int): This shard and the shard count
+            - earlier_days, later_days, history_backend: History parameters
+        context: Lambda context (unused)
+
+    Returns:
+        dict: Status response with statusCode 200
+    """
+    store = build_state_store(boto3.Session())
+    scope = ScopedStateStore(
+        store, f"{Config.SHARD_RUNS_SCOPE}/{event['shard_run']}/{event['shard']}"
+    )
+    result = fetch_shard_history(
+        event["shard"],
+        event["shards"],
+        earlier_days=event["earlier_days"],
+        later_days=event["later_days"],
+        history_backend=event.get("history_backend"),
+        **scope.load(StateNames.SHARD_INPUT),
+    )
+    scope.save(StateNames.SHARD_RESULT, result)
+    return {"statusCode": 200, "body": f"History shard {event['shard']} done"}
+
+
+def version_index_cli(argv: List[str]) -> int:
+    """Query the version index: index {running,drift,last-seen} ... [--json]."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="lambda_inspector_function.py index",
+        description="Query the version index of the inspected functions",
+    )
+    parser.add_argument("--path", default=Config.VERSION_INDEX_PATH)
+    parser.add_argument("--json", action="store_true", help="Print JSON rows")
+    commands = parser.add_subparsers(dest="command", required=True)
+    running = commands.add_parser("running", help="Functions running an AppVersion")
+    running.add_argument("app_version")
+    running.add_argument("--env")
+    running.add_argument(
+        "--all", action="store_true", help="Include functions that ran it before"
+    )
+    drift = commands.add_parser(
+        "drift", help="Services whose versions differ between environments"
+    )
+    drift.add_argument("--env", action="append", dest="envs")
+    last_seen = commands.add_parser("last-seen", help="When versions were last seen")
+    last_seen.add_argument("--function")
+    last_seen.add_argument("--app-version")
+    args = parser.parse_args(argv)
+
+    if not args.path or not os.path.exists(args.path):
+        print(f"Error: version index {args.path} not found, set VERSION_INDEX_PATH")
+        return 1
+    index = VersionIndex(args.path)
+    started = time.perf_counter()
+    if args.command == "running":
+        rows = index.running(args.app_version, args.env, current=not args.all)
+    elif args.command == "drift":
+        rows = index.drift(args.envs)
+    else:
+        rows = index.last_seen(args.function, args.app_version)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    index.close()
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return 0
+    for row in rows:
+        if args.command == "drift":
+            versions = "; ".join(
+                f"{env}: {','.join(v['app_versions'])} (Terraform {','.join(v['terraform_versions'])})"
+                for env, v in sorted(row["envs"].items())
+            )
+            print(f"{row['stack']}/{row['service']}  {versions}")
+        else:
+            seen = {
+                key: datetime.fromtimestamp(row[key], timezone.utc).isoformat()
+                for key in ("first_seen", "last_seen")
+            }
+            print(
+                f"{row['env']}/{row['stack']}/{row['service']}  {row['function']}  "
+                f"{row['app_version']}  Terraform {row['terraform_version']}  "
+                f"first seen {seen['first_seen']}  last seen {seen['last_seen']}"
+                f"{'' if row['current'] else '  (replaced)'}"
+            )
+    print(f"{len(rows)} rows in {elapsed_ms:.1f} ms")
+    return 0
+
+
 if __name__ == "__main__":
     import sys
 
+    if len(sys.argv) >= 2 and sys.argv[1] == "index":
+        sys.exit(version_index_cli(sys.argv[2:]))
+
     # Start timing
     start_time = time.time()
 
@@ -523,6 +5008,7 @@ if __name__ == "__main__":
     use_aws_config = True
     earlier_days = Config.FULL_HISTORY_EARLIER_DAYS
     later_days = 0
+    history_backend = None
 
     if len(sys.argv) >= 2:
         use_aws_config = sys.argv[1].lower() == "true"
@@ -533,6 +5019,9 @@ if __name__ == "__main__":
     if len(sys.argv) >= 4:
         later_days = float(sys.argv[3])
 
+    if len(sys.argv) >= 5:
+        history_backend = sys.argv[4]
+
     # Validate time range parameters to prevent AWS Config errors
     if earlier_days < 0 or later_days < 0:
         print("Error: Time range parameters must be non-negative")
@@ -560,13 +5049,14 @@ if __name__ == "__main__":
         sys.exit(1)
 
     print(
-        f"Running with args: use_aws_config={use_aws_config}, earlier_days={earlier_days}, later_days={later_days}"
+        f"Running with args: use_aws_config={use_aws_config}, earlier_days={earlier_days}, later_days={later_days}, history_backend={history_backend}"
     )
 
     publish_metrics(
         use_aws_config=use_aws_config,
         earlier_days=earlier_days,
         later_days=later_days,
+        history_backend=history_backend,
     )
 
     # Calculate and print execution time
@@ -5,9 +5,15 @@ setup(
     version="0.1",
     packages=find_packages(),
     install_requires=[
-        "boto3>=1.26.79",
+        "boto3>=1.34.0",
     ],
     extras_require={
+        "snappy": [
+            "python-snappy>=0.7",
+        ],
+        "arrow": [
+            "pyarrow>=14.0",
+        ],
         "dev": [
             "pytest>=8.3.5",
             "pytest-mock>=3.10.0",
@@ -1,13 +1,30 @@
+import http.server
+import json
 import os
+import struct
 import sys
-from datetime import UTC, datetime
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta, timezone
 from unittest.mock import MagicMock, patch
 
 import pytest
+from botocore.exceptions import ClientError
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from lambda_inspector_function import (
+    AdaptiveExecutor,
+    AimdLimiter,
+    is_throttling_error,
+    HistoryWatermarks,
     LambdaInspector,
+    LocalStateStore,
+    MetricsData,
+    PublishScheduler,
+    S3StateStore,
+    TieredStateStore,
     LambdaFunction,
     ServiceInfo,
     TagNames,
@@ -21,9 +38,67 @@ from lambda_inspector_function import (
     handle_current_metrics,
     handle_history_metrics,
     publish_metrics,
+    collapse_metrics,
+    collect_metrics_by_target,
+    AssumedRoleSessions,
+    TargetInspectors,
+    InspectionTarget,
+    resolve_accounts,
+    resolve_targets,
+    stream_metrics,
+    get_inspector,
+    reset_inspector,
+    compact_function,
+    compact_tags,
+    EmfSink,
+    pack_emf_documents,
+    JsonLinesSink,
+    OpenMetricsFileSink,
+    PrometheusRemoteWriteSink,
+    Phases,
+    RunTelemetry,
+    build_self_metrics,
+    snappy_compress,
+    encode_write_request,
+    StartInfo,
+    RunCheckpoint,
+    continue_run,
+    invocation_deadline,
+    collect_metrics,
+    shard_of,
+    handle_history_shard,
+    handle_function_events,
+    parse_function_events,
+    VersionIndex,
+    SnapshotExporter,
+    ObservationLog,
+    version_index_cli,
+    target_time_budget,
+    region_time_budget,
+    resolve_regions,
+    estimate_metric_bytes,
+    is_transient_error,
+    pack_metric_batches,
 )
 
 
+# What publish_metrics returns for a run that completed
+FINISHED_RUN = StartInfo(warm=False, invocation=1, init_ms=0.0)
+
+
+@pytest.fixture(autouse=True)
+def cold_start():
+    """Every test starts without a cached inspector.
+
+    Self-metrics are off unless a test enables them, they would add to the
+    published metrics and calls the tests count.
+    """
+    reset_inspector()
+    with patch.object(Config, "SELF_METRICS", False):
+        yield
+    reset_inspector()
+
+
 @pytest.fixture
 def mock_cloudwatch():
     mock = MagicMock()
@@ -31,7 +106,7 @@ def mock_cloudwatch():
     return mock
 
 
-@patch("lambda_inspector_function.publish_metrics")
+@patch("lambda_inspector_function.publish_metrics", return_value=FINISHED_RUN)
 def test_handle_current_metrics(mock_publish_metrics):
     """Test handle_current_metrics calls publish_metrics correctly"""
     # Call the handler
@@ -42,10 +117,10 @@ def test_handle_current_metrics(mock_publish_metrics):
     assert response["body"] == "Metrics updated successfully"
 
     # Verify publish_metrics was called with correct parameters
-    mock_publish_metrics.assert_called_once_with(use_aws_config=False)
+    mock_publish_metrics.assert_called_once_with(use_aws_config=False, deadline=None)
 
 
-@patch("lambda_inspector_function.publish_metrics")
+@patch("lambda_inspector_function.publish_metrics", return_value=FINISHED_RUN)
 def test_handle_history_metrics(mock_publish_metrics):
     """Test handle_history_metrics calls publish_metrics correctly"""
     # Call the handler
@@ -57,7 +132,11 @@ def test_handle_history_metrics(mock_publish_metrics):
 
     # Verify publish_metrics was called with correct parameters
     mock_publish_metrics.assert_called_once_with(
-        use_aws_config=True, earlier_days=365, later_days=14
+        use_aws_config=True,
+        earlier_days=365,
+        later_days=14,
+        history_backend=None,
+        deadline=None,
     )
 
 
@@ -331,7 +410,7 @@ class TestLambdaInspector:
         assert second_call["MetricData"][0]["Value"] == 2
 
 
-@patch("lambda_inspector_function.publish_metrics")
+@patch("lambda_inspector_function.publish_metrics", return_value=FINISHED_RUN)
 def test_handle_current_metrics_with_multiple_functions(mock_publish_metrics):
     """Test handle_current_metrics with multiple functions having different tag combinations"""
     # Call the handler
@@ -342,10 +421,10 @@ def test_handle_current_metrics_with_multiple_functions(mock_publish_metrics):
     assert response["body"] == "Metrics updated successfully"
 
     # Verify publish_metrics was called with correct parameters
-    mock_publish_metrics.assert_called_once_with(use_aws_config=False)
+    mock_publish_metrics.assert_called_once_with(use_aws_config=False, deadline=None)
 
 
-@patch("lambda_inspector_function.publish_metrics")
+@patch("lambda_inspector_function.publish_metrics", return_value=FINISHED_RUN)
 def test_handle_current_metrics_with_no_functions(mock_publish_metrics):
     """Test handle_current_metrics when no functions are found"""
     # Call the handler
@@ -356,10 +435,10 @@ def test_handle_current_metrics_with_no_functions(mock_publish_metrics):
     assert response["body"] == "Metrics updated successfully"
 
     # Verify publish_metrics was called
-    mock_publish_metrics.assert_called_once_with(use_aws_config=False)
+    mock_publish_metrics.assert_called_once_with(use_aws_config=False, deadline=None)
 
 
-@patch("lambda_inspector_function.publish_metrics")
+@patch("lambda_inspector_function.publish_metrics", return_value=FINISHED_RUN)
 def test_handle_current_metrics_with_functions_without_appversion(mock_publish_metrics):
     """Test handle_current_metrics when all functions lack AppVersion tag"""
     # Call the handler
@@ -370,10 +449,10 @@ def test_handle_current_metrics_with_functions_without_appversion(mock_publish_m
     assert response["body"] == "Metrics updated successfully"
 
     # Verify publish_metrics was called
-    mock_publish_metrics.assert_called_once_with(use_aws_config=False)
+    mock_publish_metrics.assert_called_once_with(use_aws_config=False, deadline=None)
 
 
-@patch("lambda_inspector_function.publish_metrics")
+@patch("lambda_inspector_function.publish_metrics", return_value=FINISHED_RUN)
 def test_handle_current_metrics_handles_cloudwatch_errors(mock_publish_metrics):
     """Test handle_current_metrics handles CloudWatch errors gracefully"""
     # Call the handler
@@ -384,7 +463,7 @@ def test_handle_current_metrics_handles_cloudwatch_errors(mock_publish_metrics):
     assert response["body"] == "Metrics updated successfully"
 
     # Verify publish_metrics was called
-    mock_publish_metrics.assert_called_once_with(use_aws_config=False)
+    mock_publish_metrics.assert_called_once_with(use_aws_config=False, deadline=None)
 
 
 # Tests for new helper functions and classes
@@ -836,3 +915,3104 @@ def test_publish_metrics_with_config_exception(mock_session):
 
     # Verify CloudWatch metrics were still published (using current tags only)
     assert mock_cloudwatch.put_metric_data.call_count >= 1
+
+
+class TestBulkTagDiscovery:
+    """Test bulk tag discovery through the Resource Groups Tagging API"""
+
+    def _make_inspector(self, mock_session):
+        mock_lambda = MagicMock()
+        mock_tagging = MagicMock()
+
+        mock_session_instance = MagicMock()
+        mock_session_instance.client.side_effect = [
+            mock_lambda,
+            MagicMock(),
+            mock_tagging,
+        ]
+        mock_session.return_value = mock_session_instance
+
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {
+                "Functions": [
+                    {
+                        "FunctionName": "tagged",
+                        "FunctionArn": "arn:aws:lambda:region:account:function:tagged",
+                    },
+                    {
+                        "FunctionName": "untagged",
+                        "FunctionArn": "arn:aws:lambda:region:account:function:untagged",
+                    },
+                ]
+            }
+        ]
+        mock_lambda.list_tags.return_value = {"Tags": {"AppVersion": "9.9"}}
+        return LambdaInspector(), mock_lambda, mock_tagging
+
+    @patch.object(Config, "TAG_BULK_MIN_FUNCTIONS", 1)
+    @patch.object(Config, "TAG_DISCOVERY_MODE", "tagging")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_get_all_functions_uses_get_resources(self, mock_session):
+        """Test that tagging mode merges GetResources pages with the function list"""
+        inspector, mock_lambda, mock_tagging = self._make_inspector(mock_session)
+        mock_tagging.get_paginator.return_value.paginate.return_value = [
+            {
+                "ResourceTagMappingList": [
+                    {
+                        "ResourceARN": "arn:aws:lambda:region:account:function:tagged",
+                        "Tags": [
+                            {"Key": "AppVersion", "Value": "1.0"},
+                            {"Key": "Stack", "Value": "test-stack"},
+                        ],
+                    },
+                    {
+                        "ResourceARN": "arn:aws:lambda:region:account:function:deleted",
+                        "Tags": [{"Key": "AppVersion", "Value": "0.1"}],
+                    },
+                ]
+            }
+        ]
+
+        functions = inspector.get_all_functions()
+
+        assert [f.name for f in functions] == ["tagged"]
+        assert functions[0].tags == {"AppVersion": "1.0", "Stack": "test-stack"}
+        mock_lambda.list_tags.assert_not_called()
+        mock_tagging.get_paginator.assert_called_once_with("get_resources")
+        paginate_kwargs = mock_tagging.get_paginator.return_value.paginate.call_args[1]
+        assert paginate_kwargs["ResourceTypeFilters"] == ["lambda:function"]
+        assert paginate_kwargs["TagFilters"] == [{"Key": "AppVersion"}]
+
+    @patch.object(Config, "TAG_DISCOVERY_MODE", "tagging")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_get_all_functions_below_bulk_threshold_uses_list_tags(self, mock_session):
+        """Test that a few functions to look up skip GetResources"""
+        inspector, mock_lambda, mock_tagging = self._make_inspector(mock_session)
+
+        functions = inspector.get_all_functions()
+
+        assert len(functions) == 2
+        assert mock_lambda.list_tags.call_count == 2
+        mock_tagging.get_paginator.assert_not_called()
+
+    def test_bulk_threshold_covers_get_resources_pages(self):
+        """Test that the threshold grows with the GetResources pages to read"""
+        assert LambdaInspector._bulk_threshold(50) == Config.TAG_BULK_MIN_FUNCTIONS
+        with patch.object(Config, "TAG_BULK_MIN_FUNCTIONS", 1):
+            assert LambdaInspector._bulk_threshold(250) == 3
+
+    @patch.object(Config, "TAG_BULK_MIN_FUNCTIONS", 1)
+    @patch.object(Config, "TAG_DISCOVERY_MODE", "tagging")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_get_all_functions_falls_back_to_list_tags(self, mock_session):
+        """Test that a failing GetResources call falls back to ListTags per function"""
+        inspector, mock_lambda, mock_tagging = self._make_inspector(mock_session)
+        mock_tagging.get_paginator.return_value.paginate.side_effect = Exception(
+            "AccessDenied"
+        )
+
+        functions = inspector.get_all_functions()
+
+        assert len(functions) == 2
+        assert mock_lambda.list_tags.call_count == 2
+
+
+def _throttling_error(code="ThrottlingException"):
+    return ClientError({"Error": {"Code": code, "Message": "Rate exceeded"}}, "Op")
+
+
+class TestAimdConcurrency:
+    """Test the AIMD concurrency limiter and the shared executor"""
+
+    def test_is_throttling_error(self):
+        """Test that throttling error codes are recognised"""
+        assert is_throttling_error(_throttling_error())
+        assert is_throttling_error(_throttling_error("TooManyRequestsException"))
+        assert not is_throttling_error(_throttling_error("AccessDeniedException"))
+        assert not is_throttling_error(Exception("boom"))
+
+    def test_limiter_increases_on_success(self):
+        """Test that successful calls additively raise the concurrency"""
+        limiter = AimdLimiter("api", initial=2, minimum=1, maximum=4)
+        for _ in range(20):
+            limiter.call(lambda: None)
+        assert limiter.concurrency == 4
+        assert limiter.report()["peak"] == 4
+
+    def test_limiter_halves_once_per_window(self):
+        """Test that throttles from the same window decrease the limit once"""
+        limiter = AimdLimiter("api", initial=8, minimum=1, maximum=8)
+        epochs = [limiter.acquire() for _ in range(4)]
+        for epoch in epochs:
+            limiter.release(epoch, throttled=True)
+        assert limiter.concurrency == 4
+        assert limiter.throttles == 4
+
+    @patch("lambda_inspector_function.time.sleep")
+    def test_limiter_retries_throttled_calls(self, mock_sleep):
+        """Test that a throttled call is retried and backs the limit off"""
+        fn = MagicMock(side_effect=[_throttling_error(), "ok"])
+        limiter = AimdLimiter("api", initial=4, minimum=1, maximum=8)
+
+        assert limiter.call(fn, "arg") == "ok"
+        assert fn.call_count == 2
+        assert limiter.throttles == 1
+        assert limiter.concurrency == 2
+        mock_sleep.assert_called_once()
+
+    def test_limiter_does_not_retry_other_errors(self):
+        """Test that non-throttling errors are raised immediately"""
+        fn = MagicMock(side_effect=Exception("boom"))
+        limiter = AimdLimiter("api", initial=4, minimum=1, maximum=8)
+
+        with pytest.raises(Exception, match="boom"):
+            limiter.call(fn)
+        assert fn.call_count == 1
+
+    def test_executor_reports_per_api(self):
+        """Test that the executor keeps a limiter per API"""
+        executor = AdaptiveExecutor({"a": 4, "b": 2})
+        futures = executor.submit_all("a", lambda item, n: item * n, [1, 2, 3], 10)
+        assert sorted(f.result() for f in futures) == [10, 20, 30]
+        executor.shutdown()
+
+        report = executor.report()
+        assert list(report) == ["a"]
+        assert report["a"]["calls"] == 3
+        assert executor.limiter("b").maximum == 2
+
+
+class TestStateStores:
+    """Test the stores used to persist inspector state between runs"""
+
+    def test_local_state_store_round_trip(self, tmp_path):
+        """Test that a local store saves and loads JSON documents"""
+        store = LocalStateStore(str(tmp_path / "state"))
+        assert store.load("missing.json") is None
+
+        store.save("doc.json", {"a": [1, 2]})
+        assert store.load("doc.json") == {"a": [1, 2]}
+
+    def test_s3_state_store_missing_key(self):
+        """Test that a missing S3 object loads as None"""
+        mock_s3 = MagicMock()
+        mock_s3.get_object.side_effect = ClientError(
+            {"Error": {"Code": "NoSuchKey", "Message": "missing"}}, "GetObject"
+        )
+        store = S3StateStore(mock_s3, "bucket", "prefix/")
+
+        assert store.load("doc.json") is None
+        mock_s3.get_object.assert_called_once_with(
+            Bucket="bucket", Key="prefix/doc.json"
+        )
+
+    def test_tiered_state_store_warms_local_cache(self, tmp_path):
+        """Test that the tiered store falls back to the durable store and caches it"""
+        cache = LocalStateStore(str(tmp_path))
+        durable = MagicMock()
+        durable.load.return_value = {"from": "s3"}
+        store = TieredStateStore(cache, durable)
+
+        assert store.load("doc.json") == {"from": "s3"}
+        assert store.load("doc.json") == {"from": "s3"}
+        durable.load.assert_called_once_with("doc.json")
+
+        store.save("other.json", {"x": 1})
+        durable.save.assert_called_once_with("other.json", {"x": 1})
+        assert cache.load("other.json") == {"x": 1}
+
+    def test_tiered_state_store_deletes_both_copies(self, tmp_path):
+        """Test that a deleted document is gone from the cache and S3"""
+        mock_s3 = MagicMock()
+        store = TieredStateStore(
+            LocalStateStore(str(tmp_path)), S3StateStore(mock_s3, "bucket", "prefix/")
+        )
+        store.save("runs/doc.json", {"x": 1})
+
+        store.delete("runs/doc.json")
+        store.delete("runs/doc.json")
+
+        assert LocalStateStore(str(tmp_path)).load("runs/doc.json") is None
+        mock_s3.delete_object.assert_called_with(
+            Bucket="bucket", Key="prefix/runs/doc.json"
+        )
+
+
+class TestFunctionSnapshot:
+    """Test incremental inspection with a persisted function snapshot"""
+
+    @staticmethod
+    def _page(revisions):
+        return [
+            {
+                "Functions": [
+                    {
+                        "FunctionName": name,
+                        "FunctionArn": f"arn:aws:lambda:region:account:function:{name}",
+                        "LastModified": "2024-01-01T00:00:00.000+0000",
+                        "RevisionId": revision,
+                    }
+                    for name, revision in revisions.items()
+                ]
+            }
+        ]
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_only_changed_functions_are_refetched(self, mock_session, tmp_path):
+        """Test that unchanged functions reuse the snapshot and changed ones are re-fetched"""
+        mock_lambda = MagicMock()
+        mock_session.return_value.client.side_effect = [
+            mock_lambda,
+            MagicMock(),
+            MagicMock(),
+        ]
+
+        def mock_list_tags(Resource):
+            if Resource.endswith(":untagged"):
+                return {"Tags": {}}
+            return {"Tags": {"AppVersion": Resource.rsplit(":", 1)[1]}}
+
+        mock_lambda.list_tags.side_effect = mock_list_tags
+        inspector = LambdaInspector(state_store=LocalStateStore(str(tmp_path)))
+
+        mock_lambda.get_paginator.return_value.paginate.return_value = self._page(
+            {"a": "r1", "b": "r1", "untagged": "r1"}
+        )
+        first = inspector.get_all_functions()
+        assert sorted(f.name for f in first) == ["a", "b"]
+        assert mock_lambda.list_tags.call_count == 3
+
+        # "b" changed, "c" is new, "untagged" is gone
+        mock_lambda.list_tags.reset_mock()
+        mock_lambda.get_paginator.return_value.paginate.return_value = self._page(
+            {"a": "r1", "b": "r2", "c": "r1"}
+        )
+        second = inspector.get_all_functions()
+
+        assert sorted(f.name for f in second) == ["a", "b", "c"]
+        fetched = sorted(c[1]["Resource"] for c in mock_lambda.list_tags.call_args_list)
+        assert fetched == [
+            "arn:aws:lambda:region:account:function:b",
+            "arn:aws:lambda:region:account:function:c",
+        ]
+        # The unchanged record is reused as is
+        assert [f for f in second if f.name == "a"][0] is [
+            f for f in first if f.name == "a"
+        ][0]
+
+        snapshot = LocalStateStore(str(tmp_path)).load("function_snapshot.json")
+        assert sorted(snapshot["functions"]) == [
+            "arn:aws:lambda:region:account:function:a",
+            "arn:aws:lambda:region:account:function:b",
+            "arn:aws:lambda:region:account:function:c",
+        ]
+
+    @patch.object(Config, "SNAPSHOT_MAX_AGE_SECONDS", -1)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_expired_snapshot_refetches_everything(self, mock_session, tmp_path):
+        """Test that an expired snapshot triggers a full refresh"""
+        mock_lambda = MagicMock()
+        mock_session.return_value.client.side_effect = [
+            mock_lambda,
+            MagicMock(),
+            MagicMock(),
+        ]
+        mock_lambda.list_tags.return_value = {"Tags": {"AppVersion": "1.0"}}
+        mock_lambda.get_paginator.return_value.paginate.return_value = self._page(
+            {"a": "r1"}
+        )
+        inspector = LambdaInspector(state_store=LocalStateStore(str(tmp_path)))
+
+        inspector.get_all_functions()
+        inspector.get_all_functions()
+
+        assert mock_lambda.list_tags.call_count == 2
+
+
+class TestConfigSelectHistory:
+    """Test the AWS Config advanced query history backend"""
+
+    @staticmethod
+    def _make_inspector(mock_session):
+        mock_config = MagicMock()
+        mock_session.return_value.client.side_effect = [
+            MagicMock(),
+            MagicMock(),
+            mock_config,
+        ]
+        return LambdaInspector(), mock_config
+
+    @staticmethod
+    def _result(name, tags, account_id="123456789012", region="eu-west-1"):
+        return json.dumps(
+            {
+                "accountId": account_id,
+                "awsRegion": region,
+                "resourceName": name,
+                "tags": [
+                    {"key": key, "value": value, "tag": f"{key}={value}"}
+                    for key, value in tags.items()
+                ],
+            }
+        )
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_select_backend_pages_through_results(self, mock_session):
+        """Test that the select backend maps paged query results to version sets"""
+        inspector, mock_config = self._make_inspector(mock_session)
+        mock_config.select_resource_config.side_effect = [
+            {
+                "Results": [
+                    self._result(
+                        "fn-a", {"AppVersion": "1.0", "TerraformVersion": "t1"}
+                    )
+                ],
+                "NextToken": "token",
+            },
+            {
+                "Results": [
+                    self._result("fn-b", {"AppVersion": "2.0"}),
+                    self._result("not-inspected", {"AppVersion": "3.0"}),
+                ]
+            },
+        ]
+        functions = [
+            LambdaFunction(name=name, arn=f"arn:{name}", tags={})
+            for name in ("fn-a", "fn-b", "fn-c")
+        ]
+
+        results = inspector.get_tags_history_batch(
+            functions, 365, 0, backend="config-select"
+        )
+
+        assert results == {
+            "fn-a": ({"1.0"}, {"t1"}),
+            "fn-b": ({"2.0"}, set()),
+            "fn-c": (set(), set()),
+        }
+        mock_config.get_paginator.assert_not_called()
+        calls = mock_config.select_resource_config.call_args_list
+        assert "resourceType = 'AWS::Lambda::Function'" in calls[0][1]["Expression"]
+        assert "NextToken" not in calls[0][1]
+        assert calls[1][1]["NextToken"] == "token"
+
+    @patch.object(Config, "CONFIG_AGGREGATOR_NAME", "org-aggregator")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_select_backend_uses_aggregator(self, mock_session):
+        """Test that aggregate queries only keep the inspected account and region"""
+        inspector, mock_config = self._make_inspector(mock_session)
+        mock_config.select_aggregate_resource_config.return_value = {
+            "Results": [
+                self._result("fn-a", {"AppVersion": "1.0"}),
+                self._result("fn-a", {"AppVersion": "9.0"}, account_id="999999999999"),
+                self._result("fn-a", {"AppVersion": "8.0"}, region="us-east-1"),
+            ]
+        }
+        functions = [
+            LambdaFunction(
+                name="fn-a",
+                arn="arn:aws:lambda:eu-west-1:123456789012:function:fn-a",
+                tags={},
+            )
+        ]
+
+        results = inspector.get_tags_history_batch(
+            functions, 365, 0, backend="config-select"
+        )
+
+        assert results == {"fn-a": ({"1.0"}, set())}
+        call_kwargs = mock_config.select_aggregate_resource_config.call_args[1]
+        assert call_kwargs["ConfigurationAggregatorName"] == "org-aggregator"
+        assert "accountId = '123456789012'" in call_kwargs["Expression"]
+        assert "awsRegion = 'eu-west-1'" in call_kwargs["Expression"]
+        mock_config.select_resource_config.assert_not_called()
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_select_backend_keeps_its_own_watermarks(self, mock_session, tmp_path):
+        """Test that a select run does not mark config-history as up to date"""
+        mock_config = MagicMock()
+        mock_session.return_value.client.side_effect = [
+            MagicMock(),
+            MagicMock(),
+            mock_config,
+        ]
+        store = LocalStateStore(str(tmp_path))
+        inspector = LambdaInspector(state_store=store)
+        mock_config.select_resource_config.return_value = {
+            "Results": [self._result("fn-a", {"AppVersion": "1.0"})]
+        }
+        mock_config.get_paginator.return_value.paginate.return_value = [
+            {
+                "configurationItems": [
+                    {
+                        "tags": {"AppVersion": "0.9"},
+                        "configurationItemCaptureTime": datetime.now(UTC),
+                    }
+                ]
+            }
+        ]
+        functions = [LambdaFunction(name="fn-a", arn="arn:fn-a", tags={})]
+
+        inspector.get_tags_history_batch(functions, 365, 0, backend="config-select")
+        results = inspector.get_tags_history_batch(
+            functions, 365, 0, backend="config-history"
+        )
+
+        assert results == {"fn-a": ({"0.9"}, set())}
+        mock_config.get_paginator.assert_called()
+        assert "fn-a" in store.load("select_watermarks.json")["functions"]
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_unknown_backend_raises(self, mock_session):
+        """Test that an unknown history backend is rejected"""
+        inspector, _ = self._make_inspector(mock_session)
+        with pytest.raises(ValueError):
+            inspector.get_tags_history_batch([], 365, 0, backend="nope")
+
+
+class TestHistoryWatermarks:
+    """Test incremental history scans with per-function watermarks"""
+
+    DAY = 86400
+
+    @patch.object(Config, "HISTORY_BACKFILL_CHUNK_DAYS", 30)
+    def test_scan_range_backfills_in_chunks(self, tmp_path):
+        """Test that a new function is backfilled chunk by chunk"""
+        watermarks = HistoryWatermarks(LocalStateStore(str(tmp_path)))
+
+        assert watermarks.scan_range("fn", 0, 100 * self.DAY) == (0, 30 * self.DAY)
+        watermarks.record("fn", 30 * self.DAY, [])
+        assert watermarks.scan_range("fn", 0, 100 * self.DAY) == (
+            30 * self.DAY,
+            60 * self.DAY,
+        )
+        watermarks.record("fn", 100 * self.DAY, [])
+        assert watermarks.scan_range("fn", 0, 100 * self.DAY) is None
+
+    def test_versions_are_merged_and_pruned(self, tmp_path):
+        """Test that observations merge into the stored sets and age out of the window"""
+        store = LocalStateStore(str(tmp_path))
+        watermarks = HistoryWatermarks(store)
+        watermarks.record(
+            "fn",
+            50,
+            [({"AppVersion": "1.0", "TerraformVersion": "t1"}, 10)],
+        )
+        watermarks.record("fn", 90, [({"AppVersion": "2.0"}, 80)])
+
+        assert watermarks.versions("fn", 0) == ({"1.0", "2.0"}, {"t1"})
+        assert watermarks.versions("fn", 20) == ({"2.0"}, set())
+
+        watermarks.save()
+        reloaded = HistoryWatermarks(store)
+        assert reloaded.functions["fn"]["watermark"] == 90
+        reloaded.prune([])
+        assert HistoryWatermarks(store).functions == {}
+
+    @patch.object(Config, "HISTORY_CHUNK_SIZE", 1)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_chunked_run_keeps_all_watermarks(self, mock_session, tmp_path):
+        """Test that every chunk's watermarks survive and gone functions are pruned"""
+        mock_lambda, mock_config = MagicMock(), MagicMock()
+        clients = {
+            "lambda": mock_lambda,
+            "config": mock_config,
+            "cloudwatch": MagicMock(),
+        }
+        mock_session.return_value.client.side_effect = (
+            lambda service, **kwargs: clients[service]
+        )
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {
+                "Functions": [
+                    {"FunctionName": name, "FunctionArn": f"arn:{name}"}
+                    for name in ("f1", "f2", "f3", "f4")
+                ]
+            }
+        ]
+        mock_lambda.list_tags.return_value = {
+            "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+        }
+        mock_config.get_paginator.return_value.paginate.return_value = [
+            {"configurationItems": []}
+        ]
+        store = LocalStateStore(str(tmp_path))
+        store.save(
+            "history_watermarks.json",
+            {"functions": {"gone": {"watermark": 1, "app": {}, "tf": {}}}},
+        )
+        inspector = LambdaInspector(state_store=store)
+
+        collect_metrics(
+            inspector,
+            use_aws_config=True,
+            checkpoint=RunCheckpoint(store, {}),
+            deadline=time.time() + 600,
+        )
+
+        assert sorted(store.load("history_watermarks.json")["functions"]) == [
+            "f1",
+            "f2",
+            "f3",
+            "f4",
+        ]
+
+    @patch.object(Config, "HISTORY_BACKFILL_CHUNK_DAYS", 400)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_second_run_only_scans_new_window(self, mock_session, tmp_path):
+        """Test that the second history run queries AWS Config from the watermark"""
+        mock_config = MagicMock()
+        mock_session.return_value.client.side_effect = [
+            MagicMock(),
+            MagicMock(),
+            mock_config,
+        ]
+        paginate = mock_config.get_paginator.return_value.paginate
+        paginate.return_value = [
+            {
+                "configurationItems": [
+                    {
+                        "tags": {"AppVersion": "0.9", "TerraformVersion": "t0"},
+                        "configurationItemCaptureTime": datetime.now(UTC),
+                    }
+                ]
+            }
+        ]
+        inspector = LambdaInspector(state_store=LocalStateStore(str(tmp_path)))
+        function = LambdaFunction(name="fn", arn="arn:fn", tags={})
+
+        first = inspector.get_tags_history_batch([function], 365, 0)
+        first_window = paginate.call_args[1]
+
+        paginate.return_value = [{"configurationItems": []}]
+        second = inspector.get_tags_history_batch([function], 365, 0)
+        second_window = paginate.call_args[1]
+
+        assert first == {"fn": ({"0.9"}, {"t0"})}
+        # Versions seen in the first run are kept from the stored sets
+        assert second == first
+        assert second_window["earlierTime"] == first_window["laterTime"]
+        assert datetime.fromisoformat(
+            first_window["earlierTime"]
+        ) < datetime.fromisoformat(second_window["earlierTime"])
+
+
+class TestPublishScheduler:
+    """Test the keepalive-aware publish scheduler"""
+
+    @staticmethod
+    def _metric(version, value):
+        return MetricsData(
+            metric_name="lambdaTag",
+            dimensions=[{"Name": "AppVersion", "Value": version}],
+            value=value,
+            unit="Count",
+        )
+
+    @patch.object(Config, "KEEPALIVE_INTERVAL_SECONDS", 1000)
+    @patch.object(Config, "ACTIVE_REFRESH_SECONDS", 0)
+    def test_due_publishes_new_changed_and_expiring_series(self, tmp_path):
+        """Test which series are due for publishing"""
+        scheduler = PublishScheduler(LocalStateStore(str(tmp_path)))
+        old, current = self._metric("0.9", 0), self._metric("1.0", 1)
+
+        assert scheduler.due([old, current], now=0) == [old, current]
+        scheduler.mark_published([old, current], now=0)
+
+        # Unchanged value-0 series wait for the keepalive deadline
+        assert scheduler.due([old, current], now=10) == [current]
+        assert scheduler.due([old, current], now=1000) == [old, current]
+
+        # A changed value is published immediately
+        changed = self._metric("0.9", 1)
+        assert scheduler.due([changed], now=10) == [changed]
+
+    def test_save_drops_series_no_longer_emitted(self, tmp_path):
+        """Test that only series still emitted are persisted"""
+        store = LocalStateStore(str(tmp_path))
+        scheduler = PublishScheduler(store)
+        old, current = self._metric("0.9", 0), self._metric("1.0", 1)
+        scheduler.mark_published([old, current], now=5)
+
+        scheduler.save([current])
+
+        assert PublishScheduler(store).series == {"lambdaTag|AppVersion=1.0": [5, 1]}
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_handlers_keep_separate_series_state(self, mock_session, tmp_path):
+        """Test that a history run does not drop the series of current runs"""
+        store = LocalStateStore(str(tmp_path))
+        inspector = LambdaInspector(state_store=store)
+        current, history = self._metric("1.0", 1), self._metric("0.9", 0)
+        inspector.publish_scheduler.mark_published([current], now=5)
+        inspector.publish_scheduler.save([current])
+
+        inspector.history_publish_scheduler.mark_published([history], now=5)
+        inspector.history_publish_scheduler.save([history])
+
+        assert PublishScheduler(store).series == {"lambdaTag|AppVersion=1.0": [5, 1]}
+        assert PublishScheduler(store, "history_published_series.json").series == {
+            "lambdaTag|AppVersion=0.9": [5, 0]
+        }
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_publish_metrics_skips_unchanged_series(self, mock_session, tmp_path):
+        """Test that a second run only re-publishes active series"""
+        runs = []
+        with patch.object(Config, "STATE_DIR", str(tmp_path)):
+            for _ in range(2):
+                # Each run in a new container, sharing state through the store only
+                reset_inspector()
+                mock_lambda = MagicMock()
+                mock_cloudwatch = MagicMock()
+                mock_config = MagicMock()
+                mock_session.return_value.client.side_effect = [
+                    mock_lambda,
+                    mock_cloudwatch,
+                    mock_config,
+                ]
+                mock_lambda.get_paginator.return_value.paginate.return_value = [
+                    {
+                        "Functions": [
+                            {
+                                "FunctionName": "test-function",
+                                "FunctionArn": "arn:aws:lambda:region:account:function:test-function",
+                            }
+                        ]
+                    }
+                ]
+                mock_lambda.list_tags.return_value = {
+                    "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.0.0"}
+                }
+                mock_config.get_paginator.return_value.paginate.return_value = [
+                    {
+                        "configurationItems": [
+                            {"tags": {"AppVersion": "0.9", "TerraformVersion": "0.9.0"}}
+                        ]
+                    }
+                ]
+
+                publish_metrics(use_aws_config=True)
+
+                published = [
+                    metric
+                    for call in mock_cloudwatch.put_metric_data.call_args_list
+                    for metric in call[1]["MetricData"]
+                ]
+                runs.append(sorted(metric["Value"] for metric in published))
+        # Second run: the two value-0 history series are not due yet
+        assert runs == [[0, 0, 1, 1], [1, 1]]
+
+
+class TestMetricBatchPacking:
+    """Test size-aware packing and parallel publishing of metric batches"""
+
+    @staticmethod
+    def _metrics(count, value_length=8):
+        return [
+            MetricsData(
+                metric_name="lambdaTag",
+                dimensions=[{"Name": "FunctionName", "Value": f"{i:0{value_length}d}"}],
+                value=1,
+                unit="Count",
+            )
+            for i in range(count)
+        ]
+
+    def test_pack_by_metric_count(self):
+        """Test that batches hold at most CW_BATCH_SIZE metrics"""
+        batches = pack_metric_batches(self._metrics(2500))
+        assert [len(batch) for batch in batches] == [1000, 1000, 500]
+
+    def test_pack_by_payload_size(self):
+        """Test that batches stay under the payload limit"""
+        metrics = self._metrics(10, value_length=200)
+        metric_bytes = estimate_metric_bytes(metrics[0].to_cloudwatch_format())
+
+        with patch.object(Config, "CW_MAX_PAYLOAD_BYTES", metric_bytes * 4):
+            batches = pack_metric_batches(metrics)
+
+        assert [len(batch) for batch in batches] == [4, 4, 2]
+        assert sum(batches, []) == metrics
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_publish_metrics_batch_sends_packed_batches(self, mock_session):
+        """Test that all packed batches are sent and reported as published"""
+        mock_cloudwatch = MagicMock()
+        mock_session.return_value.client.side_effect = [
+            MagicMock(),
+            mock_cloudwatch,
+            MagicMock(),
+        ]
+        inspector = LambdaInspector()
+        metrics = self._metrics(2500)
+
+        result = inspector.publish_metrics_batch(metrics)
+
+        assert mock_cloudwatch.put_metric_data.call_count == 3
+        assert len(result.published) == 2500
+        assert result.calls == 3
+        sent = sorted(
+            len(call[1]["MetricData"])
+            for call in mock_cloudwatch.put_metric_data.call_args_list
+        )
+        assert sent == [500, 1000, 1000]
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_cloudwatch_client_compresses_requests(self, mock_session):
+        """Test that the CloudWatch client is pooled and compresses large requests"""
+        LambdaInspector()
+
+        cloudwatch_call = mock_session.return_value.client.call_args_list[1]
+        assert cloudwatch_call[0] == ("cloudwatch",)
+        boto_config = cloudwatch_call[1]["config"]
+        assert boto_config.request_min_compression_size_bytes == 10240
+        assert boto_config.disable_request_compression is False
+        assert boto_config.max_pool_connections >= 1
+
+    @patch.object(Config, "BOTO_READ_TIMEOUT_SECONDS", 12.0)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_client_factory_settings(self, mock_session):
+        """Test that every client gets adaptive retries, timeouts, keepalive and a sized pool"""
+        inspector = LambdaInspector()
+        inspector.config_client
+
+        configs = {
+            c[0][0]: c[1]["config"]
+            for c in mock_session.return_value.client.call_args_list
+        }
+        assert set(configs) == {"lambda", "cloudwatch", "config"}
+        for boto_config in configs.values():
+            assert boto_config.retries == {"mode": "adaptive", "max_attempts": 3}
+            assert boto_config.connect_timeout == 5
+            assert boto_config.read_timeout == 12.0
+            assert boto_config.tcp_keepalive is True
+        assert configs["lambda"].max_pool_connections == 64
+        assert configs["config"].max_pool_connections == 16
+
+
+class TestBisectingPublish:
+    """Test bisecting retries of failed metric batches"""
+
+    @staticmethod
+    def _inspector(mock_session):
+        mock_cloudwatch = MagicMock()
+        mock_session.return_value.client.side_effect = [
+            MagicMock(),
+            mock_cloudwatch,
+            MagicMock(),
+        ]
+        return LambdaInspector(), mock_cloudwatch
+
+    @staticmethod
+    def _metrics(count):
+        return [
+            MetricsData(
+                metric_name="lambdaTag",
+                dimensions=[{"Name": "FunctionName", "Value": f"fn-{i}"}],
+                value=1,
+                unit="Count",
+            )
+            for i in range(count)
+        ]
+
+    def test_is_transient_error(self):
+        """Test that throttling, 5xx and connection errors are transient"""
+        assert is_transient_error(_throttling_error())
+        assert is_transient_error(_throttling_error("ServiceUnavailable"))
+        server_error = ClientError(
+            {
+                "Error": {"Code": "Whatever", "Message": ""},
+                "ResponseMetadata": {"HTTPStatusCode": 503},
+            },
+            "Op",
+        )
+        assert is_transient_error(server_error)
+        assert not is_transient_error(_throttling_error("InvalidParameterValue"))
+        assert not is_transient_error(Exception("boom"))
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_bisect_isolates_rejected_metrics(self, mock_session):
+        """Test that a bad metric in a batch of 16 costs O(log n) extra calls"""
+        inspector, mock_cloudwatch = self._inspector(mock_session)
+        metrics = self._metrics(16)
+
+        def put_metric_data(Namespace, MetricData):
+            if any(m["Dimensions"][0]["Value"] == "fn-5" for m in MetricData):
+                raise ClientError(
+                    {"Error": {"Code": "InvalidParameterValue", "Message": "bad"}},
+                    "PutMetricData",
+                )
+
+        mock_cloudwatch.put_metric_data.side_effect = put_metric_data
+
+        result = inspector.publish_metrics_batch(metrics)
+
+        assert [metric for metric, _ in result.rejected] == [metrics[5]]
+        assert "InvalidParameterValue" in result.rejected[0][1]
+        assert len(result.published) == 15
+        # 1 failed batch + 2 calls per level of the 4 levels down to a single metric
+        assert result.calls == 1 + 2 * 4
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_auth_errors_reject_batch_without_splitting(self, mock_session):
+        """Test that a permission error costs one call instead of splitting to single metrics"""
+        inspector, mock_cloudwatch = self._inspector(mock_session)
+        mock_cloudwatch.put_metric_data.side_effect = _throttling_error("AccessDenied")
+
+        result = inspector.publish_metrics_batch(self._metrics(16))
+
+        assert result.published == []
+        assert len(result.rejected) == 16
+        assert "AccessDenied" in result.rejected[0][1]
+        assert mock_cloudwatch.put_metric_data.call_count == 1
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_service_errors_reject_batch_without_splitting(self, mock_session):
+        """Test that only size and validation errors are bisected"""
+        inspector, mock_cloudwatch = self._inspector(mock_session)
+        mock_cloudwatch.put_metric_data.side_effect = _throttling_error("LimitExceeded")
+
+        result = inspector.publish_metrics_batch(self._metrics(16))
+
+        assert len(result.rejected) == 16
+        assert result.calls == 1
+
+    @patch("lambda_inspector_function.time.sleep")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_transient_errors_are_retried_without_splitting(
+        self, mock_session, mock_sleep
+    ):
+        """Test that a transient error retries the same batch with backoff"""
+        inspector, mock_cloudwatch = self._inspector(mock_session)
+        mock_cloudwatch.put_metric_data.side_effect = [
+            _throttling_error("ServiceUnavailable"),
+            None,
+        ]
+
+        result = inspector.publish_metrics_batch(self._metrics(4))
+
+        assert len(result.published) == 4
+        assert result.calls == 2
+        assert mock_cloudwatch.put_metric_data.call_count == 2
+        mock_sleep.assert_called_once()
+
+    @patch("lambda_inspector_function.time.sleep")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_persistent_transient_errors_reject_batch(self, mock_session, mock_sleep):
+        """Test that a batch failing transiently on every attempt is rejected whole"""
+        inspector, mock_cloudwatch = self._inspector(mock_session)
+        mock_cloudwatch.put_metric_data.side_effect = _throttling_error(
+            "InternalFailure"
+        )
+
+        result = inspector.publish_metrics_batch(self._metrics(4))
+
+        assert result.published == []
+        assert len(result.rejected) == 4
+        assert result.calls == Config.CW_TRANSIENT_MAX_ATTEMPTS
+
+
+class TestCollapseMetrics:
+    """Test collapsing identical series into Values/Counts arrays"""
+
+    @staticmethod
+    def _metric(version, value, metric_name="terraformTag"):
+        return MetricsData(
+            metric_name=metric_name,
+            dimensions=[{"Name": "TerraformVersion", "Value": version}],
+            value=value,
+            unit="Count",
+        )
+
+    def test_collapse_merges_same_series(self):
+        """Test that datapoints of one series become a single Values/Counts entry"""
+        metrics = [
+            self._metric("1.0", 1),
+            self._metric("1.0", 0),
+            self._metric("1.0", 1),
+            self._metric("2.0", 0),
+            self._metric("1.0", 1, metric_name="lambdaTag"),
+        ]
+
+        collapsed = collapse_metrics(metrics)
+
+        assert len(collapsed) == 3
+        merged = collapsed[0].to_cloudwatch_format()
+        assert merged["Values"] == [1, 0]
+        assert merged["Counts"] == [2, 1]
+        assert "Value" not in merged
+        # Single datapoints are kept as is
+        assert collapsed[1] is metrics[3]
+        assert collapsed[2] is metrics[4]
+
+    @patch.object(Config, "CW_MAX_VALUES_PER_METRIC", 2)
+    def test_collapse_splits_distinct_values(self):
+        """Test that an entry never holds more distinct values than allowed"""
+        collapsed = collapse_metrics([self._metric("1.0", value) for value in range(5)])
+
+        assert [entry.values for entry in collapsed] == [[0, 1], [2, 3], [4]]
+        assert all(entry.counts == [1] * len(entry.values) for entry in collapsed)
+
+    def test_different_timestamps_are_not_merged(self):
+        """Test that datapoints with different timestamps stay separate"""
+        first, second = self._metric("1.0", 1), self._metric("1.0", 1)
+        first.timestamp = datetime(2024, 1, 1, tzinfo=UTC)
+        second.timestamp = datetime(2024, 1, 2, tzinfo=UTC)
+
+        collapsed = collapse_metrics([first, second])
+
+        assert collapsed == [first, second]
+        assert collapsed[0].to_cloudwatch_format()["Timestamp"] == first.timestamp
+
+
+class TestMultiRegion:
+    """Test inspecting several regions in a single run"""
+
+    @patch.object(Config, "INSPECTOR_REGIONS", " us-east-1, eu-west-1 ")
+    def test_resolve_regions_from_list(self):
+        """Test that a comma separated region list is used as is"""
+        assert resolve_regions(MagicMock()) == ["us-east-1", "eu-west-1"]
+
+    @patch.object(Config, "INSPECTOR_REGIONS", "all")
+    def test_resolve_all_enabled_regions(self):
+        """Test that "all" resolves the enabled regions"""
+        session = MagicMock()
+        session.client.return_value.describe_regions.return_value = {
+            "Regions": [{"RegionName": "eu-west-1"}, {"RegionName": "us-east-1"}]
+        }
+        assert resolve_regions(session) == ["eu-west-1", "us-east-1"]
+        session.client.assert_called_once()
+        assert session.client.call_args[0] == ("ec2",)
+        assert "config" in session.client.call_args[1]
+
+    def test_resolve_regions_default_is_current_region(self):
+        """Test that no setting keeps the single region behaviour"""
+        assert resolve_regions(MagicMock()) == []
+
+    @patch.object(Config, "REGION_TIME_BUDGET_SECONDS", "60")
+    @patch.object(Config, "REGION_TIME_BUDGETS", "us-east-1=120, eu-west-1=30")
+    def test_region_time_budget(self):
+        """Test per-region budgets with a default"""
+        assert region_time_budget("us-east-1") == 120
+        assert region_time_budget("eu-west-1") == 30
+        assert region_time_budget("ap-south-1") == 60
+
+    def test_region_dimension(self):
+        """Test that a region adds a Region dimension"""
+        service_info = ServiceInfo(
+            env="prod",
+            service="api",
+            stack="main",
+            terraform_version="1.0",
+            region="eu-west-1",
+        )
+        assert create_lambda_dimensions(service_info, "fn", "1.0")[-1] == {
+            "Name": "Region",
+            "Value": "eu-west-1",
+        }
+        assert create_terraform_dimensions(service_info, "1.0")[-1] == {
+            "Name": "Region",
+            "Value": "eu-west-1",
+        }
+
+    @patch.object(Config, "REGION_TIME_BUDGETS", "slow-region=0.05")
+    @patch("lambda_inspector_function.collect_metrics")
+    @patch("lambda_inspector_function.LambdaInspector")
+    def test_regions_run_concurrently_within_budget(
+        self, mock_inspector, mock_collect_metrics
+    ):
+        """Test that every region has its own inspector and slow regions are skipped"""
+        release = threading.Event()
+
+        def collect(inspector, **kwargs):
+            if inspector.region == "slow-region":
+                release.wait(5)
+                return ["slow"]
+            return [inspector.region]
+
+        mock_inspector.side_effect = lambda region_name, **kwargs: MagicMock(
+            region=region_name
+        )
+        mock_collect_metrics.side_effect = collect
+
+        metrics = collect_metrics_by_target(
+            [
+                InspectionTarget(region="us-east-1"),
+                InspectionTarget(region="slow-region"),
+                InspectionTarget(region="eu-west-1"),
+            ],
+            use_aws_config=False,
+        )
+        release.set()
+
+        assert metrics == ["us-east-1", "eu-west-1"]
+        regions = sorted(c[1]["region_name"] for c in mock_inspector.call_args_list)
+        assert regions == ["eu-west-1", "slow-region", "us-east-1"]
+
+
+class TestCrossAccount:
+    """Test sweeping several accounts through AssumeRole"""
+
+    @staticmethod
+    def _credentials(expires_in):
+        return {
+            "Credentials": {
+                "AccessKeyId": "AKIA",
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": datetime.now(timezone.utc)
+                + timedelta(seconds=expires_in),
+            }
+        }
+
+    @patch.object(Config, "INSPECTOR_ACCOUNT_IDS", "111111111111, 222222222222")
+    def test_resolve_accounts_from_list(self):
+        """Test that a comma separated account list is used as is"""
+        assert resolve_accounts(MagicMock()) == ["111111111111", "222222222222"]
+
+    @patch.object(Config, "INSPECTOR_ACCOUNT_IDS", "organization")
+    def test_resolve_active_organization_accounts(self):
+        """Test that "organization" lists the active accounts"""
+        session = MagicMock()
+        session.client.return_value.get_paginator.return_value.paginate.return_value = [
+            {"Accounts": [{"Id": "2", "Status": "ACTIVE"}]},
+            {
+                "Accounts": [
+                    {"Id": "3", "Status": "SUSPENDED"},
+                    {"Id": "1", "Status": "ACTIVE"},
+                ]
+            },
+        ]
+        assert resolve_accounts(session) == ["1", "2"]
+        session.client.assert_called_once()
+        assert session.client.call_args[0] == ("organizations",)
+        assert session.client.call_args[1]["config"].retries["mode"] == (
+            Config.BOTO_RETRY_MODE
+        )
+
+    @patch.object(Config, "INSPECTOR_ACCOUNT_IDS", "1,2")
+    @patch.object(Config, "INSPECTOR_REGIONS", "us-east-1,eu-west-1")
+    def test_targets_interleave_accounts(self):
+        """Test that every account starts before any account gets a second region"""
+        assert resolve_targets(MagicMock()) == [
+            InspectionTarget("1", "us-east-1"),
+            InspectionTarget("2", "us-east-1"),
+            InspectionTarget("1", "eu-west-1"),
+            InspectionTarget("2", "eu-west-1"),
+        ]
+
+    def test_no_targets_by_default(self):
+        """Test that no setting keeps the single account behaviour"""
+        assert resolve_targets(MagicMock()) == []
+
+    @patch("lambda_inspector_function.resolve_targets")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_targets_are_cached_on_warm_inspector(self, mock_session, mock_resolve):
+        """Test that warm invocations reuse the targets until they are refreshed"""
+        mock_resolve.return_value = [InspectionTarget("1", "us-east-1")]
+        inspector = LambdaInspector()
+
+        assert inspector.targets == [InspectionTarget("1", "us-east-1")]
+        assert inspector.targets == [InspectionTarget("1", "us-east-1")]
+        mock_resolve.assert_called_once_with(inspector.session)
+
+        inspector._targets_resolved_at -= Config.TARGETS_REFRESH_SECONDS + 1
+        mock_resolve.return_value = [InspectionTarget("2", "us-east-1")]
+        assert inspector.targets == [InspectionTarget("2", "us-east-1")]
+        assert mock_resolve.call_count == 2
+
+    @patch.object(Config, "ACCOUNT_TIME_BUDGET_SECONDS", "45")
+    @patch.object(Config, "REGION_TIME_BUDGETS", "us-east-1=30,eu-west-1=90")
+    def test_target_time_budget(self):
+        """Test that the tighter of the region and account budgets applies"""
+        assert target_time_budget(InspectionTarget("1", "us-east-1")) == 30
+        assert target_time_budget(InspectionTarget("1", "eu-west-1")) == 45
+        assert target_time_budget(InspectionTarget(region="eu-west-1")) == 90
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_sessions_cached_until_credentials_expire(self, mock_session):
+        """Test that AssumeRole runs once per account while credentials are valid"""
+        sts = MagicMock()
+        sts.assume_role.side_effect = [
+            self._credentials(3600),
+            self._credentials(60),
+            self._credentials(3600),
+        ]
+        sessions = AssumedRoleSessions(sts, "inspector")
+
+        sessions.session("1", "us-east-1")
+        sessions.session("1", "eu-west-1")
+        sessions.session("2")
+        sessions.session("2")
+
+        assert [c[1]["RoleArn"] for c in sts.assume_role.call_args_list] == [
+            "arn:aws:iam::1:role/inspector",
+            "arn:aws:iam::2:role/inspector",
+            "arn:aws:iam::2:role/inspector",
+        ]
+        assert mock_session.call_args_list[1][1] == {
+            "aws_access_key_id": "AKIA",
+            "aws_secret_access_key": "secret",
+            "aws_session_token": "token",
+            "region_name": "eu-west-1",
+        }
+
+    def test_account_dimension(self):
+        """Test that an account adds an AccountId dimension"""
+        service_info = ServiceInfo(
+            env="prod",
+            service="api",
+            stack="main",
+            terraform_version="1.0",
+            region="eu-west-1",
+            account_id="111111111111",
+        )
+        assert create_terraform_dimensions(service_info, "1.0")[-2:] == [
+            {"Name": "Region", "Value": "eu-west-1"},
+            {"Name": "AccountId", "Value": "111111111111"},
+        ]
+
+    @patch("lambda_inspector_function.collect_metrics")
+    @patch("lambda_inspector_function.LambdaInspector")
+    def test_slow_account_does_not_block_others(
+        self, mock_inspector, mock_collect_metrics
+    ):
+        """Test that accounts use assumed sessions and the sweep stops at its deadline"""
+        release = threading.Event()
+
+        def collect(inspector, **kwargs):
+            if inspector.account_id == "slow":
+                release.wait(5)
+            return [inspector.account_id]
+
+        mock_inspector.side_effect = lambda account_id, **kwargs: MagicMock(
+            account_id=account_id
+        )
+        mock_collect_metrics.side_effect = collect
+        sessions = MagicMock()
+
+        metrics = collect_metrics_by_target(
+            [InspectionTarget("slow"), InspectionTarget("1"), InspectionTarget("2")],
+            sessions=sessions,
+            deadline=time.time() + 0.1,
+            use_aws_config=False,
+        )
+        release.set()
+
+        assert metrics == ["1", "2"]
+        assert sorted(c[0][0] for c in sessions.session.call_args_list) == [
+            "1",
+            "2",
+            "slow",
+        ]
+        session_by_account = {
+            c[1]["account_id"]: c[1]["session"] for c in mock_inspector.call_args_list
+        }
+        assert session_by_account["1"] is sessions.session.return_value
+
+    @patch("lambda_inspector_function.collect_metrics")
+    @patch("lambda_inspector_function.LambdaInspector")
+    def test_skipped_target_does_not_save_state(
+        self, mock_inspector, mock_collect_metrics, tmp_path
+    ):
+        """Test that a target still running after the deadline no longer writes state"""
+        release, finished = threading.Event(), threading.Event()
+
+        def collect(inspector, **kwargs):
+            if inspector.account_id == "slow":
+                release.wait(5)
+            inspector.state_store.save("snapshot.json", {"done": True})
+            finished.set()
+            return [inspector.account_id]
+
+        mock_inspector.side_effect = lambda account_id, state_store, **kwargs: (
+            MagicMock(account_id=account_id, state_store=state_store)
+        )
+        mock_collect_metrics.side_effect = collect
+        store = LocalStateStore(str(tmp_path))
+
+        metrics = collect_metrics_by_target(
+            [InspectionTarget("slow"), InspectionTarget("1")],
+            state_store=store,
+            sessions=MagicMock(),
+            deadline=time.time() + 0.1,
+            use_aws_config=False,
+        )
+        finished.clear()
+        release.set()
+        finished.wait(5)
+
+        assert metrics == ["1"]
+        assert store.load("1/snapshot.json") == {"done": True}
+        assert store.load("slow/snapshot.json") is None
+
+    @patch("lambda_inspector_function.collect_metrics")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_target_inspectors_reused_with_one_pool(
+        self, mock_session, mock_collect_metrics
+    ):
+        """Test that warm sweeps reuse target inspectors, all sharing one thread pool"""
+        mock_collect_metrics.side_effect = lambda inspector, **kwargs: [inspector]
+        sessions = MagicMock()
+        credentials = [{"renewed": False}] * 2 + [{"renewed": True}]
+        other_account = {}
+        sessions.credentials.side_effect = lambda account_id: (
+            credentials.pop(0) if account_id == "1" else other_account
+        )
+        inspectors = TargetInspectors(ThreadPoolExecutor(max_workers=2))
+        targets = [InspectionTarget("1"), InspectionTarget("2")]
+
+        runs = [
+            collect_metrics_by_target(
+                targets, sessions=sessions, inspectors=inspectors, use_aws_config=False
+            )
+            for _ in range(3)
+        ]
+
+        first, second, renewed = runs
+        assert second == first
+        # Account 1's credentials were renewed, only its inspector is rebuilt
+        assert renewed[0] is not first[0] and renewed[1] is first[1]
+        assert {inspector.executor.pool for inspector in first} == {inspectors.pool}
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_assumed_role_sessions_kept_on_inspector(self, mock_session):
+        """Test that a warm inspector keeps its assumed role credentials"""
+        inspector = LambdaInspector()
+
+        assert inspector.assumed_role_sessions is inspector.assumed_role_sessions
+
+
+class TestStreamingPipeline:
+    """Test publishing while list_functions pages are still being fetched"""
+
+    @staticmethod
+    def _page(*names):
+        return {
+            "Functions": [
+                {
+                    "FunctionName": name,
+                    "FunctionArn": f"arn:aws:lambda:region:account:function:{name}",
+                }
+                for name in names
+            ]
+        }
+
+    @staticmethod
+    def _tags(Resource):
+        name = Resource.rsplit(":", 1)[-1]
+        return {
+            "Tags": {
+                "AppVersion": f"{name}-1.0",
+                "Stack": "stack",
+                "Service": name,
+                "Environment": "prod",
+                "TerraformVersion": "1.5.0",
+            }
+        }
+
+    @staticmethod
+    def _published(mock_cloudwatch):
+        return sorted(
+            json.dumps(metric, sort_keys=True)
+            for c in mock_cloudwatch.put_metric_data.call_args_list
+            for metric in c[1]["MetricData"]
+        )
+
+    def _run(self, mode, pages, put_metric_data=None):
+        reset_inspector()
+        with patch("lambda_inspector_function.boto3.Session") as mock_session:
+            mock_lambda = MagicMock()
+            mock_cloudwatch = MagicMock()
+            mock_session.return_value.client.side_effect = [
+                mock_lambda,
+                mock_cloudwatch,
+                MagicMock(),
+            ]
+            mock_lambda.get_paginator.return_value.paginate.return_value = pages
+            mock_lambda.list_tags.side_effect = self._tags
+            mock_cloudwatch.put_metric_data.side_effect = put_metric_data
+            with patch.object(Config, "PIPELINE_MODE", mode):
+                publish_metrics(use_aws_config=False)
+        return mock_cloudwatch
+
+    def test_streaming_publishes_same_metrics_as_batch(self):
+        """Test that both pipeline modes publish the same datapoints"""
+        pages = [self._page("a", "b"), self._page("c"), self._page("d", "e")]
+        batch = self._run("batch", pages)
+        streaming = self._run("streaming", pages)
+
+        assert self._published(streaming) == self._published(batch)
+        assert len(self._published(batch)) == 10
+
+    def test_first_batch_published_before_listing_ends(self):
+        """Test that the first page is published while later pages are pending"""
+        published = threading.Event()
+        seen_before_second_page = []
+
+        def pages():
+            yield self._page("a")
+            seen_before_second_page.append(published.wait(5))
+            yield self._page("b")
+
+        mock_cloudwatch = self._run(
+            "streaming", pages(), lambda **kwargs: published.set()
+        )
+
+        assert seen_before_second_page == [True]
+        assert mock_cloudwatch.put_metric_data.call_count == 2
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_account_wide_history_read_once_per_run(self, mock_session, tmp_path):
+        """Test that every page reuses one advanced query and watermarks are saved once"""
+        mock_lambda, mock_config = MagicMock(), MagicMock()
+        clients = {"lambda": mock_lambda, "config": mock_config}
+        mock_session.return_value.client.side_effect = (
+            lambda service, **kwargs: clients.get(service) or MagicMock()
+        )
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            self._page(name) for name in "abcde"
+        ]
+        mock_lambda.list_tags.side_effect = self._tags
+        mock_config.select_resource_config.return_value = {
+            "Results": [
+                json.dumps(
+                    {
+                        "resourceName": "c",
+                        "tags": [{"key": "AppVersion", "value": "c-0.9"}],
+                    }
+                )
+            ]
+        }
+        store = LocalStateStore(str(tmp_path))
+        inspector = LambdaInspector(state_store=store)
+
+        with patch.object(store, "save", wraps=store.save) as save:
+            stream_metrics(
+                inspector, use_aws_config=True, history_backend="config-select"
+            )
+
+        assert mock_config.select_resource_config.call_count == 1
+        saved = [c[0][0] for c in save.call_args_list]
+        assert saved.count("select_watermarks.json") == 1
+        assert inspector.select_watermarks.versions("c", 0)[0] == {"c-0.9"}
+
+    def test_stage_error_is_raised(self):
+        """Test that a failing stage stops the pipeline and raises its error"""
+        inspector = MagicMock()
+        inspector._load_snapshot.return_value = {}
+        inspector.list_function_pages.return_value = iter([[], []])
+        inspector.resolve_functions.side_effect = RuntimeError("tags failed")
+
+        with pytest.raises(RuntimeError, match="tags failed"):
+            stream_metrics(inspector)
+        inspector.commit_functions.assert_not_called()
+
+
+class TestWarmStart:
+    """Test reusing the inspector across warm invocations"""
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_inspector_reused_by_warm_invocations(self, mock_session):
+        """Test that only the first invocation creates the session and clients"""
+        first, cold = get_inspector()
+        second, warm = get_inspector()
+
+        assert first is second
+        assert mock_session.call_count == 1
+        assert (cold.warm, cold.invocation) == (False, 1)
+        assert (warm.warm, warm.invocation, warm.init_ms) == (True, 2, 0.0)
+
+        reset_inspector()
+        assert get_inspector()[0] is not first
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_config_client_created_on_first_use(self, mock_session):
+        """Test that runs without history never create an AWS Config client"""
+        inspector = LambdaInspector()
+        services = [c[0][0] for c in mock_session.return_value.client.call_args_list]
+        assert services == ["lambda", "cloudwatch"]
+
+        assert inspector.config_client is inspector.config_client
+        assert mock_session.return_value.client.call_args_list[-1][0][0] == "config"
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_handler_invocations_report_start_kind(self, mock_session):
+        """Test that publish_metrics reports a cold then a warm start"""
+        mock_session.return_value.client.return_value.get_paginator.return_value.paginate.return_value = (
+            []
+        )
+
+        assert publish_metrics().warm is False
+        assert publish_metrics().warm is True
+        assert mock_session.call_count == 1
+
+
+class TestCompactRecords:
+    """Test the memory layout of functions, services and metrics"""
+
+    def test_records_are_slotted(self):
+        """Test that records carry no per-instance __dict__"""
+        service_info = ServiceInfo(
+            env="prod", service="api", stack="main", terraform_version="1.0"
+        )
+        function = LambdaFunction(name="fn", arn="arn", tags={})
+        metric = MetricsData(metric_name="m", dimensions=[], value=1, unit="Count")
+        for record in (service_info, function, metric):
+            assert not hasattr(record, "__dict__")
+
+    def test_list_functions_entries_are_compacted(self):
+        """Test that only the fields the inspector reads are kept"""
+        entry = {
+            "FunctionName": "fn",
+            "FunctionArn": "arn",
+            "LastModified": "2024-01-01",
+            "RevisionId": "r1",
+            "Environment": {"Variables": {"SECRET": "value"}},
+            "Layers": [{"Arn": "layer"}],
+        }
+        assert compact_function(entry) == {
+            "FunctionName": "fn",
+            "FunctionArn": "arn",
+            "LastModified": "2024-01-01",
+            "RevisionId": "r1",
+        }
+
+    def test_tags_are_compacted(self):
+        """Test that tags the inspector does not read are dropped"""
+        tags = compact_tags({"AppVersion": "1.0", "Owner": "team", "Stack": "main"})
+        assert tags == {"AppVersion": "1.0", "Stack": "main"}
+
+    def test_dimensions_shared_per_service(self):
+        """Test that metrics of a service share their dimension dicts"""
+        service_info = ServiceInfo(
+            env="prod", service="api", stack="main", terraform_version="1.0"
+        )
+        first = create_lambda_dimensions(service_info, "fn-a", "1.0")
+        second = create_lambda_dimensions(service_info, "fn-b", "1.0")
+        terraform = create_terraform_dimensions(service_info, "1.0")
+
+        assert first is not second
+        assert all(a is b for a, b in zip(first[:3], second[:3]))
+        assert all(a is b for a, b in zip(first[:3], terraform[:3]))
+        assert first[4] is second[4]
+        assert first[3] == {"Name": "FunctionName", "Value": "fn-a"}
+
+
+class TestEmfSink:
+    """Test the Embedded Metric Format output mode"""
+
+    @staticmethod
+    def _service(service="api"):
+        return ServiceInfo(
+            env="prod", service=service, stack="main", terraform_version="1.5.0"
+        )
+
+    def _lambda_metric(self, function_name, version, value=1, service="api"):
+        return MetricsData(
+            metric_name=MetricNames.LAMBDA_TAG,
+            dimensions=create_lambda_dimensions(
+                self._service(service), function_name, version
+            ),
+            value=value,
+            unit="Count",
+        )
+
+    def _terraform_metric(self, version, value=1, service="api"):
+        return MetricsData(
+            metric_name=MetricNames.TERRAFORM_TAG,
+            dimensions=create_terraform_dimensions(self._service(service), version),
+            value=value,
+            unit="Count",
+        )
+
+    def test_compatible_metrics_share_a_document(self):
+        """Test that a function and its service metric share one line"""
+        documents = pack_emf_documents(
+            [self._lambda_metric("fn", "1.0"), self._terraform_metric("1.5.0")], "NS"
+        )
+
+        assert len(documents) == 1
+        document = documents[0]
+        assert document["lambdaTag"] == 1
+        assert document["terraformTag"] == 1
+        assert document["FunctionName"] == "fn"
+        assert document["TerraformVersion"] == "1.5.0"
+        directives = document["_aws"]["CloudWatchMetrics"]
+        assert [d["Metrics"][0]["Name"] for d in directives] == [
+            "lambdaTag",
+            "terraformTag",
+        ]
+        assert directives[0]["Namespace"] == "NS"
+        assert directives[0]["Dimensions"] == [
+            ["Env", "Stack", "Service", "FunctionName", "AppVersion"]
+        ]
+
+    def test_conflicting_dimensions_use_separate_documents(self):
+        """Test that metrics disagreeing on a dimension value never share a line"""
+        documents = pack_emf_documents(
+            [
+                self._lambda_metric("fn", "1.0"),
+                self._lambda_metric("fn", "0.9", value=0),
+                self._lambda_metric("other", "1.0", service="web"),
+            ],
+            "NS",
+        )
+
+        assert len(documents) == 3
+        assert sorted((d["AppVersion"], d["lambdaTag"]) for d in documents) == [
+            ("0.9", 0),
+            ("1.0", 1),
+            ("1.0", 1),
+        ]
+
+    def test_datapoints_of_a_series_become_value_arrays(self):
+        """Test that repeated datapoints of a series are packed as an array"""
+        metrics = [self._lambda_metric("fn", "1.0") for _ in range(3)]
+        documents = pack_emf_documents(metrics, "NS")
+
+        assert len(documents) == 1
+        assert documents[0]["lambdaTag"] == [1, 1, 1]
+
+    @patch.object(Config, "EMF_MAX_VALUES_PER_METRIC", 2)
+    def test_value_arrays_respect_emf_limit(self):
+        """Test that value arrays are split at the EMF limit"""
+        metrics = [self._lambda_metric("fn", "1.0") for _ in range(3)]
+        documents = pack_emf_documents(metrics, "NS")
+
+        assert [d["lambdaTag"] for d in documents] == [[1, 1], 1]
+
+    @patch.object(Config, "METRIC_SINK", "emf")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_publish_metrics_writes_emf_without_api_calls(self, mock_session, capsys):
+        """Test that the EMF sink replaces PutMetricData"""
+        mock_lambda = MagicMock()
+        mock_cloudwatch = MagicMock()
+        mock_session.return_value.client.side_effect = [mock_lambda, mock_cloudwatch]
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {"Functions": [{"FunctionName": "fn", "FunctionArn": "arn:fn"}]}
+        ]
+        mock_lambda.list_tags.return_value = {
+            "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+        }
+
+        publish_metrics(use_aws_config=False)
+
+        mock_cloudwatch.put_metric_data.assert_not_called()
+        documents = [
+            json.loads(line)
+            for line in capsys.readouterr().out.splitlines()
+            if line.startswith('{"_aws"')
+        ]
+        assert len(documents) == 1
+        assert documents[0]["lambdaTag"] == 1
+        assert documents[0]["terraformTag"] == 1
+
+    def test_sink_reports_written_metrics(self):
+        """Test that every written metric counts as published"""
+        stream = MagicMock()
+        metrics = [self._lambda_metric("fn", "1.0"), self._terraform_metric("1.5.0")]
+
+        result = EmfSink(namespace="NS", stream=stream).publish(metrics)
+
+        assert result.published == metrics
+        assert result.calls == 0
+        assert stream.write.call_count == 1
+
+
+def _snappy_decompress(data):
+    """Decode the snappy blocks the built-in encoder writes (literals only)"""
+    position = 0
+    while data[position] & 0x80:
+        position += 1
+    position += 1
+    output = bytearray()
+    while position < len(data):
+        tag = data[position]
+        assert tag & 0x03 == 0, "only literal chunks are expected"
+        length = tag >> 2
+        position += 1
+        if length >= 60:
+            size = length - 59
+            length = int.from_bytes(data[position : position + size], "little")
+            position += size
+        length += 1
+        output += data[position : position + length]
+        position += length
+    return bytes(output)
+
+
+def _protobuf_fields(data):
+    """Decode protobuf fields into (number, value) pairs"""
+    fields = []
+    position = 0
+
+    def varint():
+        nonlocal position
+        value = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    while position < len(data):
+        key = varint()
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            fields.append((number, varint()))
+        elif wire_type == 1:
+            fields.append(
+                (number, struct.unpack("<d", data[position : position + 8])[0])
+            )
+            position += 8
+        else:
+            length = varint()
+            fields.append((number, data[position : position + length]))
+            position += length
+    return fields
+
+
+def _decode_write_request(body):
+    series = []
+    for _, timeseries in _protobuf_fields(body):
+        labels = []
+        samples = []
+        for number, value in _protobuf_fields(timeseries):
+            if number == 1:
+                label = dict(_protobuf_fields(value))
+                labels.append((label[1].decode(), label[2].decode()))
+            else:
+                samples.append(dict(_protobuf_fields(value)))
+        series.append((labels, samples))
+    return series
+
+
+class TestMetricSinks:
+    """Test the OpenMetrics file, JSONL and Prometheus remote-write sinks"""
+
+    @staticmethod
+    def _metric(function_name, version="1.0", value=1):
+        return MetricsData(
+            metric_name=MetricNames.LAMBDA_TAG,
+            dimensions=[
+                {"Name": "Env", "Value": "prod"},
+                {"Name": "FunctionName", "Value": function_name},
+                {"Name": "AppVersion", "Value": version},
+            ],
+            value=value,
+            unit="Count",
+        )
+
+    def test_openmetrics_file_written_on_flush(self, tmp_path):
+        """Test that series are buffered and written as one exposition file, highest value first"""
+        path = tmp_path / "metrics.prom"
+        sink = OpenMetricsFileSink(str(path))
+
+        assert sink.publish([self._metric("a"), self._metric('b"q')]).published == []
+        assert sink.publish([self._metric("a", value=0)]).published == []
+        assert not path.exists()
+
+        result = sink.flush()
+
+        assert len(result.published) == 2
+        assert path.read_text().splitlines() == [
+            "# TYPE lambdaTag gauge",
+            'lambdaTag{AppVersion="1.0",Env="prod",FunctionName="a"} 1',
+            'lambdaTag{AppVersion="1.0",Env="prod",FunctionName="b\\"q"} 1',
+            "# EOF",
+        ]
+        assert sink.flush().published == []
+
+    @patch.object(Config, "JSONL_BUFFER_LINES", 2)
+    def test_jsonl_buffered_until_full(self, tmp_path):
+        """Test that lines are written once the buffer is full and on flush"""
+        path = tmp_path / "metrics.jsonl"
+        sink = JsonLinesSink(str(path))
+
+        assert sink.publish([self._metric("a")]).published == []
+        assert not path.exists()
+        assert len(sink.publish([self._metric("b")]).published) == 2
+        sink.publish([self._metric("c")])
+        assert len(sink.flush().published) == 1
+
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [r["Dimensions"][1]["Value"] for r in records] == ["a", "b", "c"]
+        assert all(r["MetricName"] == "lambdaTag" and "Timestamp" in r for r in records)
+
+    def test_snappy_fallback_is_literal_only(self):
+        """Test the built-in snappy encoder round trip"""
+        data = bytes(range(256)) * 300
+        with patch("lambda_inspector_function.snappy", None):
+            assert _snappy_decompress(snappy_compress(data)) == data
+            assert _snappy_decompress(snappy_compress(b"short")) == b"short"
+
+    @patch.object(Config, "REMOTE_WRITE_BATCH_SIZE", 2)
+    @patch("lambda_inspector_function._jittered_backoff")
+    @patch("lambda_inspector_function.snappy", None)
+    def test_remote_write_against_local_stub(self, mock_backoff):
+        """Test batching, encoding and retries against a local endpoint"""
+        requests = []
+        statuses = [500, 204, 204]
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                requests.append((dict(self.headers), body))
+                self.send_response(statuses.pop(0))
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            sink = PrometheusRemoteWriteSink(
+                f"http://127.0.0.1:{server.server_port}/api/v1/push"
+            )
+            first = sink.publish(
+                [self._metric("a"), self._metric("b", value=0), self._metric("c")]
+            )
+            last = sink.flush()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert (len(first.published), first.calls) == (2, 2)
+        assert (len(last.published), last.calls) == (1, 1)
+        assert mock_backoff.call_count == 1
+        headers, body = requests[1]
+        assert headers["Content-Encoding"] == "snappy"
+        assert headers["Content-Type"] == "application/x-protobuf"
+        assert headers["X-Prometheus-Remote-Write-Version"] == "0.1.0"
+        series = _decode_write_request(_snappy_decompress(body))
+        assert [labels for labels, _ in series] == [
+            [
+                ("AppVersion", "1.0"),
+                ("Env", "prod"),
+                ("FunctionName", "a"),
+                ("__name__", "lambdaTag"),
+            ],
+            [
+                ("AppVersion", "1.0"),
+                ("Env", "prod"),
+                ("FunctionName", "b"),
+                ("__name__", "lambdaTag"),
+            ],
+        ]
+        assert [samples[0][1] for _, samples in series] == [1.0, 0.0]
+        assert all(samples[0][2] > 0 for _, samples in series)
+
+    @patch("lambda_inspector_function.snappy", None)
+    def test_remote_write_sends_each_series_once(self):
+        """Test that a series emitted twice is sent once with its highest value"""
+        with patch("urllib.request.urlopen") as urlopen:
+            sink = PrometheusRemoteWriteSink("http://127.0.0.1:1/push")
+            sink.publish([self._metric("a", value=0), self._metric("b")])
+            sink.publish([self._metric("a", value=1)])
+            sink.flush()
+            sink.publish([self._metric("a", value=0)])
+            sink.flush()
+
+        bodies = [
+            _decode_write_request(_snappy_decompress(c[0][0].data))
+            for c in urlopen.call_args_list
+        ]
+        assert [
+            [(dict(labels)["FunctionName"], samples[0][1]) for labels, samples in body]
+            for body in bodies
+        ] == [[("a", 1.0), ("b", 1.0)], [("a", 0.0)]]
+
+    def test_encoded_request_never_repeats_a_series(self):
+        """Test that duplicate series of one request are merged"""
+        body = encode_write_request(
+            [self._metric("a", value=1), self._metric("a", value=0)], 1000
+        )
+
+        assert [samples[0][1] for _, samples in _decode_write_request(body)] == [1.0]
+
+    @patch.object(Config, "METRIC_SINK", "openmetrics")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_shared_terraform_version_written_once(self, mock_session, tmp_path):
+        """Test that a version in one function's history and another's deployment is running"""
+        mock_lambda, mock_config = MagicMock(), MagicMock()
+        clients = {"lambda": mock_lambda, "config": mock_config}
+        mock_session.return_value.client.side_effect = (
+            lambda service, **kwargs: clients.get(service) or MagicMock()
+        )
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {
+                "Functions": [
+                    {"FunctionName": name, "FunctionArn": f"arn:{name}"}
+                    for name in ("b", "a")
+                ]
+            }
+        ]
+
+        def tags(Resource):
+            return {
+                "Tags": {
+                    "AppVersion": "1.0",
+                    "Stack": "stack",
+                    "Service": "api",
+                    "Environment": "prod",
+                    "TerraformVersion": "v1" if Resource == "arn:a" else "v2",
+                }
+            }
+
+        mock_lambda.list_tags.side_effect = tags
+        # Function a ran v2 before, function b still does
+        mock_config.get_paginator.return_value.paginate.return_value = [
+            {"configurationItems": [{"tags": {"TerraformVersion": "v2"}}]}
+        ]
+        path = tmp_path / "metrics.prom"
+
+        with patch.object(Config, "METRIC_SINK_PATH", str(path)):
+            publish_metrics(use_aws_config=True)
+
+        v2 = [
+            line
+            for line in path.read_text().splitlines()
+            if line.startswith("terraformTag{") and 'TerraformVersion="v2"' in line
+        ]
+        assert len(v2) == 1 and v2[0].endswith(" 1")
+
+    @patch("lambda_inspector_function._jittered_backoff")
+    def test_remote_write_client_errors_are_rejected(self, mock_backoff):
+        """Test that 4xx answers are not retried and reject the batch"""
+        sink = PrometheusRemoteWriteSink("http://127.0.0.1:1/push")
+        error = urllib.error.HTTPError(sink.url, 400, "bad request", {}, None)
+        with patch("urllib.request.urlopen") as urlopen:
+            urlopen.side_effect = error
+            sink.publish([self._metric("a")])
+            result = sink.flush()
+
+        assert urlopen.call_count == 1
+        assert len(result.rejected) == 1
+        mock_backoff.assert_not_called()
+
+    @patch.object(Config, "METRIC_SINK", "jsonl")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_publish_metrics_to_jsonl(self, mock_session, tmp_path):
+        """Test that a file sink replaces PutMetricData for a whole run"""
+        mock_lambda = MagicMock()
+        mock_cloudwatch = MagicMock()
+        mock_session.return_value.client.side_effect = [mock_lambda, mock_cloudwatch]
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {"Functions": [{"FunctionName": "fn", "FunctionArn": "arn:fn"}]}
+        ]
+        mock_lambda.list_tags.return_value = {
+            "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+        }
+        path = tmp_path / "out" / "metrics.jsonl"
+
+        with patch.object(Config, "METRIC_SINK_PATH", str(path)):
+            publish_metrics(use_aws_config=False)
+
+        mock_cloudwatch.put_metric_data.assert_not_called()
+        names = [
+            json.loads(line)["MetricName"] for line in path.read_text().splitlines()
+        ]
+        assert sorted(names) == ["lambdaTag", "terraformTag"]
+
+
+class TestRunTelemetry:
+    """Test phase timing, per-API statistics and inspector self-metrics"""
+
+    def test_phases_accumulate(self):
+        """Test that repeated phases add up"""
+        telemetry = RunTelemetry()
+        telemetry.add_phase(Phases.PUBLISH, 10)
+        telemetry.add_phase(Phases.PUBLISH, 5)
+        with telemetry.phase(Phases.METRIC_BUILD):
+            time.sleep(0.01)
+
+        phases = telemetry.summary()["phases_ms"]
+        assert phases[Phases.PUBLISH] == 15
+        assert phases[Phases.METRIC_BUILD] >= 10
+
+        telemetry.reset()
+        assert telemetry.summary() == {"phases_ms": {}, "apis": {}}
+
+    def test_api_latency_percentiles(self):
+        """Test nearest-rank percentiles, throttles and retries per API"""
+        telemetry = RunTelemetry()
+        for latency in range(1, 101):
+            telemetry.record_call("lambda:ListTags", latency, retries=latency % 2)
+        telemetry.record_call("config:GetResourceConfigHistory", 7, throttled=True)
+
+        apis = telemetry.summary()["apis"]
+        assert apis["lambda:ListTags"] == {
+            "calls": 100,
+            "throttles": 0,
+            "retries": 50,
+            "latency_ms": {"p50": 50, "p90": 90, "p99": 99, "max": 100},
+        }
+        assert apis["config:GetResourceConfigHistory"]["throttles"] == 1
+        assert apis["config:GetResourceConfigHistory"]["latency_ms"]["p50"] == 7
+
+    def test_botocore_hooks_record_calls(self):
+        """Test that attached clients report each operation and its throttles"""
+        import boto3
+        from botocore.stub import Stubber
+
+        client = boto3.client(
+            "lambda",
+            region_name="eu-west-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        telemetry = RunTelemetry()
+        telemetry.attach(client, "lambda")
+        with Stubber(client) as stubber:
+            stubber.add_response("list_tags", {"Tags": {}})
+            stubber.add_client_error(
+                "list_tags", service_error_code="TooManyRequestsException"
+            )
+            client.list_tags(Resource="arn:fn")
+            with pytest.raises(ClientError):
+                client.list_tags(Resource="arn:fn")
+
+        stats = telemetry.summary()["apis"]["lambda:ListTags"]
+        assert stats["calls"] == 2
+        assert stats["throttles"] == 1
+
+    def test_merge_adds_target_telemetry(self):
+        """Test that target inspectors add to the run's telemetry"""
+        run, target = RunTelemetry(), RunTelemetry()
+        run.add_phase(Phases.PUBLISH, 3)
+        target.add_phase(Phases.LIST_FUNCTIONS, 4)
+        target.record_call("lambda:ListTags", 2, throttled=True, retries=1)
+
+        run.merge(target)
+        run.merge(target)
+
+        summary = run.summary()
+        assert summary["phases_ms"] == {Phases.PUBLISH: 3, Phases.LIST_FUNCTIONS: 8}
+        assert summary["apis"]["lambda:ListTags"]["calls"] == 2
+        assert summary["apis"]["lambda:ListTags"]["throttles"] == 2
+        assert summary["apis"]["lambda:ListTags"]["retries"] == 2
+
+    def test_build_self_metrics(self):
+        """Test the self-metrics built from a run summary"""
+        summary = {
+            "phases_ms": {Phases.LIST_FUNCTIONS: 12.5},
+            "apis": {
+                "lambda:ListTags": {
+                    "calls": 3,
+                    "throttles": 1,
+                    "retries": 2,
+                    "latency_ms": {"p50": 4.0, "max": 9.0},
+                }
+            },
+        }
+        metrics = {
+            (
+                metric.metric_name,
+                tuple(d["Value"] for d in metric.dimensions),
+            ): (metric.value, metric.unit)
+            for metric in build_self_metrics(summary, 100.0)
+        }
+
+        assert metrics == {
+            (MetricNames.RUN_DURATION, ()): (100.0, "Milliseconds"),
+            (MetricNames.PHASE_DURATION, ("list_functions",)): (12.5, "Milliseconds"),
+            (MetricNames.API_CALLS, ("lambda:ListTags",)): (3, "Count"),
+            (MetricNames.API_THROTTLES, ("lambda:ListTags",)): (1, "Count"),
+            (MetricNames.API_RETRIES, ("lambda:ListTags",)): (2, "Count"),
+            (MetricNames.API_LATENCY, ("lambda:ListTags", "p50")): (
+                4.0,
+                "Milliseconds",
+            ),
+            (MetricNames.API_LATENCY, ("lambda:ListTags", "max")): (
+                9.0,
+                "Milliseconds",
+            ),
+        }
+
+    @patch.object(Config, "SELF_METRICS", True)
+    @patch.object(Config, "METRIC_SINK", "jsonl")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_publish_metrics_reports_run(self, mock_session, tmp_path, capsys):
+        """Test the summary log line and self-metrics of a run"""
+        mock_lambda = MagicMock()
+        mock_session.return_value.client.side_effect = [mock_lambda, MagicMock()]
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {"Functions": [{"FunctionName": "fn", "FunctionArn": "arn:fn"}]}
+        ]
+        mock_lambda.list_tags.return_value = {
+            "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+        }
+        path = tmp_path / "metrics.jsonl"
+
+        with patch.object(Config, "METRIC_SINK_PATH", str(path)):
+            publish_metrics(use_aws_config=False)
+
+        summaries = [
+            json.loads(line)
+            for line in capsys.readouterr().out.splitlines()
+            if line.startswith('{"event": "inspector_run_summary"')
+        ]
+        assert len(summaries) == 1
+        summary = summaries[0]
+        assert summary["start"] == "cold"
+        assert summary["metrics"]["lambda"] == 1
+        assert set(summary["phases_ms"]) == {
+            Phases.LIST_FUNCTIONS,
+            Phases.TAG_FETCH,
+            Phases.METRIC_BUILD,
+            Phases.PUBLISH,
+        }
+
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        phases = {
+            line["Dimensions"][0]["Value"]
+            for line in lines
+            if line["MetricName"] == MetricNames.PHASE_DURATION
+        }
+        assert phases == set(summary["phases_ms"])
+        assert sum(line["MetricName"] == MetricNames.LAMBDA_TAG for line in lines) == 1
+
+    @patch.object(Config, "SELF_METRICS", True)
+    @patch.object(Config, "METRIC_SINK", "openmetrics")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_self_metrics_share_the_final_flush(self, mock_session, tmp_path):
+        """Test that the replaced OpenMetrics file keeps the run's series"""
+        mock_lambda = MagicMock()
+        mock_session.return_value.client.side_effect = [mock_lambda, MagicMock()]
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {"Functions": [{"FunctionName": "fn", "FunctionArn": "arn:fn"}]}
+        ]
+        mock_lambda.list_tags.return_value = {
+            "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+        }
+        path = tmp_path / "metrics.prom"
+
+        with patch.object(Config, "METRIC_SINK_PATH", str(path)):
+            publish_metrics(use_aws_config=False)
+
+        exposition = path.read_text()
+        assert "lambdaTag{" in exposition
+        assert "terraformTag{" in exposition
+        assert f"{MetricNames.RUN_DURATION} " in exposition
+
+    @patch.object(Config, "ACTIVE_REFRESH_SECONDS", 3600)
+    @patch.object(Config, "METRIC_SINK", "openmetrics")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_openmetrics_file_keeps_unchanged_series(self, mock_session, tmp_path):
+        """Test that the keepalive scheduler does not thin out the replaced file"""
+        path = tmp_path / "metrics.prom"
+        expositions = []
+        with patch.object(Config, "STATE_DIR", str(tmp_path / "state")), patch.object(
+            Config, "METRIC_SINK_PATH", str(path)
+        ):
+            for _ in range(2):
+                reset_inspector()
+                mock_lambda = MagicMock()
+                mock_session.return_value.client.side_effect = [
+                    mock_lambda,
+                    MagicMock(),
+                ]
+                mock_lambda.get_paginator.return_value.paginate.return_value = [
+                    {"Functions": [{"FunctionName": "fn", "FunctionArn": "arn:fn"}]}
+                ]
+                mock_lambda.list_tags.return_value = {
+                    "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+                }
+                publish_metrics(use_aws_config=False)
+                expositions.append(path.read_text())
+                path.unlink()
+
+        assert expositions[0] == expositions[1]
+        assert "lambdaTag{" in expositions[1] and "terraformTag{" in expositions[1]
+
+
+class TestCheckpointedRuns:
+    """Test deadline-bounded runs, their checkpoints and continuations"""
+
+    FUNCTIONS = ["fn-a", "fn-b", "fn-c"]
+
+    def _container(self, mock_session, functions):
+        """Clients of a new container, returns (lambda, cloudwatch, config) mocks"""
+        reset_inspector()
+        clients = (MagicMock(), MagicMock(), MagicMock())
+        mock_lambda, _, mock_config = clients
+        mock_session.return_value.client.side_effect = list(clients)
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {
+                "Functions": [
+                    {"FunctionName": name, "FunctionArn": f"arn:{name}"}
+                    for name in functions
+                ]
+            }
+        ]
+        mock_lambda.list_tags.return_value = {
+            "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+        }
+        mock_config.get_paginator.return_value.paginate.return_value = [
+            {"configurationItems": [{"tags": {"AppVersion": "0.9"}}]}
+        ]
+        return clients
+
+    @staticmethod
+    def _published(mock_cloudwatch):
+        return [
+            metric
+            for call in mock_cloudwatch.put_metric_data.call_args_list
+            for metric in call[1]["MetricData"]
+        ]
+
+    def test_invocation_deadline(self):
+        """Test the deadline left by the Lambda context"""
+        assert invocation_deadline({}) is None
+        assert invocation_deadline(None) is None
+
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 60_000
+        with patch.object(Config, "CHECKPOINT_RESERVE_SECONDS", 5):
+            deadline = invocation_deadline(context)
+        assert 54 < deadline - time.time() <= 55
+
+    @patch.object(Config, "HISTORY_CHUNK_SIZE", 1)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_history_completes_over_several_invocations(self, mock_session, tmp_path):
+        """Test that each invocation fetches one more chunk until the run completes"""
+        history_calls = 0
+        runs = []
+        with patch.object(Config, "STATE_DIR", str(tmp_path)):
+            for _ in self.FUNCTIONS:
+                _, mock_cloudwatch, mock_config = self._container(
+                    mock_session, self.FUNCTIONS
+                )
+                # Already past the deadline, only the first chunk runs
+                start = publish_metrics(use_aws_config=True, deadline=time.time() - 1)
+                history_calls += (
+                    mock_config.get_paginator.return_value.paginate.call_count
+                )
+                runs.append((start.checkpointed, len(self._published(mock_cloudwatch))))
+                checkpoint = RunCheckpoint(
+                    LocalStateStore(str(tmp_path)),
+                    dict(
+                        use_aws_config=True,
+                        earlier_days=Config.FULL_HISTORY_EARLIER_DAYS,
+                        later_days=0,
+                        history_backend=None,
+                    ),
+                )
+                if start.checkpointed:
+                    assert len(checkpoint.history) == len(runs)
+
+        # Every function's history is fetched once, metrics are published at the end
+        assert history_calls == len(self.FUNCTIONS)
+        assert runs == [(True, 0), (True, 0), (False, 7)]
+        assert checkpoint.history == {}
+        assert LocalStateStore(str(tmp_path)).load(checkpoint.name) is None
+
+    @patch.object(Config, "PUBLISH_CHUNK_SIZE", 1)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_unpublished_metrics_are_resumed(self, mock_session, tmp_path):
+        """Test that metrics left at the deadline are published by the next invocation"""
+        with patch.object(Config, "STATE_DIR", str(tmp_path)):
+            mock_lambda, mock_cloudwatch, _ = self._container(mock_session, ["fn-a"])
+            first = publish_metrics(use_aws_config=False, deadline=time.time() - 1)
+            first_published = self._published(mock_cloudwatch)
+
+            mock_lambda, mock_cloudwatch, _ = self._container(mock_session, ["fn-a"])
+            second = publish_metrics(use_aws_config=False, deadline=time.time() - 1)
+            second_published = self._published(mock_cloudwatch)
+
+        assert first.checkpointed and not second.checkpointed
+        assert len(first_published) == len(second_published) == 1
+        assert {
+            first_published[0]["MetricName"],
+            second_published[0]["MetricName"],
+        } == {
+            "lambdaTag",
+            "terraformTag",
+        }
+        # The resumed invocation does not list functions again
+        mock_lambda.get_paginator.assert_not_called()
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_checkpoint_of_other_parameters_is_ignored(self, mock_session, tmp_path):
+        """Test that a run with other parameters starts over"""
+        store = LocalStateStore(str(tmp_path))
+        params = dict(use_aws_config=True, earlier_days=30)
+        checkpoint = RunCheckpoint(store, params)
+        checkpoint.history["fn-a"] = ({"1.0"}, {"1.5.0"})
+        checkpoint.save()
+
+        assert RunCheckpoint(store, params).history == {"fn-a": ({"1.0"}, {"1.5.0"})}
+        assert RunCheckpoint(store, dict(params, earlier_days=7)).history == {}
+        with patch.object(Config, "CHECKPOINT_MAX_AGE_SECONDS", -1):
+            assert RunCheckpoint(store, params).history == {}
+
+    def test_completed_run_keeps_checkpoints_of_other_runs(self, tmp_path):
+        """Test that a current run completing does not clear a history checkpoint"""
+        store = LocalStateStore(str(tmp_path))
+        history_params = dict(use_aws_config=True, earlier_days=30)
+        history = RunCheckpoint(store, history_params)
+        history.history["fn-a"] = ({"1.0"}, {"1.5.0"})
+        history.save()
+
+        RunCheckpoint(store, dict(use_aws_config=False, earlier_days=1)).clear()
+
+        assert RunCheckpoint(store, history_params).history == {
+            "fn-a": ({"1.0"}, {"1.5.0"})
+        }
+
+    @patch.object(Config, "PUBLISH_CHUNK_SIZE", 1)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_run_without_state_publishes_everything(self, mock_session):
+        """Test that metrics are not left behind when no checkpoint can carry them"""
+        with patch.object(Config, "STATE_DIR", None):
+            _, mock_cloudwatch, _ = self._container(mock_session, ["fn-a"])
+            start = publish_metrics(use_aws_config=False, deadline=time.time() - 1)
+
+        assert not start.checkpointed
+        assert len(self._published(mock_cloudwatch)) == 2
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_continue_run_invokes_itself(self, mock_session):
+        """Test the asynchronous follow-up invocation"""
+        mock_lambda = MagicMock()
+        mock_session.return_value.client.side_effect = [mock_lambda, MagicMock()]
+        get_inspector()
+        context = MagicMock()
+        context.invoked_function_arn = "arn:inspector"
+
+        response = continue_run({"earlier_days": 30, "continuation": 2}, context)
+
+        assert response["statusCode"] == 202
+        kwargs = mock_lambda.invoke.call_args[1]
+        assert kwargs["FunctionName"] == "arn:inspector"
+        assert kwargs["InvocationType"] == "Event"
+        assert json.loads(kwargs["Payload"]) == {"earlier_days": 30, "continuation": 3}
+
+        with patch.object(Config, "MAX_CONTINUATIONS", 3):
+            continue_run({"continuation": 3}, context)
+        assert mock_lambda.invoke.call_count == 1
+
+    @patch("lambda_inspector_function.continue_run")
+    @patch("lambda_inspector_function.publish_metrics")
+    def test_handler_continues_checkpointed_run(
+        self, mock_publish_metrics, mock_continue_run
+    ):
+        """Test that a handler passes its deadline and continues a checkpointed run"""
+        mock_publish_metrics.return_value = StartInfo(
+            warm=False, invocation=1, init_ms=0.0, checkpointed=True
+        )
+        mock_continue_run.return_value = {"statusCode": 202, "body": "Checkpointed"}
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 900_000
+
+        response = handle_history_metrics({}, context)
+
+        assert response["statusCode"] == 202
+        assert mock_publish_metrics.call_args[1]["deadline"] > time.time()
+        mock_continue_run.assert_called_once_with({}, context)
+
+
+class TestShardedHistory:
+    """Test history fetched by parallel shard workers"""
+
+    FUNCTIONS = [f"fn-{i:02d}" for i in range(12)]
+
+    def _session(self, mock_session):
+        """Session handing out the same Lambda and Config stand-ins to every inspector"""
+        mock_lambda, mock_config = MagicMock(), MagicMock()
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {
+                "Functions": [
+                    {"FunctionName": name, "FunctionArn": f"arn:{name}"}
+                    for name in self.FUNCTIONS
+                ]
+            }
+        ]
+
+        def tags(Resource):
+            index = int(Resource[-2:])
+            return {
+                "Tags": {
+                    "AppVersion": f"1.{index}",
+                    "TerraformVersion": "1.5.0",
+                    "Service": f"service-{index % 3}",
+                }
+            }
+
+        def history(resourceId, **kwargs):
+            index = int(resourceId[-2:])
+            return [
+                {
+                    "configurationItems": [
+                        {
+                            "tags": {
+                                "AppVersion": f"0.{index}",
+                                "TerraformVersion": f"1.{index % 4}.0",
+                            }
+                        }
+                    ]
+                }
+            ]
+
+        mock_lambda.list_tags.side_effect = tags
+        mock_config.get_paginator.return_value.paginate.side_effect = history
+        clients = {
+            "lambda": mock_lambda,
+            "config": mock_config,
+            "cloudwatch": MagicMock(),
+        }
+        mock_session.return_value.client.side_effect = (
+            lambda service, **kwargs: clients.get(service) or MagicMock()
+        )
+        return mock_lambda, mock_config
+
+    @staticmethod
+    def _sorted(metrics):
+        # Versions are sets, only the order of a function's metrics may differ
+        return sorted(
+            metrics,
+            key=lambda m: (m.metric_name, [d["Value"] for d in m.dimensions]),
+        )
+
+    def _collect(self, shard_count):
+        return self._sorted(
+            collect_metrics(
+                LambdaInspector(state_store=None),
+                use_aws_config=True,
+                shard_count=shard_count,
+            )
+        )
+
+    def test_shard_of_is_stable(self):
+        """Test that shards only depend on the function name"""
+        assert shard_of("fn-00", 4) == shard_of("fn-00", 4)
+        assert [shard_of(name, 4) for name in ("a", "b", "c")] == [3, 1, 3]
+        assert {shard_of(name, 4) for name in self.FUNCTIONS} == {0, 1, 2, 3}
+
+    @patch.object(Config, "SHARD_WORKER_FUNCTION", None)
+    @patch("lambda_inspector_function._shard_pool", ThreadPoolExecutor)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_local_shards_match_single_process(self, mock_session):
+        """Test that local shard workers give exactly the single-process metrics"""
+        _, mock_config = self._session(mock_session)
+        single = self._collect(1)
+        history_calls = mock_config.get_paginator.return_value.paginate.call_count
+
+        sharded = self._collect(4)
+
+        assert sharded == single
+        # Each function's history is fetched once by its shard
+        assert (
+            mock_config.get_paginator.return_value.paginate.call_count
+            == 2 * history_calls
+        )
+
+    @patch.object(Config, "SHARD_WORKER_FUNCTION", "inspector-worker")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_lambda_shards_match_single_process(self, mock_session, tmp_path):
+        """Test shard workers invoked through Lambda, with results in the state store"""
+        mock_lambda, _ = self._session(mock_session)
+        single = self._collect(1)
+
+        def invoke(FunctionName, InvocationType, Payload):
+            # The worker runs right away instead of asynchronously
+            assert (FunctionName, InvocationType) == ("inspector-worker", "Event")
+            handle_history_shard(json.loads(Payload), None)
+
+        mock_lambda.invoke.side_effect = invoke
+        with patch.object(Config, "STATE_DIR", str(tmp_path)):
+            sharded = self._sorted(
+                collect_metrics(
+                    LambdaInspector(state_store=LocalStateStore(str(tmp_path))),
+                    use_aws_config=True,
+                    shard_count=3,
+                )
+            )
+
+        assert sharded == single
+        assert mock_lambda.invoke.call_count == 3
+        # Workers hand their watermarks back to the coordinator
+        assert set(
+            LocalStateStore(str(tmp_path)).load("history_watermarks.json")["functions"]
+        ) == set(self.FUNCTIONS)
+        assert not (tmp_path / "shard-0-of-3").exists()
+        # The coordinator deletes the run's shard inputs and results
+        assert not [p for p in (tmp_path / "shard-runs").rglob("*") if p.is_file()]
+
+    @patch.object(Config, "SHARD_WORKER_FUNCTION", None)
+    @patch("lambda_inspector_function._shard_pool", ThreadPoolExecutor)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_sharding_continues_single_process_history(self, mock_session, tmp_path):
+        """Test that turning sharding on keeps the watermarks of earlier runs"""
+        _, mock_config = self._session(mock_session)
+        store = LocalStateStore(str(tmp_path))
+        single = self._sorted(
+            collect_metrics(LambdaInspector(state_store=store), use_aws_config=True)
+        )
+        # Later scans find nothing new, the versions come from the watermarks
+        mock_config.get_paginator.return_value.paginate.side_effect = lambda **kwargs: [
+            {"configurationItems": []}
+        ]
+
+        sharded = self._sorted(
+            collect_metrics(
+                LambdaInspector(state_store=store), use_aws_config=True, shard_count=3
+            )
+        )
+
+        assert sharded == single
+        watermarks = store.load("history_watermarks.json")["functions"]
+        assert set(watermarks) == set(self.FUNCTIONS)
+        assert all(entry["app"] for entry in watermarks.values())
+
+    @patch.object(Config, "SHARD_TIMEOUT_SECONDS", 0)
+    @patch.object(Config, "SHARD_WORKER_FUNCTION", "inspector-worker")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_unfinished_shards_are_fetched_by_coordinator(self, mock_session, tmp_path):
+        """Test that shards without a result in time are fetched in-process"""
+        mock_lambda, _ = self._session(mock_session)
+        single = self._collect(1)
+
+        sharded = self._sorted(
+            collect_metrics(
+                LambdaInspector(state_store=LocalStateStore(str(tmp_path))),
+                use_aws_config=True,
+                shard_count=3,
+            )
+        )
+
+        assert sharded == single
+        assert mock_lambda.invoke.call_count == 3
+        assert not [p for p in (tmp_path / "shard-runs").rglob("*") if p.is_file()]
+
+    @patch("lambda_inspector_function.handle_history_shard")
+    @patch("lambda_inspector_function.publish_metrics")
+    def test_history_handler_forwards_shard_events(
+        self, mock_publish_metrics, mock_handle_history_shard
+    ):
+        """Test that the history handler serves as its own shard worker"""
+        event = {"shard_run": "run", "shard": 0, "shards": 2}
+        handle_history_metrics(event, {})
+
+        mock_handle_history_shard.assert_called_once_with(event, {})
+        mock_publish_metrics.assert_not_called()
+
+
+class TestFunctionEvents:
+    """Test incremental updates from function change events"""
+
+    ARN = "arn:aws:lambda:eu-west-1:123456789012:function:fn"
+
+    @staticmethod
+    def _event(name, parameters, time="2024-05-01T10:00:00Z", **detail):
+        return {
+            "detail-type": "AWS API Call via CloudTrail",
+            "source": "aws.lambda",
+            "account": "123456789012",
+            "region": "eu-west-1",
+            "time": time,
+            "detail": {
+                "eventName": name,
+                "eventTime": time,
+                "awsRegion": "eu-west-1",
+                "recipientAccountId": "123456789012",
+                "requestParameters": parameters,
+                **detail,
+            },
+        }
+
+    def _container(self, mock_session):
+        reset_inspector()
+        mock_lambda, mock_cloudwatch = MagicMock(), MagicMock()
+        mock_session.return_value.region_name = "eu-west-1"
+        mock_session.return_value.client.side_effect = [mock_lambda, mock_cloudwatch]
+        return mock_lambda, mock_cloudwatch
+
+    @staticmethod
+    def _published(mock_cloudwatch):
+        return sorted(
+            (
+                metric["MetricName"],
+                next(
+                    d["Value"]
+                    for d in metric["Dimensions"]
+                    if d["Name"] in ("AppVersion", "TerraformVersion")
+                ),
+                metric["Value"],
+            )
+            for call in mock_cloudwatch.put_metric_data.call_args_list
+            for metric in call[1]["MetricData"]
+        )
+
+    def test_parse_function_events(self):
+        """Test which events are kept and how they are merged per function"""
+        events = [
+            self._event("UpdateFunctionCode20150331v2", {"functionName": "fn"}),
+            self._event(
+                "TagResource20170331v2",
+                {"resource": f"{self.ARN}:prod", "tags": {"AppVersion": "2.0"}},
+                time="2024-05-01T10:00:05Z",
+            ),
+            self._event("DeleteFunction20150331", {"functionName": "other"}),
+            self._event(
+                "UntagResource20170331v2",
+                {"resource": "arn:aws:lambda:us-east-1:123456789012:function:fn"},
+                awsRegion="us-east-1",
+            ),
+            self._event("GetFunction20150331v2", {"functionName": "fn"}),
+            self._event(
+                "CreateFunction20150331",
+                {"functionName": "failed"},
+                errorCode="AccessDenied",
+            ),
+        ]
+        sqs_event = {"Records": [{"body": json.dumps(event)} for event in events]}
+
+        changes = parse_function_events(sqs_event, "eu-west-1")
+
+        assert changes == {
+            self.ARN: datetime(2024, 5, 1, 10, 0, 5, tzinfo=timezone.utc).timestamp(),
+            "arn:aws:lambda:eu-west-1:123456789012:function:other": datetime(
+                2024, 5, 1, 10, tzinfo=timezone.utc
+            ).timestamp(),
+        }
+        assert len(parse_function_events(events[3])) == 1
+
+    @patch.object(Config, "EVENT_COALESCE_SECONDS", 0)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_version_change_updates_only_its_series(self, mock_session, tmp_path):
+        """Test that a deploy publishes the new version and retires the old one"""
+        store = LocalStateStore(str(tmp_path))
+        store.save(
+            "function_snapshot.json",
+            {
+                "refreshed_at": 0,
+                "functions": {
+                    self.ARN: [
+                        "old",
+                        {"AppVersion": "1.0", "TerraformVersion": "1.5.0"},
+                    ]
+                },
+            },
+        )
+        with patch.object(Config, "STATE_DIR", str(tmp_path)):
+            mock_lambda, mock_cloudwatch = self._container(mock_session)
+            mock_lambda.get_function.return_value = {
+                "Configuration": {
+                    "FunctionName": "fn",
+                    "FunctionArn": self.ARN,
+                    "LastModified": "2024-05-01T10:00:00.000+0000",
+                    "RevisionId": "r2",
+                },
+                "Tags": {"AppVersion": "2.0", "TerraformVersion": "1.5.0"},
+            }
+
+            response = handle_function_events(
+                self._event("UpdateFunctionCode20150331v2", {"functionName": "fn"}),
+                {},
+            )
+
+        assert response["statusCode"] == 200
+        mock_lambda.get_function.assert_called_once_with(FunctionName=self.ARN)
+        mock_lambda.get_paginator.assert_not_called()
+        assert self._published(mock_cloudwatch) == [
+            ("lambdaTag", "1.0", 0),
+            ("lambdaTag", "2.0", 1),
+            ("terraformTag", "1.5.0", 1),
+        ]
+        snapshot = store.load("function_snapshot.json")
+        assert snapshot["functions"][self.ARN] == [
+            "2024-05-01T10:00:00.000+0000|r2",
+            {"AppVersion": "2.0", "TerraformVersion": "1.5.0"},
+        ]
+
+    @patch.object(Config, "EVENT_COALESCE_SECONDS", 0)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_deleted_function_is_retired(self, mock_session, tmp_path):
+        """Test that a deleted function's series are set to 0"""
+        store = LocalStateStore(str(tmp_path))
+        store.save(
+            "function_snapshot.json",
+            {
+                "refreshed_at": 0,
+                "functions": {
+                    self.ARN: [
+                        "old",
+                        {"AppVersion": "1.0", "TerraformVersion": "1.5.0"},
+                    ]
+                },
+            },
+        )
+        with patch.object(Config, "STATE_DIR", str(tmp_path)):
+            mock_lambda, mock_cloudwatch = self._container(mock_session)
+            mock_lambda.get_function.side_effect = ClientError(
+                {"Error": {"Code": "ResourceNotFoundException", "Message": "gone"}},
+                "GetFunction",
+            )
+
+            handle_function_events(
+                self._event("DeleteFunction20150331", {"functionName": "fn"}), {}
+            )
+
+        assert self._published(mock_cloudwatch) == [
+            ("lambdaTag", "1.0", 0),
+            ("terraformTag", "1.5.0", 0),
+        ]
+        assert store.load("function_snapshot.json")["functions"] == {}
+
+    @patch.object(Config, "EVENT_COALESCE_SECONDS", 0)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_terraform_series_kept_while_siblings_run_it(self, mock_session, tmp_path):
+        """Test that one function's upgrade does not retire its service's version"""
+        tags = {
+            "AppVersion": "1.0",
+            "TerraformVersion": "1.5.0",
+            "Service": "orders",
+        }
+        store = LocalStateStore(str(tmp_path))
+        store.save(
+            "function_snapshot.json",
+            {
+                "refreshed_at": 0,
+                "functions": {
+                    self.ARN: ["old", tags],
+                    f"{self.ARN}-sibling": ["old", tags],
+                },
+            },
+        )
+        with patch.object(Config, "STATE_DIR", str(tmp_path)):
+            mock_lambda, mock_cloudwatch = self._container(mock_session)
+            mock_lambda.get_function.return_value = {
+                "Configuration": {"FunctionName": "fn", "FunctionArn": self.ARN},
+                "Tags": dict(tags, TerraformVersion="1.6.0"),
+            }
+
+            handle_function_events(
+                self._event("TagResource20170331v2", {"resource": self.ARN}), {}
+            )
+
+        assert self._published(mock_cloudwatch) == [
+            ("lambdaTag", "1.0", 1),
+            ("terraformTag", "1.6.0", 1),
+        ]
+
+    @patch.object(Config, "EVENT_COALESCE_SECONDS", 0)
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_events_already_handled_are_skipped(self, mock_session):
+        """Test that a warm container does not re-read functions for old events"""
+        mock_lambda, mock_cloudwatch = self._container(mock_session)
+        mock_lambda.get_function.return_value = {
+            "Configuration": {"FunctionName": "fn", "FunctionArn": self.ARN},
+            "Tags": {"AppVersion": "2.0", "TerraformVersion": "1.5.0"},
+        }
+        event = self._event("TagResource20170331v2", {"resource": self.ARN})
+
+        handle_function_events(event, {})
+        response = handle_function_events(event, {})
+
+        assert response["body"] == "No function changes"
+        assert mock_lambda.get_function.call_count == 1
+        assert self._published(mock_cloudwatch) == [
+            ("lambdaTag", "2.0", 1),
+            ("terraformTag", "1.5.0", 1),
+        ]
+
+
+class TestVersionIndex:
+    """Test the SQLite version inventory"""
+
+    @staticmethod
+    def _function(name, version, env="prod", service="orders", terraform="1.5.0"):
+        return LambdaFunction(
+            name=name,
+            arn=f"arn:aws:lambda:eu-west-1:123456789012:function:{name}",
+            tags={
+                "AppVersion": version,
+                "TerraformVersion": terraform,
+                "Environment": env,
+                "Stack": "shop",
+                "Service": service,
+            },
+        )
+
+    @pytest.fixture
+    def index(self, tmp_path):
+        index = VersionIndex(str(tmp_path / "index" / "versions.db"))
+        yield index
+        index.close()
+
+    def test_runs_update_rows_incrementally(self, index):
+        """Test that first_seen is kept and replaced versions stop being current"""
+        inspector = LambdaInspector(state_store=None, session=MagicMock())
+        index.update(
+            inspector,
+            [self._function("a", "1.0"), self._function("b", "1.0")],
+            complete=True,
+            now=100,
+        )
+        index.update(inspector, [self._function("a", "1.1")], complete=True, now=200)
+
+        rows = {(r["function"], r["app_version"]): r for r in index.last_seen()}
+        assert rows[("a", "1.0")]["current"] == 0
+        assert rows[("a", "1.1")]["current"] == 1
+        assert rows[("a", "1.1")]["first_seen"] == 200
+        # b was not listed by the second run, it is gone
+        assert rows[("b", "1.0")]["current"] == 0
+        assert rows[("b", "1.0")]["last_seen"] == 100
+
+        index.update(inspector, [self._function("a", "1.1")], complete=True, now=300)
+        row = index.last_seen(function="a", app_version="1.1")[0]
+        assert (row["first_seen"], row["last_seen"]) == (200, 300)
+
+    def test_partial_updates_only_touch_their_functions(self, index):
+        """Test that change events keep the other functions current"""
+        inspector = LambdaInspector(state_store=None, session=MagicMock())
+        index.update(
+            inspector,
+            [self._function("a", "1.0"), self._function("b", "1.0")],
+            complete=True,
+            now=100,
+        )
+        index.update(inspector, [self._function("a", "2.0")], gone=["c"], now=200)
+
+        assert [r["function"] for r in index.running("1.0")] == ["b"]
+        assert [r["function"] for r in index.running("1.0", current=False)] == [
+            "a",
+            "b",
+        ]
+        assert [r["function"] for r in index.running("2.0", env="prod")] == ["a"]
+        assert index.running("2.0", env="dev") == []
+
+    def test_targets_are_kept_apart(self, index):
+        """Test that a complete run of one region leaves the others current"""
+        west = LambdaInspector(
+            state_store=None, session=MagicMock(), region_name="eu-west-1"
+        )
+        east = LambdaInspector(
+            state_store=None, session=MagicMock(), region_name="us-east-1"
+        )
+        index.update(west, [self._function("a", "1.0")], complete=True, now=100)
+        index.update(east, [self._function("a", "1.0")], complete=True, now=100)
+        index.update(west, [], complete=True, now=200)
+
+        assert [r["region"] for r in index.running("1.0")] == ["us-east-1"]
+
+    def test_drift_between_environments(self, index):
+        """Test that services with different versions per environment are reported"""
+        inspector = LambdaInspector(state_store=None, session=MagicMock())
+        index.update(
+            inspector,
+            [
+                self._function("prod-orders", "1.0"),
+                self._function("dev-orders", "1.1", env="dev"),
+                self._function("prod-cart", "3.0", service="cart"),
+                self._function("dev-cart", "3.0", env="dev", service="cart"),
+                self._function(
+                    "qa-cart", "3.0", env="qa", service="cart", terraform="1.6.0"
+                ),
+            ],
+            complete=True,
+        )
+
+        assert index.drift(["prod", "dev"]) == [
+            {
+                "stack": "shop",
+                "service": "orders",
+                "envs": {
+                    "dev": {"app_versions": ["1.1"], "terraform_versions": ["1.5.0"]},
+                    "prod": {"app_versions": ["1.0"], "terraform_versions": ["1.5.0"]},
+                },
+            }
+        ]
+        assert [row["service"] for row in index.drift()] == ["cart", "orders"]
+
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_runs_and_events_update_the_index(self, mock_session, tmp_path):
+        """Test that publish_metrics and change events keep the index current"""
+        path = str(tmp_path / "versions.db")
+        reset_inspector()
+        mock_lambda, mock_cloudwatch = MagicMock(), MagicMock()
+        mock_session.return_value.region_name = "eu-west-1"
+        mock_session.return_value.client.side_effect = [mock_lambda, mock_cloudwatch]
+        arn = "arn:aws:lambda:eu-west-1:123456789012:function:fn"
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {"Functions": [{"FunctionName": "fn", "FunctionArn": arn}]}
+        ]
+        mock_lambda.list_tags.return_value = {
+            "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+        }
+        mock_lambda.get_function.return_value = {
+            "Configuration": {"FunctionName": "fn", "FunctionArn": arn},
+            "Tags": {"AppVersion": "2.0", "TerraformVersion": "1.5.0"},
+        }
+
+        with patch.object(Config, "VERSION_INDEX_PATH", path), patch.object(
+            Config, "EVENT_COALESCE_SECONDS", 0
+        ):
+            publish_metrics(use_aws_config=False)
+            handle_function_events(
+                TestFunctionEvents._event("TagResource20170331v2", {"resource": arn}),
+                {},
+            )
+
+        index = VersionIndex(path)
+        assert [
+            (r["app_version"], r["current"]) for r in index.last_seen(function="fn")
+        ] == [
+            ("2.0", 1),
+            ("1.0", 0),
+        ]
+        index.close()
+
+    def test_cli_queries(self, index, capsys):
+        """Test the index subcommands"""
+        inspector = LambdaInspector(state_store=None, session=MagicMock())
+        index.update(inspector, [self._function("a", "1.0")], complete=True)
+        index.close()
+
+        assert (
+            version_index_cli(["--path", index.path, "--json", "running", "1.0"]) == 0
+        )
+        rows = json.loads(capsys.readouterr().out)
+        assert [row["function"] for row in rows] == ["a"]
+
+        assert (
+            version_index_cli(["--path", index.path, "last-seen", "--function", "a"])
+            == 0
+        )
+        output = capsys.readouterr().out
+        assert "prod/shop/orders  a  1.0  Terraform 1.5.0" in output
+        assert "1 rows in" in output
+
+        assert version_index_cli(["--path", str(index.path) + ".missing", "drift"]) == 1
+
+
+class TestSnapshotExport:
+    """Test the columnar snapshot export"""
+
+    @staticmethod
+    def _row(name, version, service="orders"):
+        function = LambdaFunction(
+            name=name,
+            arn=f"arn:aws:lambda:eu-west-1:123456789012:function:{name}",
+            tags={"AppVersion": version, "TerraformVersion": "1.5.0"},
+        )
+        return ServiceInfo("prod", service, "shop", "1.5.0"), function
+
+    @staticmethod
+    def _read(path):
+        pyarrow = pytest.importorskip("pyarrow")
+        if path.endswith(".parquet"):
+            import pyarrow.parquet
+
+            return pyarrow.parquet.read_table(path)
+        return pyarrow.ipc.open_stream(path).read_all()
+
+    @pytest.mark.parametrize("export_format", ["parquet", "arrow"])
+    def test_rows_are_written_in_batches(self, tmp_path, export_format):
+        """Test that batches share dictionaries and the file reads back"""
+        pyarrow = pytest.importorskip("pyarrow")
+        exporter = SnapshotExporter(
+            str(tmp_path), export_format, batch_rows=2, now=1714557600
+        )
+        for name, version, service in (
+            ("a", "1.0", "orders"),
+            ("b", "1.1", "orders"),
+            ("c", "1.0", "cart"),
+        ):
+            service_info, function = self._row(name, version, service)
+            exporter.add(service_info, function, {version, "0.9"}, {"1.5.0"})
+
+        location = exporter.close()
+        table = self._read(location)
+
+        extension = "parquet" if export_format == "parquet" else "arrows"
+        assert location.endswith(f"inspector-snapshot-20240501T100000Z.{extension}")
+        assert table.num_rows == 3
+        assert pyarrow.types.is_dictionary(table.schema.field("service").type)
+        assert pyarrow.types.is_dictionary(
+            table.schema.field("app_versions").type.value_type
+        )
+        rows = table.to_pylist()
+        assert [row["service"] for row in rows] == ["orders", "orders", "cart"]
+        assert rows[2]["app_versions"] == ["0.9", "1.0"]
+        assert rows[2]["region"] is None
+        assert rows[0]["observed_at"].timestamp() == 1714557600
+
+    def test_nothing_is_written_without_rows(self, tmp_path):
+        """Test that an empty run leaves no file"""
+        pytest.importorskip("pyarrow")
+        exporter = SnapshotExporter(str(tmp_path))
+
+        assert exporter.close() is None
+        assert list(tmp_path.iterdir()) == []
+
+    def test_s3_destination_is_uploaded(self, tmp_path):
+        """Test that the file is uploaded and the local copy removed"""
+        pytest.importorskip("pyarrow")
+        s3_client = MagicMock()
+        with patch.object(Config, "DEFAULT_STATE_DIR", str(tmp_path)):
+            exporter = SnapshotExporter(
+                "s3://bucket/exports/", s3_client=s3_client, now=1714557600
+            )
+            exporter.add(*self._row("a", "1.0"), {"1.0"}, {"1.5.0"})
+            location = exporter.close()
+
+        key = "exports/inspector-snapshot-20240501T100000Z.parquet"
+        assert location == f"s3://bucket/{key}"
+        s3_client.upload_file.assert_called_once_with(
+            str(tmp_path / "inspector-snapshot-20240501T100000Z.parquet"), "bucket", key
+        )
+        assert list(tmp_path.iterdir()) == []
+
+    @pytest.mark.parametrize("pipeline_mode", ["batch", "streaming"])
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_publish_metrics_exports_functions(
+        self, mock_session, tmp_path, pipeline_mode
+    ):
+        """Test that a run exports the functions it built metrics for"""
+        pytest.importorskip("pyarrow")
+        mock_lambda, mock_cloudwatch = MagicMock(), MagicMock()
+        mock_session.return_value.client.side_effect = [mock_lambda, mock_cloudwatch]
+        mock_lambda.get_paginator.return_value.paginate.return_value = [
+            {"Functions": [{"FunctionName": "fn", "FunctionArn": "arn:fn"}]}
+        ]
+        mock_lambda.list_tags.return_value = {
+            "Tags": {"AppVersion": "1.0", "TerraformVersion": "1.5.0"}
+        }
+
+        with patch.object(Config, "SNAPSHOT_EXPORT_PATH", str(tmp_path)), patch.object(
+            Config, "PIPELINE_MODE", pipeline_mode
+        ):
+            publish_metrics(use_aws_config=False)
+
+        (path,) = tmp_path.iterdir()
+        rows = self._read(str(path)).to_pylist()
+        assert [(row["function_name"], row["app_version"]) for row in rows] == [
+            ("fn", "1.0")
+        ]
+
+
+class TestObservationLog:
+    """Test the observation log and the snapshot-log history backend"""
+
+    DAY = 86400
+    NOW = datetime(2024, 5, 1, tzinfo=timezone.utc).timestamp()
+
+    def test_observations_are_collapsed_into_intervals(self, tmp_path):
+        """Test that only version changes are appended to the daily segment"""
+        store = LocalStateStore(str(tmp_path))
+        log = ObservationLog(store)
+        log.record(
+            {"a": ("1.0", "1.5.0"), "b": ("1.0", "1.5.0")}, complete=True, now=self.NOW
+        )
+        log.record(
+            {"a": ("1.0", "1.5.0"), "b": ("1.0", "1.5.0")},
+            complete=True,
+            now=self.NOW + 60,
+        )
+        assert store.load("observations/2024-05-01.json") is None
+
+        log.record({"a": ("1.1", "1.5.0")}, complete=True, now=self.NOW + 120)
+
+        log = ObservationLog(store)
+        assert log.running == {"a": ["1.1", "1.5.0", self.NOW + 120, self.NOW + 120]}
+        assert store.load("observations/2024-05-01.json")["intervals"] == [
+            ["a", "1.0", "1.5.0", self.NOW, self.NOW + 60],
+            ["b", "1.0", "1.5.0", self.NOW, self.NOW + 60],
+        ]
+
+    def test_partial_records_keep_other_functions(self, tmp_path):
+        """Test that change events only close the intervals they touched"""
+        log = ObservationLog(LocalStateStore(str(tmp_path)))
+        log.record(
+            {"a": ("1.0", "1.5.0"), "b": ("1.0", "1.5.0")}, complete=True, now=self.NOW
+        )
+        log.record({"a": ("2.0", "1.5.0")}, gone=["c"], now=self.NOW + 60)
+
+        assert set(log.running) == {"a", "b"}
+        log.record({}, gone=["b"], now=self.NOW + 120)
+        assert set(log.running) == {"a"}
+
+    def test_versions_within_time_range(self, tmp_path):
+        """Test that history only holds versions seen in the window, reading the segments it needs"""
+        store = LocalStateStore(str(tmp_path))
+        log = ObservationLog(store)
+        log.record({"a": ("1.0", "1.4.0")}, complete=True, now=self.NOW - 30 * self.DAY)
+        log.record({"a": ("1.1", "1.5.0")}, complete=True, now=self.NOW - 10 * self.DAY)
+        log.record({"a": ("1.2", "1.5.0")}, complete=True, now=self.NOW - 2 * self.DAY)
+
+        with patch.object(store, "load", wraps=store.load) as load:
+            history = log.versions(["a", "b"], 7, now=self.NOW)
+        assert history == {"a": ({"1.2"}, {"1.5.0"}), "b": (set(), set())}
+        # Only the segment of the last deploy can overlap the last 7 days
+        load.assert_called_once_with("observations/2024-04-29.json")
+
+        assert log.versions(["a"], 20, now=self.NOW)["a"] == (
+            {"1.1", "1.2"},
+            {"1.5.0"},
+        )
+        assert log.versions(["a"], 40, 5, now=self.NOW)["a"] == (
+            {"1.0", "1.1"},
+            {"1.4.0", "1.5.0"},
+        )
+        # Without names, every function of the log in one read
+        assert log.versions(None, 7, now=self.NOW) == {"a": ({"1.2"}, {"1.5.0"})}
+
+    @patch.object(Config, "OBSERVATION_LOG_RETENTION_DAYS", 20)
+    def test_old_segments_are_pruned(self, tmp_path):
+        """Test that segments beyond the retention are deleted and forgotten"""
+        store = LocalStateStore(str(tmp_path))
+        log = ObservationLog(store)
+        log.record({"a": ("1.0", "1.5.0")}, complete=True, now=self.NOW - 40 * self.DAY)
+        log.record({"a": ("1.1", "1.5.0")}, complete=True, now=self.NOW - 30 * self.DAY)
+        log.record({"a": ("1.2", "1.5.0")}, complete=True, now=self.NOW)
+
+        assert log.segments == ["2024-05-01"]
+        assert store.load("observations/2024-04-01.json") is None
+        assert not (tmp_path / "observations" / "2024-04-01.json").exists()
+
+    @patch.object(Config, "HISTORY_BACKEND", "snapshot-log")
+    @patch("lambda_inspector_function.boto3.Session")
+    def test_history_runs_without_aws_config(self, mock_session, tmp_path):
+        """Test that history metrics come from earlier runs' observations"""
+        mock_lambda, mock_cloudwatch = MagicMock(), MagicMock()
+        mock_session.return_value.client.side_effect = [mock_lambda, mock_cloudwatch]
+        paginate = mock_lambda.get_paginator.return_value.paginate
+        mock_lambda.list_tags.side_effect = [
+            {"Tags": {"AppVersion": version, "TerraformVersion": "1.5.0"}}
+            for version in ("1.0", "2.0")
+        ]
+
+        with patch.object(Config, "STATE_DIR", str(tmp_path)):
+            for revision in ("r1", "r2"):
+                paginate.return_value = [
+                    {
+                        "Functions": [
+                            {
+                                "FunctionName": "fn",
+                                "FunctionArn": "arn:fn",
+                                "RevisionId": revision,
+                            }
+                        ]
+                    }
+                ]
+                mock_cloudwatch.put_metric_data.reset_mock()
+                publish_metrics(use_aws_config=True)
+
+        # Only the lambda and cloudwatch clients were created
+        assert mock_session.return_value.client.call_count == 2
+        published = sorted(
+            (metric["MetricName"], dimension["Value"], metric["Value"])
+            for call in mock_cloudwatch.put_metric_data.call_args_list
+            for metric in call[1]["MetricData"]
+            for dimension in metric["Dimensions"]
+            if dimension["Name"] == "AppVersion"
+        )
+        assert published == [("lambdaTag", "1.0", 0), ("lambdaTag", "2.0", 1)]